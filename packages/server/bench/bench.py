@@ -17,7 +17,7 @@ Options:
     -n, --iterations N      Requests per query (default: 100)
     -w, --warmup N          Warmup requests (default: 5)
     -s, --servers LIST      Comma-separated servers to test (default: auto-detect)
-                            Options: rust, go, python, node
+                            Options: rust, go, python, python-asgi, node
     --ws-only               Only run WebSocket benchmarks
     --http-only             Only run HTTP benchmarks
     -h, --help              Show this help
@@ -101,6 +101,9 @@ BENCHMARKS: list[tuple[str, str, str]] = [
     ("scan: 1k rows", "arrow", "SELECT * FROM flights LIMIT 1000"),
     ("scan: 10k rows", "arrow", "SELECT * FROM flights LIMIT 10000"),
     ("full table: athletes", "arrow", "SELECT * FROM athletes"),
+    # -- JSON encoding of larger results --
+    ("scan: 10k rows", "json", "SELECT * FROM flights LIMIT 10000"),
+    ("full table: athletes", "json", "SELECT * FROM athletes"),
     # -- complex / realistic --
     (
         "M4-style: time-series",
@@ -332,11 +335,32 @@ def build_and_start_go(port: int) -> subprocess.Popen | None:
 
 def build_and_start_python(port: int) -> subprocess.Popen | None:
     py_dir = SERVER_DIR / "duckdb-server"
-    if port != 3000:  # ruff: ignore[magic-value-comparison]
-        print("  WARNING: Python server does not support custom ports, using 3000")
     print("  Starting Python server ...")
     return subprocess.Popen(
-        ["uv", "run", "duckdb-server"],
+        ["uv", "run", "duckdb-server", "--port", str(port)],
+        cwd=py_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def build_and_start_python_asgi(port: int) -> subprocess.Popen | None:
+    py_dir = SERVER_DIR / "duckdb-server"
+    print("  Starting Python server as an ASGI app on uvicorn ...")
+    return subprocess.Popen(
+        [
+            "uv",
+            "run",
+            "--with",
+            "uvicorn[standard]",
+            "uvicorn",
+            "--factory",
+            "pkg.asgi:create_app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
         cwd=py_dir,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
@@ -371,6 +395,7 @@ SERVER_BUILDERS = {
     "rust": build_and_start_rust,
     "go": build_and_start_go,
     "python": build_and_start_python,
+    "python-asgi": build_and_start_python_asgi,
     "node": build_and_start_node,
 }
 
@@ -378,6 +403,7 @@ SERVER_REQUIREMENTS = {
     "rust": "cargo",
     "go": "go",
     "python": "uv",
+    "python-asgi": "uv",
     "node": "node",
 }
 
@@ -522,7 +548,7 @@ def main() -> None:
     parser.add_argument(
         "-s",
         "--servers",
-        help="Comma-separated list of servers (rust,go,python,node). "
+        help="Comma-separated list of servers (rust,go,python,python-asgi,node). "
         "If omitted, auto-detects available runtimes.",
     )
     transport = parser.add_mutually_exclusive_group()
@@ -1,28 +1,16 @@
 from __future__ import annotations
 
-import logging
-import sys
-
-import duckdb
-from diskcache import Cache
-
-from pkg.server import server
-
-logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+from pkg.launch import run, run_processes
+from pkg.options import parse_args
 
 
 def serve() -> None:
-    db_path = sys.argv[1] if len(sys.argv) >= 2 else ":memory:"  # ruff: ignore[magic-value-comparison]
-
-    logger.info(f"Using DuckDB {db_path}")
-
-    con = duckdb.connect(db_path)
-    cache = Cache()
-
-    logger.info(f"Caching in {cache.directory}")
+    args = parse_args()
 
-    server(con, cache)
+    if args.processes > 1:
+        run_processes(args)
+    else:
+        run(args)
 
 
 if __name__ == "__main__":
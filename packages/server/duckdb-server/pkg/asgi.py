@@ -0,0 +1,416 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+from typing import TYPE_CHECKING, Any
+from urllib.parse import parse_qs
+
+import ujson
+
+from pkg import core, metrics
+from pkg.compression import (
+    COMPRESS_THRESHOLD,
+    OFFLOAD_THRESHOLD,
+    compress,
+    negotiate,
+)
+from pkg.core import CORS_HEADERS, Handler, error_status, ingest_query
+from pkg.ingest import Upload
+from pkg.launch import create_service, split_resources
+from pkg.options import parse_args
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Awaitable, Callable, MutableMapping
+
+    from pkg.core import QueryService
+    from pkg.query import _QueryParams
+
+    Scope = MutableMapping[str, Any]
+    Message = MutableMapping[str, Any]
+    Receive = Callable[[], Awaitable[Message]]
+    Send = Callable[[Message], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+
+def _headers(content_type: str | None, encoding: str | None = None) -> list:
+    headers = [(name.lower().encode(), value.encode()) for name, value in CORS_HEADERS]
+    if content_type is not None:
+        headers.append((b"content-type", content_type.encode()))
+        headers.append((b"vary", b"Accept-Encoding"))
+    if encoding is not None:
+        headers.append((b"content-encoding", encoding.encode()))
+    return headers
+
+
+async def _respond(
+    send: Send, status: int, body: bytes | str, content_type: str | None = None
+) -> None:
+    data = body.encode() if isinstance(body, str) else body
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": _headers(content_type),
+        }
+    )
+    await send({"type": "http.response.body", "body": data})
+    metrics.BYTES_SENT.inc(len(data), transport="http")
+
+
+async def _read_body(receive: Receive) -> bytes:
+    parts = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            msg = "Client disconnected"
+            raise ConnectionError(msg)
+        parts.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(parts)
+
+
+async def _read_upload(receive: Receive, upload: Upload) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            upload.finish(ConnectionError("Upload aborted"))
+            return
+        upload.feed(message.get("body", b""))
+        if not message.get("more_body"):
+            upload.finish()
+            return
+
+
+class HTTPHandler(Handler):
+    """Answer an HTTP request, compressed with the `encoding` the client accepts.
+
+    The result is held until the query is done and then sent by `respond`, except
+    for streamed results, whose chunks go out as they arrive.
+    """
+
+    def __init__(self, send: Send, encoding: str | None = None) -> None:
+        self._send = send
+        self.encoding = encoding
+        self.status = 200
+        self.body: bytes | str = b""
+        self.content_type: str | None = None
+        self.started = False
+        self.streaming = False
+        self.failed = False
+
+    def done(self) -> None:
+        self.body = b""
+
+    def arrow(self, buffer: bytes) -> None:
+        self.body = buffer
+        self.content_type = "application/octet-stream"
+
+    async def arrow_stream(self, first: bytes, rest: AsyncIterator[bytes]) -> None:
+        # without a content length, the chunks go out with chunked transfer encoding
+        await self.start(200, "application/octet-stream")
+        self.streaming = True
+        await self.write(first, more=True)
+        async for chunk in rest:
+            await self.write(chunk, more=True)
+        await self.write(b"")
+        self.streaming = False
+
+    def json(self, data: str) -> None:
+        self.body = data
+        self.content_type = "application/json"
+
+    def error(self, error: object) -> None:
+        if self.streaming:
+            self.failed = True
+            return
+        self.status = error_status(error)
+        self.encoding = None
+        self.body = str(error)
+        self.content_type = "text/plain; charset=utf-8"
+
+    async def start(
+        self, status: int, content_type: str | None, encoding: str | None = None
+    ) -> None:
+        self.started = True
+        await self._send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": _headers(content_type, encoding),
+            }
+        )
+
+    async def write(self, body: bytes, more: bool = False) -> None:
+        await self._send(
+            {"type": "http.response.body", "body": body, "more_body": more}
+        )
+        metrics.BYTES_SENT.inc(len(body), transport="http")
+
+    async def respond(self) -> None:
+        if self.failed:
+            # the status line is already sent, so signal the error by closing
+            msg = "Error while streaming result"
+            raise RuntimeError(msg)
+        if self.started:
+            return
+        body = self.body.encode() if isinstance(self.body, str) else self.body
+        encoding = None
+        if self.encoding is not None and len(body) >= COMPRESS_THRESHOLD:
+            encoding = self.encoding
+            if len(body) < OFFLOAD_THRESHOLD:
+                body = compress(body, encoding)
+            else:
+                body = await asyncio.to_thread(compress, body, encoding)
+        await self.start(self.status, self.content_type, encoding)
+        await self.write(body)
+
+
+class SocketHandler(Handler):
+    """Collect the messages of a query, which `flush` then sends in order.
+
+    ASGI WebSockets cannot send a message in fragments, so a streamed result goes
+    out as a single message once all its chunks are there.
+    """
+
+    def __init__(self, client: SocketClient, uuid: str | None = None) -> None:
+        self.client = client
+        self.uuid = uuid
+        self.messages: list[Message] = []
+        # set while the messages go out, which cancelling cannot take back
+        self.sending = False
+
+    def done(self) -> None:
+        self.json("{}")
+
+    def arrow(self, buffer: bytes) -> None:
+        self.messages.append({"type": "websocket.send", "bytes": bytes(buffer)})
+
+    async def arrow_stream(self, first: bytes, rest: AsyncIterator[bytes]) -> None:
+        chunks = [first]
+        async for chunk in rest:
+            chunks.append(chunk)
+        self.arrow(b"".join(chunks))
+
+    def json(self, data: str) -> None:
+        self.messages.append({"type": "websocket.send", "text": data})
+
+    def error(self, error: object) -> None:
+        self.json(ujson.dumps({"error": str(error)}))
+
+    async def flush(self) -> None:
+        self.sending = True
+        try:
+            while self.messages and not self.client.closed:
+                message = self.messages.pop(0)
+                await self.client.send(message)
+                data = message.get("bytes") or message.get("text") or ""
+                metrics.BYTES_SENT.inc(len(data), transport="ws")
+        except OSError:
+            logger.debug("Dropping result for closed WebSocket")
+        finally:
+            self.sending = False
+
+
+class SocketClient(core.SocketClient):
+    """State of one WebSocket connection.
+
+    Queries of one socket run and send their results one at a time, like on the
+    socketify server. Sends wait while the connection's buffer is full, and with
+    them the socket's next query, so a slow client holds back its own queries.
+    """
+
+    def __init__(self, send: Send) -> None:
+        super().__init__()
+        self.send = send
+        # the queries and the tasks that answer them once they are cancelled
+        self.tasks: set[asyncio.Task[None]] = set()
+
+    def cancel_all(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+
+class ASGIApp:
+    """The server as an ASGI app, to run under uvicorn, hypercorn or in Starlette.
+
+    It speaks the same protocol as the socketify server: query messages over HTTP
+    GET and POST and over WebSockets, uploads to /ingest, and the /metrics,
+    /profiles and /preaggregates endpoints. Queries run on the thread pool of the
+    executor, so the event loop only passes messages on.
+    """
+
+    def __init__(self, service: QueryService) -> None:
+        self.service = service
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.websocket(receive, send)
+        elif scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    # warms the cache before the server accepts clients
+                    await self.service.start()
+                except Exception as e:
+                    logger.exception("Error starting the server")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.service.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        method = scope["method"]
+        path = scope["path"]
+        params = parse_qs(scope.get("query_string", b"").decode())
+        # HTTP requests from one address take turns with other clients
+        client = scope["client"][0] if scope.get("client") else None
+
+        if method == "OPTIONS":
+            await _respond(send, 200, b"")
+        elif path == "/" and method in {"GET", "POST"}:
+            try:
+                if method == "GET":
+                    message: str | bytes = params.get("query", [""])[0]
+                else:
+                    message = await _read_body(receive)
+                query: _QueryParams = ujson.loads(message)
+            except (ValueError, ConnectionError) as e:
+                logger.warning(f"Invalid query message: {e}")
+                await _respond(send, 400, f"Invalid query message: {e}")
+                return
+            headers = dict(scope.get("headers", []))
+            handler = HTTPHandler(
+                send, negotiate(headers.get(b"accept-encoding", b"").decode())
+            )
+            if query.get("compression"):
+                # the Arrow IPC bodies are compressed already
+                handler.encoding = None
+            await self.service.handle(handler, query, client)
+            await handler.respond()
+        elif path == "/ingest" and method == "POST":
+            query = ingest_query(
+                params.get("table", [None])[0], params.get("mode", [None])[0]
+            )
+            upload = Upload()
+            reading = asyncio.ensure_future(_read_upload(receive, upload))
+            handler = HTTPHandler(send)
+            try:
+                await self.service.handle(handler, query, client, upload)
+            finally:
+                reading.cancel()
+            await handler.respond()
+        elif path == "/metrics" and method == "GET":
+            await _respond(
+                send, 200, self.service.metrics(), "text/plain; version=0.0.4"
+            )
+        elif path == "/profiles" and method == "GET":
+            await _respond(send, 200, self.service.profiles(), "application/json")
+        elif path.startswith("/profiles/") and method == "GET":
+            profile_id = path.removeprefix("/profiles/")
+            profile = self.service.profile(profile_id)
+            if profile is None:
+                await _respond(send, 404, f"No profile {profile_id}")
+            else:
+                await _respond(send, 200, profile, "application/json")
+        elif path == "/preaggregates" and method == "GET":
+            await _respond(send, 200, self.service.preaggregates(), "application/json")
+        else:
+            await _respond(send, 404, f"No {method} {path}")
+
+    async def websocket(self, receive: Receive, send: Send) -> None:
+        client = SocketClient(send)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.connect":
+                    await send({"type": "websocket.accept"})
+                elif message["type"] == "websocket.receive":
+                    if message.get("bytes") is not None:
+                        client.receive(message["bytes"])
+                    else:
+                        self.receive(client, message.get("text") or "")
+                else:
+                    return
+        finally:
+            client.close()
+
+    def receive(self, client: SocketClient, message: str) -> None:
+        """Start answering a text message of a WebSocket."""
+        handler = SocketHandler(client)
+        query: _QueryParams | None = None
+        upload = None
+        try:
+            query = ujson.loads(message)
+        except Exception as e:
+            logger.exception("Error reading message from WebSocket")
+            handler.error(e)
+        else:
+            handler.uuid = query.get("uuid")
+            if query["type"] == "cancel":
+                client.cancel(handler.uuid)
+                return
+            if query["type"] == "ingest":
+                upload = client.start_upload()
+
+        task = asyncio.ensure_future(self.run(client, handler, query, upload))
+        if handler.uuid is not None:
+            client.queries[handler.uuid] = (task, handler)
+        # a query may be cancelled before it starts, so another task answers it
+        answer = asyncio.ensure_future(self.answer(client, handler, task))
+        for pending in (task, answer):
+            client.tasks.add(pending)
+            pending.add_done_callback(client.tasks.discard)
+
+    async def run(
+        self,
+        client: SocketClient,
+        handler: SocketHandler,
+        query: _QueryParams | None,
+        upload: Upload | None,
+    ) -> None:
+        async with client.lock:
+            if query is not None:
+                await self.service.handle(handler, query, client, upload)
+            await handler.flush()
+
+    async def answer(
+        self, client: SocketClient, handler: SocketHandler, task: asyncio.Task[None]
+    ) -> None:
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info(f"Cancelled query {handler.uuid}")
+            metrics.QUERIES_CANCELLED.inc()
+            if not client.closed:
+                # still answer, in order, since clients may match responses by order
+                handler.messages.clear()
+                handler.error("Query cancelled")
+                async with client.lock:
+                    await handler.flush()
+        finally:
+            if handler.uuid is not None:
+                client.queries.pop(handler.uuid, None)
+
+
+def create_app(argv: list[str] | None = None) -> ASGIApp:
+    """The app of a server process, with the options of the command line.
+
+    The options default to the DUCKDB_SERVER_* environment variables, which is
+    how to configure the app that `uvicorn --factory pkg.asgi:create_app` runs.
+    """
+    args = parse_args([] if argv is None else argv)
+    logging.basicConfig(stream=sys.stdout, level=args.log_level)
+    if args.processes > 1:
+        split_resources(args)
+    return ASGIApp(create_service(args))
@@ -0,0 +1,414 @@
+from __future__ import annotations
+
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any
+
+import pyarrow as pa
+from diskcache import UNKNOWN, Disk
+
+from pkg.sql import ANY_TABLE, EVERYTHING, GLOB_CHARACTERS
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from diskcache import Cache
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+# The key of the disk entry that marks a persisted result as reading a table. The
+# mark's tag is the table, so `Cache.evict` drops the marks of a written table, and
+# a result with a missing mark is outdated.
+DEPENDENCY_KEY = "{key}\0{table}"
+
+# Marks results compressed by `CompressedDisk`. Arrow IPC streams start with
+# 0xFFFFFFFF, so results stored without compression are told apart.
+COMPRESSED = b"MZ\x00"
+
+# kind of result (b"b" for bytes, b"s" for str), codec and uncompressed size
+COMPRESSED_HEADER = struct.Struct(">3sccQ")
+
+CODECS = {"lz4": b"l", "zstd": b"z"}
+CODEC_NAMES = {code: name for name, code in CODECS.items()}
+
+# Starts the line of a disk entry's tag that holds the state of the files it
+# read, after the lines of its tables. Table names do not start with a NUL.
+FILES_TAG = "\0files:"
+
+# The files a result read, as (file or glob pattern, ((path, mtime, size), ...)).
+FileState = tuple[tuple[str, tuple[tuple[str, int, int], ...]], ...]
+
+
+def file_state(sources: Iterable[str]) -> FileState:
+    """The modification time and size of the files of each file or glob pattern.
+
+    Rewriting, adding or removing a file changes the state.
+    """
+    state = []
+    for source in sorted(sources):
+        paths = (
+            sorted(glob.glob(source, recursive=True))
+            if GLOB_CHARACTERS.search(source)
+            else [source]
+        )
+        files = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, stat.st_mtime_ns, stat.st_size))
+        state.append((source, tuple(files)))
+    return tuple(state)
+
+
+def is_fresh(files: FileState) -> bool:
+    """Whether the files are still as they were when a result read them."""
+    return file_state(source for source, _ in files) == files
+
+
+def _make_tag(tables: frozenset[str], files: FileState) -> str:
+    lines = sorted(tables)
+    if files:
+        lines.append(FILES_TAG + json.dumps(files))
+    return "\n".join(lines)
+
+
+def _parse_tag(tag: str | None) -> tuple[frozenset[str], FileState]:
+    if not tag:
+        return EVERYTHING, ()
+    lines = tag.split("\n")
+    files: FileState = ()
+    if lines[-1].startswith(FILES_TAG):
+        files = tuple(
+            (source, tuple((path, mtime, size) for path, mtime, size in paths))
+            for source, paths in json.loads(lines.pop()[len(FILES_TAG) :])
+        )
+    return frozenset(lines) if lines else EVERYTHING, files
+
+
+class CompressedDisk(Disk):
+    """A `diskcache.Disk` that compresses results before writing them.
+
+    Pass `disk=CompressedDisk` and `disk_codec="lz4"`, `"zstd"` or `"none"` to the
+    `diskcache.Cache`. Results stored with another codec, or none, can still be read.
+    """
+
+    def __init__(self, directory: str, codec: str = "zstd", **kwargs: Any) -> None:
+        super().__init__(directory, **kwargs)
+        if codec != "none" and codec not in CODECS:
+            msg = f"Unsupported codec {codec!r}"
+            raise ValueError(msg)
+        # diskcache also sets this attribute when the cache's settings change
+        self.codec = codec
+
+    def store(self, value: Any, read: bool, key: Any = UNKNOWN) -> Any:
+        if self.codec in CODECS and not read and isinstance(value, str | bytes):
+            kind = b"s" if isinstance(value, str) else b"b"
+            data = value.encode("utf-8") if isinstance(value, str) else value
+            header = COMPRESSED_HEADER.pack(
+                COMPRESSED, kind, CODECS[self.codec], len(data)
+            )
+            value = header + pa.compress(data, self.codec, asbytes=True)
+        return super().store(value, read, key)
+
+    def fetch(self, mode: int, filename: str, value: Any, read: bool) -> Any:
+        value = super().fetch(mode, filename, value, read)
+        if not isinstance(value, bytes) or not value.startswith(COMPRESSED):
+            return value
+        _, kind, codec, size = COMPRESSED_HEADER.unpack_from(value)
+        data = pa.decompress(
+            memoryview(value)[COMPRESSED_HEADER.size :],
+            size,
+            CODEC_NAMES[codec],
+            asbytes=True,
+        )
+        return data.decode("utf-8") if kind == b"s" else data
+
+
+class ResultCache:
+    """Two-tier cache for query results.
+
+    All recent results are kept in an in-memory LRU bounded by their total size
+    in bytes. Results of persisted queries are also written to a `diskcache.Cache`,
+    which survives restarts and is consulted when the memory tier misses.
+
+    Each result records the tables it reads, so that `invalidate` can drop the
+    results that a write makes outdated.
+
+    Processes that share the disk tier pass the `shared_tables` that are the same
+    in all of them, such as the tables of a read-only database file. Results that
+    read other tables, which only exist in this process, are persisted under keys
+    of the process, and a table that a write changes is no longer shared.
+
+    Results may also record the state of the local files they read, and are
+    dropped when they are found to have changed, e.g. after a file was rewritten,
+    which checks the files on every hit.
+    """
+
+    def __init__(
+        self,
+        disk: Cache,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        shared_tables: Iterable[str] | None = None,
+    ) -> None:
+        self.disk = disk
+        self.memory_limit = memory_limit
+        self.shared_tables = None if shared_tables is None else frozenset(shared_tables)
+        # the prefix of the disk keys of results that are not shared, see `clear`
+        self._namespace = f"process-{os.getpid()}/"
+        self._clears = 0
+
+        self._entries: OrderedDict[str, str | bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        # the tables each result in memory reads, and the results reading each table
+        self._tables: dict[str, frozenset[str]] = {}
+        self._dependents: dict[str, set[str]] = {}
+        # the state of the files each result in memory read, if it read any
+        self._files: dict[str, FileState] = {}
+        # the results in memory that are on disk too
+        self._persisted: set[str] = set()
+        # changes on every write, see `set`
+        self.epoch = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    @property
+    def directory(self) -> str:
+        return self.disk.directory
+
+    @property
+    def size(self) -> int:
+        """The total size in bytes of the results in the memory tier."""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str, persist: bool = False) -> str | bytes | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                tables = self._tables[key]
+                files = self._files.get(key, ())
+                persisted = key in self._persisted
+        if value is not None:
+            if files and not is_fresh(files):
+                self._drop_stale(key)
+                return None
+            with self._lock:
+                self.memory_hits += 1
+            # the result may have been cached by a query that was not persisted
+            if persist and not persisted:
+                self._persist(key, value, tables, files)
+            return value
+
+        value, tables, files = self._read(key)
+        if value is not None and not self._shared(tables):
+            # another process's tables, or ones that changed since
+            value = None
+        if value is None and self.shared_tables is not None:
+            value, tables, files = self._read(self._namespace + key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if files and not is_fresh(files):
+            self._drop_stale(key)
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._put(key, value, tables, files)
+            if key in self._entries:
+                self._persisted.add(key)
+        return value
+
+    def set(
+        self,
+        key: str,
+        value: str | bytes,
+        persist: bool = False,
+        tables: Iterable[str] = EVERYTHING,
+        epoch: int | None = None,
+        files: FileState = (),
+    ) -> None:
+        """Cache the result of a query that reads the given tables and files.
+
+        A result computed while a write happened, that is, since the `epoch` it
+        started in, may be outdated and is not cached. The state of the `files`
+        should be taken before the query runs, so that changes while it runs
+        make the result stale.
+        """
+        tables = frozenset(tables)
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._put(key, value, tables, files)
+        if persist:
+            self._persist(key, value, tables, files)
+
+    def invalidate(self, tables: Iterable[str]) -> int:
+        """Drop the results that read any of the tables, and return their number.
+
+        Writing `ANY_TABLE` drops all results.
+        """
+        tables = frozenset(tables)
+        if not tables:
+            return 0
+        if ANY_TABLE in tables:
+            with self._lock:
+                count = len(self._entries)
+                self.epoch += 1
+                if self.shared_tables is not None:
+                    # the write may have changed what any name refers to
+                    self.shared_tables = frozenset()
+            self.clear()
+            with self._lock:
+                self.invalidations += count
+            return count
+
+        with self._lock:
+            self.epoch += 1
+            if self.shared_tables is not None:
+                self.shared_tables -= tables
+        # results whose tables are unknown may read any table
+        for table in (*tables, ANY_TABLE):
+            self.disk.evict(table)
+        keys: set[str] = set()
+        with self._lock:
+            for table in (*tables, ANY_TABLE):
+                keys |= self._dependents.get(table, set())
+            count = 0
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    count += 1
+            self.invalidations += count
+        return count
+
+    def _drop_stale(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self.stale += 1
+            self.misses += 1
+        self.disk.delete(key)
+        if self.shared_tables is not None:
+            self.disk.delete(self._namespace + key)
+
+    def clear(self) -> None:
+        """Drop all results, or only this process's if others share the disk."""
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self._dependents.clear()
+            self._files.clear()
+            self._persisted.clear()
+            self._size = 0
+            if self.shared_tables is not None:
+                # the results under the old keys are not read again, and the cull
+                # drops them in time like those of processes that have exited
+                self._clears += 1
+                self._namespace = f"process-{os.getpid()}-{self._clears}/"
+                return
+        self.disk.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale": self.stale,
+        }
+
+    def _persist(
+        self,
+        key: str,
+        value: str | bytes,
+        tables: frozenset[str],
+        files: FileState = (),
+    ) -> None:
+        disk_key = key if self._shared(tables) else self._namespace + key
+        # The marks go first: if a write evicts them before the result is written,
+        # the result has no marks and is not used.
+        for table in tables:
+            self.disk.set(
+                DEPENDENCY_KEY.format(key=disk_key, table=table), None, tag=table
+            )
+        self.disk.set(disk_key, value, tag=_make_tag(tables, files))
+        with self._lock:
+            if key in self._entries:
+                self._persisted.add(key)
+
+    def _read(self, disk_key: str) -> tuple[Any, frozenset[str], FileState]:
+        value, tag = self.disk.get(disk_key, tag=True)  # pyright: ignore[reportGeneralTypeIssues]
+        tables, files = _parse_tag(tag)
+        if value is not None and not all(
+            DEPENDENCY_KEY.format(key=disk_key, table=table) in self.disk
+            for table in tables
+        ):
+            # a table it reads was written since, or the cull dropped a mark
+            self.disk.delete(disk_key)
+            value = None
+        return value, tables, files
+
+    def _shared(self, tables: frozenset[str]) -> bool:
+        # whether the result is the same in all processes that share the disk
+        shared = self.shared_tables
+        return shared is None or (ANY_TABLE not in tables and tables <= shared)
+
+    def _put(
+        self,
+        key: str,
+        value: str | bytes,
+        tables: frozenset[str],
+        files: FileState = (),
+    ) -> None:
+        # Must be called with the lock held.
+        size = sys.getsizeof(value)
+        if size > self.memory_limit:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = value
+        self._size += size
+        self._tables[key] = tables
+        if files:
+            self._files[key] = files
+        for table in tables:
+            self._dependents.setdefault(table, set()).add(key)
+
+        while self._size > self.memory_limit:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        # Must be called with the lock held.
+        self._size -= sys.getsizeof(self._entries.pop(key))
+        self._files.pop(key, None)
+        self._persisted.discard(key)
+        for table in self._tables.pop(key):
+            dependents = self._dependents[table]
+            dependents.discard(key)
+            if not dependents:
+                del self._dependents[table]
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import gzip
+import zlib
+
+import pyarrow as pa
+
+# content codings the server can apply, in the order it prefers them
+CONTENT_ENCODINGS = ("zstd", "gzip", "deflate")
+
+# zlib's default, rather than the slow 9 of `gzip.compress`
+GZIP_LEVEL = 6
+
+# smaller bodies go out as they are, since compressing saves little of them
+COMPRESS_THRESHOLD = 1024
+
+# larger bodies are compressed on a thread rather than on the event loop
+OFFLOAD_THRESHOLD = 256 * 1024
+
+
+def negotiate(accept_encoding: str | None) -> str | None:
+    """The content coding for a response, given the request's Accept-Encoding."""
+    if not accept_encoding:
+        return None
+
+    weights: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, parameters = item.partition(";")
+        weight = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    best = None
+    best_weight = 0.0
+    for coding in CONTENT_ENCODINGS:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compress(body: bytes | str, coding: str) -> bytes:
+    """Encode a response body with a content coding from `CONTENT_ENCODINGS`."""
+    data = body.encode() if isinstance(body, str) else body
+    if coding == "zstd":
+        return pa.compress(data, "zstd", asbytes=True)
+    if coding == "gzip":
+        return gzip.compress(data, GZIP_LEVEL)
+    if coding == "deflate":
+        # HTTP's deflate is the zlib format
+        return zlib.compress(data)
+    msg = f"Unsupported content coding {coding!r}"
+    raise ValueError(msg)
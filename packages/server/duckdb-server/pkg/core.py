@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import aclosing
+from typing import TYPE_CHECKING, Any, Protocol
+
+import ujson
+
+from pkg import metrics
+from pkg.executor import QueryExecutor, ServerBusyError, WriteRefusedError
+from pkg.ingest import Upload
+from pkg.query import ResultTooLargeError, encode_batch
+from pkg.warm import keep_warm, warm_cache
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Hashable
+
+    from duckdb import DuckDBPyConnection as Con
+
+    from pkg.cache import ResultCache
+    from pkg.preagg import PreAggregates
+    from pkg.profiles import Profiler
+    from pkg.query import _QueryParams
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_THRESHOLD = 5000
+
+# headers of every HTTP response, so that browsers on other origins may query
+CORS_HEADERS = (
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Request-Method", "*"),
+    ("Access-Control-Allow-Methods", "OPTIONS, POST, GET"),
+    ("Access-Control-Allow-Headers", "*"),
+    ("Access-Control-Max-Age", "2592000"),
+)
+
+# HTTP status of the errors of queries that the server refused to run to the end
+ERROR_STATUS = {
+    ServerBusyError: 503,
+    TimeoutError: 504,
+    ResultTooLargeError: 413,
+    WriteRefusedError: 403,
+}
+
+
+def error_status(error: object) -> int:
+    """The HTTP status of a query's error."""
+    for kind, status in ERROR_STATUS.items():
+        if isinstance(error, kind):
+            return status
+    return 500
+
+
+class Handler(Protocol):
+    def done(self) -> None: ...
+    def arrow(self, buffer: bytes) -> None: ...
+    async def arrow_stream(self, first: bytes, rest: AsyncIterator[bytes]) -> None: ...
+    def json(self, data: Any) -> None: ...
+    def error(self, error: Any) -> None: ...
+
+
+class Sending(Protocol):
+    # set while the result goes out, which cancelling cannot take back
+    sending: bool
+
+
+class SocketClient:
+    """State of one WebSocket connection that does not depend on the server.
+
+    The client matches responses to requests by order, so queries from one socket
+    run one at a time under `lock`, while other sockets are served in parallel.
+    Binary messages are the upload of the last ingest command.
+    """
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.closed = False
+        # queued and running queries by uuid, so that the client can cancel them
+        self.queries: dict[str, tuple[asyncio.Task[None], Sending]] = {}
+        # the upload of the last ingest command, until an empty binary message ends it
+        self.upload: Upload | None = None
+
+    def start_upload(self) -> Upload:
+        """Take the binary messages that follow as the upload of an ingest command."""
+        if self.upload is not None:
+            # the previous upload never ended, so its ingest would wait for it forever
+            self.upload.finish(ConnectionError("Upload ended by the next ingest"))
+        self.upload = Upload()
+        return self.upload
+
+    def receive(self, chunk: bytes) -> None:
+        """Pass a binary message on to the upload of the last ingest command."""
+        if self.upload is None:
+            logger.warning("Binary message without an ingest command")
+            return
+        if chunk:
+            self.upload.feed(chunk)
+        else:
+            self.upload.finish()
+            self.upload = None
+
+    def cancel(self, uuid: str | None) -> None:
+        if uuid not in self.queries:
+            logger.debug(f"No query {uuid} to cancel")
+            return
+        task, handler = self.queries[uuid]
+        if handler.sending:
+            logger.debug(f"Query {uuid} is already being sent")
+            return
+        task.cancel()
+
+    def cancel_all(self) -> None:
+        for task, _ in self.queries.values():
+            task.cancel()
+
+    def close(self) -> None:
+        self.closed = True
+        if self.upload is not None:
+            self.upload.finish(ConnectionError("WebSocket closed during upload"))
+        # nobody is waiting for the results anymore
+        self.cancel_all()
+
+
+async def handle_query(
+    handler: Handler,
+    executor: QueryExecutor,
+    query: _QueryParams,
+    stream: bool = False,
+    client: Hashable = None,
+    upload: Upload | None = None,
+    writes: bool = True,
+) -> None:
+    logger.debug(f"{query=}")
+
+    start = time.time()
+
+    sql = query.get("sql", "")
+    command = query["type"]
+    label = metrics.command_label(command)
+
+    metrics.QUERIES_IN_FLIGHT.inc()
+    try:
+        if command == "batch":
+            queries = query.get("queries")
+            if not isinstance(queries, list):
+                msg = "A batch needs a list of queries"
+                raise TypeError(msg)
+            sql = "\n".join(q.get("sql", "") for q in queries)
+            results = await executor.submit_batch(queries, client, writes)
+            # the results go out as one binary message, like arrow results
+            handler.arrow(encode_batch(queries, results))
+        elif command == "ingest":
+            if upload is None:
+                msg = "An ingest command needs an upload"
+                raise ValueError(msg)
+            rows = await executor.ingest(query, upload, client, writes)
+            handler.json(ujson.dumps({"rows": rows}))
+        elif command == "arrow" and stream:
+            async with aclosing(executor.stream(query, client)) as chunks:
+                # wait for the first chunk so that query errors are reported normally
+                first = await anext(chunks)
+                await handler.arrow_stream(first, chunks)
+        else:
+            result = await executor.submit(query, client, writes)
+            if command == "exec":
+                handler.done()
+            elif command == "arrow":
+                handler.arrow(result)  # pyright: ignore[reportArgumentType]
+            else:
+                handler.json(result)
+    except Exception as e:
+        if isinstance(e, tuple(ERROR_STATUS)):
+            # the error says what happened, a traceback would not add to it
+            logger.warning(f"Refused query: {e}")
+        else:
+            logger.exception("Error processing query")
+        metrics.QUERY_ERRORS.inc(command=label)
+        handler.error(e)
+    finally:
+        metrics.QUERIES_IN_FLIGHT.dec()
+
+    elapsed = time.time() - start
+    metrics.QUERY_DURATION.observe(elapsed, command=label)
+
+    total = round(elapsed * 1_000)
+    if total > SLOW_QUERY_THRESHOLD:
+        logger.warning(f"DONE. Slow query took {total} ms.\n{sql}")
+    else:
+        # see /metrics for latencies, logging every query is costly
+        logger.debug(f"DONE. Query took {total} ms.\n{sql}")
+
+
+def ingest_query(table: str | None, mode: str | None) -> _QueryParams:
+    """The ingest command of an upload to the /ingest endpoint."""
+    return {
+        "type": "ingest",
+        "sql": "",
+        "uuid": "",
+        "table": table,  # pyright: ignore[reportAssignmentType]
+        "mode": mode or "create",  # pyright: ignore[reportAssignmentType]
+    }
+
+
+class QueryService:
+    """What the server does, independent of the transport that clients use.
+
+    The socketify server and the ASGI app both pass the messages of their clients
+    to `handle`, with a `Handler` that sends the results back.
+
+    With `sticky_writes`, only WebSocket clients may write. The server then runs
+    in several processes, and while a WebSocket stays with one process, the next
+    HTTP request of a client may reach another one, which does not see the write.
+    """
+
+    def __init__(
+        self,
+        con: Con,
+        cache: ResultCache,
+        workers: int | None = None,
+        stream: bool = False,
+        profiler: Profiler | None = None,
+        preaggs: PreAggregates | None = None,
+        warm: list[_QueryParams] | None = None,
+        warm_interval: float | None = None,
+        timeouts: dict[str, float] | None = None,
+        max_queued: int | None = None,
+        max_result_size: int | None = None,
+        sticky_writes: bool = False,
+    ) -> None:
+        self.executor = QueryExecutor(
+            con,
+            cache,
+            workers,
+            profiler,
+            preaggs,
+            timeouts=timeouts,
+            max_queued=max_queued,
+            max_result_size=max_result_size,
+        )
+        self.stream = stream
+        self.sticky_writes = sticky_writes
+        self.warm = warm
+        self.warm_interval = warm_interval
+        self.background: set[asyncio.Task[None]] = set()
+        metrics.collect_from(cache, self.executor)
+
+    async def start(self) -> None:
+        """Warm the cache, before the server accepts clients."""
+        if self.warm:
+            await warm_cache(self.executor, self.warm)
+            if self.warm_interval:
+                task = asyncio.ensure_future(
+                    keep_warm(self.executor, self.warm, self.warm_interval)
+                )
+                self.background.add(task)
+
+    async def handle(
+        self,
+        handler: Handler,
+        query: _QueryParams,
+        client: Hashable = None,
+        upload: Upload | None = None,
+    ) -> None:
+        writes = not self.sticky_writes or isinstance(client, SocketClient)
+        await handle_query(
+            handler, self.executor, query, self.stream, client, upload, writes
+        )
+
+    def metrics(self) -> str:
+        return metrics.REGISTRY.render()
+
+    def profiles(self) -> str:
+        return ujson.dumps(self.executor.profiler.list())
+
+    def profile(self, profile_id: str | None) -> str | None:
+        profile = (
+            self.executor.profiler.get(int(profile_id))
+            if profile_id is not None and profile_id.isdigit()
+            else None
+        )
+        return None if profile is None else ujson.dumps(profile)
+
+    def preaggregates(self) -> str:
+        return ujson.dumps(self.executor.preaggs.list())
+
+    def shutdown(self) -> None:
+        for task in self.background:
+            task.cancel()
+        self.executor.shutdown()
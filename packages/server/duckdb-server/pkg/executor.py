@@ -0,0 +1,557 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from enum import IntEnum
+from functools import partial
+from typing import TYPE_CHECKING, Any
+
+import duckdb
+
+from pkg.ingest import ingest_arrow
+from pkg.preagg import PreAggregates
+from pkg.profiles import Profiler
+from pkg.query import ResultTooLargeError, get_query_key, run_query, stream_arrow
+from pkg.session import Session
+from pkg.sql import written_tables
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Hashable
+
+    from pkg.cache import ResultCache
+    from pkg.ingest import Upload
+    from pkg.query import _QueryParams
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 10
+
+# commands that write, which run after the queries of the same priority by default
+WRITE_COMMANDS = frozenset(("exec", "ingest"))
+
+# number of encoded record batches a worker may run ahead of the socket
+STREAM_BUFFER = 2
+
+# times in a row that the waiting queries of a priority may be passed over for
+# more urgent ones, before one of them runs
+MAX_BYPASSES = 16
+
+# commands that may have their own timeout, see `QueryExecutor.get_timeout`
+TIMEOUT_COMMANDS = frozenset(("arrow", "json", "exec", "ingest"))
+
+# the key of the timeout of all other commands
+ALL_COMMANDS = "*"
+
+
+class ServerBusyError(RuntimeError):
+    """Too many queries are waiting for a worker to queue another one."""
+
+
+class WriteRefusedError(RuntimeError):
+    """A command would write, which the client may not do on this transport."""
+
+
+class Priority(IntEnum):
+    """Query priorities, as in Mosaic's coordinator. Lower values run first."""
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+def get_priority(query: _QueryParams) -> int:
+    """The priority of a query, where writes default to low priority.
+
+    Priorities outside of `Priority` are clamped to it.
+    """
+    priority = query.get("priority")
+    if priority is None:
+        return Priority.LOW if query["type"] in WRITE_COMMANDS else Priority.NORMAL
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        msg = f"Invalid priority {priority!r}"
+        raise TypeError(msg)
+    return min(max(priority, Priority.HIGH), Priority.LOW)
+
+
+class Scheduler:
+    """Hand out worker slots to waiting queries.
+
+    The queries with the lowest priority value go first, but a priority whose
+    queries were passed over `MAX_BYPASSES` times in a row gets the next slot, so
+    low priority queries do not starve while more urgent ones keep arriving.
+    Within a priority, the clients take turns, so a client with many queued
+    queries does not hold up the others.
+    """
+
+    def __init__(self, slots: int, max_queued: int | None = None) -> None:
+        self.free = slots
+        # per priority, the waiting queries of each client in the order they arrived
+        self.waiting: dict[int, OrderedDict[Hashable, deque[asyncio.Future[None]]]] = {}
+        # queries beyond this many waiting ones are rejected rather than queued
+        self.max_queued = max_queued
+        self.queued = 0
+        self.rejected = 0
+        # per priority, the slots that went to more urgent queries since it had one
+        self.bypassed: dict[int, int] = {}
+
+    async def acquire(self, priority: int, client: Hashable = None) -> None:
+        if self.free > 0 and not self.waiting:
+            self.free -= 1
+            return
+        if self.max_queued is not None and self.queued >= self.max_queued:
+            self.rejected += 1
+            msg = f"The server is busy with {self.queued} waiting queries, try again later"
+            raise ServerBusyError(msg)
+
+        future = asyncio.get_running_loop().create_future()
+        clients = self.waiting.setdefault(priority, OrderedDict())
+        clients.setdefault(client, deque()).append(future)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation
+                self.release()
+            else:
+                self._remove(priority, client, future)
+            raise
+
+    def _remove(
+        self, priority: int, client: Hashable, future: asyncio.Future[None]
+    ) -> None:
+        clients = self.waiting[priority]
+        clients[client].remove(future)
+        self.queued -= 1
+        if not clients[client]:
+            del clients[client]
+        if not clients:
+            del self.waiting[priority]
+            self.bypassed.pop(priority, None)
+
+    def release(self) -> None:
+        if not self.waiting:
+            self.free += 1
+            return
+
+        priority = self._next_priority()
+        clients = self.waiting[priority]
+        client, futures = next(iter(clients.items()))
+        future = futures.popleft()
+        self.queued -= 1
+        if futures:
+            # the client's next query waits for the other clients' turns
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+        if not clients:
+            del self.waiting[priority]
+            self.bypassed.pop(priority, None)
+        future.set_result(None)
+
+    def _next_priority(self) -> int:
+        priorities = sorted(self.waiting)
+        starving = [p for p in priorities if self.bypassed.get(p, 0) >= MAX_BYPASSES]
+        priority = starving[0] if starving else priorities[0]
+        self.bypassed[priority] = 0
+        for other in priorities:
+            if other > priority:
+                self.bypassed[other] = self.bypassed.get(other, 0) + 1
+        return priority
+
+
+class _Job:
+    """A query on the pool and the number of requests waiting for its result."""
+
+    def __init__(
+        self,
+        priority: int = Priority.NORMAL,
+        source: Upload | None = None,
+        writes: bool = True,
+    ) -> None:
+        self.priority = priority
+        # whether an exec command may write, see `QueryExecutor.submit`
+        self.writes = writes
+        # the upload an ingest command reads, which an interrupt does not wake up
+        self.source = source
+        self.future: asyncio.Future[bytes | str | None] | None = None
+        self.cursor: duckdb.DuckDBPyConnection | None = None
+        self.cancelled = False
+        self.waiters = 0
+        # seconds the query may run, and whether it ran out of them
+        self.timeout: float | None = None
+        self.timed_out = False
+
+    def start(self, cursor: duckdb.DuckDBPyConnection) -> None:
+        """Attach the cursor that runs the query. Called on a worker thread."""
+        self.cursor = cursor
+        # an interrupt that arrives before DuckDB starts the query is lost
+        if self.cancelled or self.timed_out:
+            msg = "Query cancelled"
+            raise duckdb.InterruptException(msg)
+
+    def start_timer(self, timeout: float | None) -> asyncio.TimerHandle | None:
+        """Interrupt the query once it has run for `timeout` seconds."""
+        if timeout is None:
+            return None
+        self.timeout = timeout
+        return asyncio.get_running_loop().call_later(timeout, self.time_out)
+
+    def time_out(self) -> None:
+        self.timed_out = True
+        if self.source is not None:
+            self.source.finish(self.timeout_error())
+        if self.cursor is not None:
+            with suppress(duckdb.Error):
+                self.cursor.interrupt()
+
+    def timeout_error(self) -> TimeoutError:
+        return TimeoutError(f"Query timed out after {self.timeout:g} seconds")
+
+    def cancel(self) -> None:
+        """Drop the query if it is still queued, or interrupt it if it is running."""
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+        if self.source is not None:
+            self.source.finish(ConnectionError("Upload cancelled"))
+        if self.cursor is not None:
+            # the cursor may already be closed if the query just finished
+            with suppress(duckdb.Error):
+                self.cursor.interrupt()
+
+
+class QueryExecutor:
+    """Run queries on a pool of worker threads.
+
+    Each query runs on its own cursor of the shared DuckDB connection, so the
+    event loop stays responsive and queries from different clients execute in
+    parallel. The `Session` keeps settings and temporary objects across cursors.
+    When all workers are busy, queries wait in the `Scheduler`, unless `max_queued`
+    queries wait already.
+
+    Queries are interrupted after the `timeouts` of their command (by command,
+    with `ALL_COMMANDS` for the others), and arrow and json results above
+    `max_result_size` bytes fail instead of being kept in memory.
+    """
+
+    def __init__(
+        self,
+        con: duckdb.DuckDBPyConnection,
+        cache: ResultCache,
+        workers: int | None = None,
+        profiler: Profiler | None = None,
+        preaggs: PreAggregates | None = None,
+        timeouts: dict[str, float] | None = None,
+        max_queued: int | None = None,
+        max_result_size: int | None = None,
+    ) -> None:
+        self.con = con
+        self.session = Session(con)
+        self.cache = cache
+        self.workers = workers or DEFAULT_WORKERS
+        self.profiler = profiler or Profiler()
+        self.preaggs = preaggs or PreAggregates()
+        self.timeouts = timeouts or {}
+        self.max_result_size = max_result_size
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="duckdb-server"
+        )
+        self.scheduler = Scheduler(self.workers, max_queued)
+
+        # identical queries that are already running, see `submit`
+        self.inflight: dict[tuple[str, bool, int], _Job] = {}
+        self.coalesced = 0
+        self.timed_out = 0
+        self.too_large = 0
+
+        logger.info(f"Executing queries on {self.workers} workers")
+
+    def get_timeout(self, query: _QueryParams) -> float | None:
+        """The seconds a query may run, if it has a timeout."""
+        return self.timeouts.get(query["type"], self.timeouts.get(ALL_COMMANDS))
+
+    def execute(
+        self, query: _QueryParams, job: _Job | None = None
+    ) -> bytes | str | None:
+        """Run a query on a fresh cursor. Called on a worker thread."""
+        with self.session.cursor(query["sql"]) as cursor:
+            if job is not None:
+                job.start(cursor)
+            # the profile is taken before the bookkeeping of pre-aggregated tables
+            # runs other statements on the cursor
+            if query["type"] == "exec":
+                if job is not None and not job.writes:
+                    self._refuse_writes(cursor, query["sql"])
+                with (
+                    self.preaggs.track(cursor, query["sql"]),
+                    self.profiler.capture(cursor, query),
+                ):
+                    return run_query(cursor, self.cache, query)
+            self.preaggs.use(cursor, query["sql"])
+            try:
+                with self.profiler.capture(cursor, query):
+                    return self._run_query(cursor, query)
+            except duckdb.CatalogException:
+                # a table it reads may have been dropped to stay in budget since
+                if not self.preaggs.use(cursor, query["sql"]):
+                    raise
+                with self.profiler.capture(cursor, query):
+                    return self._run_query(cursor, query)
+
+    def _refuse_writes(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> None:
+        # pre-aggregated tables are local even if this process has them already
+        if written_tables(cursor, sql) or self.preaggs.created_tables(sql):
+            msg = (
+                "With several server processes, commands that write must be sent "
+                "over a WebSocket, whose queries all reach the same process"
+            )
+            raise WriteRefusedError(msg)
+
+    def _run_query(
+        self, cursor: duckdb.DuckDBPyConnection, query: _QueryParams
+    ) -> bytes | str | None:
+        try:
+            return run_query(cursor, self.cache, query, self.max_result_size)
+        except ResultTooLargeError:
+            self.too_large += 1
+            raise
+
+    async def run(
+        self, query: _QueryParams, job: _Job, client: Hashable = None
+    ) -> bytes | str | None:
+        """Wait for a worker and run the query on it."""
+        await self.scheduler.acquire(job.priority, client)
+        timer = job.start_timer(self.get_timeout(query))
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.pool, self.execute, query, job)
+        # a cancelled query keeps its worker until the worker gets to the interrupt
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.shield(future)
+        except duckdb.InterruptException:
+            if not job.timed_out:
+                raise
+            self.timed_out += 1
+            raise job.timeout_error() from None
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _release(self, future: asyncio.Future[Any]) -> None:
+        self.scheduler.release()
+        # nobody retrieves the error of a query whose waiter was cancelled
+        if not future.cancelled():
+            future.exception()
+
+    async def submit(
+        self, query: _QueryParams, client: Hashable = None, writes: bool = True
+    ) -> bytes | str | None:
+        """Run a query on the pool and wait for the result without blocking the loop.
+
+        Queries are scheduled by priority, taking turns between clients. Concurrent
+        requests for the same arrow or json query share a single execution and
+        receive the same result buffer. Cancelling the waiting task drops the query
+        from the queue or interrupts it once no other request is waiting for its
+        result. Exec commands that only create pre-aggregated tables are shared the
+        same way, and skipped once the tables exist.
+
+        Unless `writes`, exec commands that would write fail with a
+        `WriteRefusedError`, e.g. for clients whose next queries may reach another
+        server process, which does not see the write.
+        """
+        priority = get_priority(query)
+
+        idempotent = (
+            query["type"] == "exec"
+            and writes
+            and "params" not in query
+            and bool(self.preaggs.created_tables(query["sql"]))
+        )
+        if idempotent and self.preaggs.exists(query["sql"]):
+            logger.debug("Skipping exec of existing pre-aggregated tables")
+            return None
+
+        key = None
+        job = None
+        if query["type"] != "exec" or idempotent:
+            # Persisted queries must not join one that skips the disk cache, and
+            # queries after a write must not join one that started before it.
+            key = (get_query_key(query), query.get("persist", False), self.cache.epoch)
+            job = self.inflight.get(key)
+            # do not wait behind a less urgent copy of the query that has not started
+            if job is not None and job.priority > priority and job.cursor is None:
+                job = None
+
+        if job is None:
+            job = _Job(priority, writes=writes)
+            job.future = asyncio.ensure_future(self.run(query, job, client))
+            if key is not None:
+                self.inflight[key] = job
+                job.future.add_done_callback(partial(self._finished, key, job))
+        else:
+            logger.debug("Joining in-flight query")
+            self.coalesced += 1
+
+        job.waiters += 1
+        try:
+            # one waiter going away must not cancel the query for the others
+            return await asyncio.shield(job.future)  # pyright: ignore[reportArgumentType]
+        except asyncio.CancelledError:
+            if job.waiters == 1:
+                logger.info("Cancelling query")
+                job.cancel()
+            raise
+        finally:
+            job.waiters -= 1
+
+    def _finished(self, key: tuple[str, bool, int], job: _Job, _: object) -> None:
+        # a more urgent copy of the query may have taken its place
+        if self.inflight.get(key) is job:
+            del self.inflight[key]
+
+    async def submit_batch(
+        self, queries: list[_QueryParams], client: Hashable = None, writes: bool = True
+    ) -> list[bytes | str | BaseException | None]:
+        """Run the queries of a batch and return their results or errors in order.
+
+        Queries run in parallel, except that an exec command waits for the queries
+        before it and the queries after it wait for the exec command.
+        """
+        results: list[bytes | str | BaseException | None] = []
+        group: list[_QueryParams] = []
+        for query in queries:
+            if query["type"] == "exec":
+                results += await self._gather(group, client, writes)
+                results += await self._gather([query], client, writes)
+                group = []
+            else:
+                group.append(query)
+        results += await self._gather(group, client, writes)
+        return results
+
+    async def _gather(
+        self, queries: list[_QueryParams], client: Hashable, writes: bool
+    ) -> list[bytes | str | BaseException | None]:
+        return await asyncio.gather(
+            *(self.submit(query, client, writes) for query in queries),
+            return_exceptions=True,
+        )
+
+    async def stream(
+        self, query: _QueryParams, client: Hashable = None
+    ) -> AsyncIterator[bytes]:
+        """Run an arrow query on the pool and yield IPC chunks as they are encoded.
+
+        The worker pauses once it is `STREAM_BUFFER` chunks ahead of the consumer
+        and stops early, interrupting the query, if the consumer goes away.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[bytes | BaseException | None] = asyncio.Queue()
+        slots = threading.Semaphore(STREAM_BUFFER)
+        stopped = threading.Event()
+        job = _Job()
+
+        def send(cursor: duckdb.DuckDBPyConnection) -> None:
+            with self.profiler.capture(cursor, query):
+                for chunk in stream_arrow(cursor, self.cache, query):
+                    slots.acquire()
+                    if stopped.is_set():
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+
+        def produce() -> None:
+            try:
+                with self.session.cursor(query["sql"]) as cursor:
+                    job.start(cursor)
+                    self.preaggs.use(cursor, query["sql"])
+                    try:
+                        send(cursor)
+                    except duckdb.CatalogException:
+                        # like in `execute`, the error comes before the first chunk
+                        if not self.preaggs.use(cursor, query["sql"]):
+                            raise
+                        send(cursor)
+            except Exception as e:  # ruff: ignore[blind-except]
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        await self.scheduler.acquire(get_priority(query), client)
+        timer = job.start_timer(self.get_timeout(query))
+        future = loop.run_in_executor(self.pool, produce)
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, duckdb.InterruptException) and job.timed_out:
+                    self.timed_out += 1
+                    raise job.timeout_error()
+                if isinstance(item, BaseException):
+                    raise item
+                slots.release()
+                yield item
+        finally:
+            if timer is not None:
+                timer.cancel()
+            stopped.set()
+            if not future.done():
+                job.cancel()
+            slots.release()
+            try:
+                await future
+            finally:
+                self.scheduler.release()
+
+    async def ingest(
+        self,
+        query: _QueryParams,
+        source: Upload,
+        client: Hashable = None,
+        writes: bool = True,
+    ) -> int:
+        """Write an uploaded Arrow IPC stream to a table on the pool.
+
+        The worker reads the upload while it arrives, see `ingest_arrow`. Unless
+        `writes`, it fails with a `WriteRefusedError` like `submit`.
+        """
+        if not writes:
+            source.close()
+            msg = (
+                "With several server processes, uploads must be sent over a "
+                "WebSocket, whose queries all reach the same process"
+            )
+            raise WriteRefusedError(msg)
+        job = _Job(get_priority(query), source)
+
+        def load() -> int:
+            with self.session.cursor(query.get("table") or "") as cursor:
+                job.start(cursor)
+                return ingest_arrow(cursor, self.cache, query, source)
+
+        await self.scheduler.acquire(job.priority, client)
+        timer = job.start_timer(self.get_timeout(query))
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.pool, load)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        except Exception:
+            # the read of the upload or DuckDB fails, whichever the timeout hit
+            if not job.timed_out:
+                raise
+            self.timed_out += 1
+            raise job.timeout_error() from None
+        finally:
+            if timer is not None:
+                timer.cancel()
+            # also wakes up the worker if it still waits for the upload
+            source.close()
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import io
+import logging
+import threading
+from collections import deque
+from typing import TYPE_CHECKING
+
+import pyarrow as pa
+
+from pkg.sql import quote, written_tables
+
+if TYPE_CHECKING:
+    import duckdb
+
+    from pkg.cache import ResultCache
+    from pkg.query import _QueryParams
+
+logger = logging.getLogger(__name__)
+
+# how an ingest command writes the uploaded rows to its table
+INGEST_STATEMENTS = {
+    "create": "CREATE TABLE {table} AS FROM {source}",
+    "replace": "CREATE OR REPLACE TABLE {table} AS FROM {source}",
+    "append": "INSERT INTO {table} BY NAME FROM {source}",
+}
+
+# the name under which the statement reads the uploaded record batches
+SOURCE = "__ingest_source"
+
+
+class Upload(io.RawIOBase):
+    """The body of an upload, written on the event loop and read by a worker.
+
+    Reads block until the bytes they ask for have arrived, so the worker writes
+    record batches to DuckDB while the rest of the upload is still on its way, and
+    only the bytes it has not read yet are held in memory.
+    """
+
+    def __init__(self) -> None:
+        self._chunks: deque[memoryview] = deque()
+        self._finished = False
+        self._error: BaseException | None = None
+        self._changed = threading.Condition()
+
+    def readable(self) -> bool:
+        return True
+
+    def feed(self, chunk: bytes) -> None:
+        """Add the next bytes of the upload."""
+        with self._changed:
+            # nobody reads the rest of a failed or finished upload
+            if chunk and not self._finished:
+                self._chunks.append(memoryview(chunk))
+                self._changed.notify()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        """End the upload, with the error if it broke off."""
+        with self._changed:
+            self._finished = True
+            self._error = error
+            self._changed.notify_all()
+
+    def close(self) -> None:
+        """Drop what was not read, and fail reads that wait for more."""
+        with self._changed:
+            if not self._finished:
+                self._error = ConnectionError("Upload closed")
+            self._finished = True
+            self._chunks.clear()
+            self._changed.notify_all()
+        super().close()
+
+    def read(self, size: int | None = -1) -> bytes:
+        parts: list[memoryview] = []
+        wanted = -1 if size is None else size
+        with self._changed:
+            while wanted != 0:
+                while not self._chunks and not self._finished:
+                    self._changed.wait()
+                if self._error is not None:
+                    raise self._error
+                if not self._chunks:
+                    break
+                chunk = self._chunks.popleft()
+                if 0 < wanted < len(chunk):
+                    self._chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                parts.append(chunk)
+                if wanted > 0:
+                    wanted -= len(chunk)
+        return b"".join(parts)
+
+
+def ingest_arrow(
+    con: duckdb.DuckDBPyConnection,
+    cache: ResultCache,
+    query: _QueryParams,
+    source: io.RawIOBase,
+) -> int:
+    """Write an Arrow IPC stream to a table as its record batches arrive.
+
+    Returns the number of rows written.
+    """
+    table = query.get("table")
+    if not isinstance(table, str) or not table:
+        msg = "An ingest command needs a table"
+        raise ValueError(msg)
+    mode = query.get("mode", "create")
+    if mode not in INGEST_STATEMENTS:
+        msg = f"Unsupported ingest mode {mode!r}"
+        raise ValueError(msg)
+
+    sql = INGEST_STATEMENTS[mode].format(table=quote(*table.split(".")), source=SOURCE)
+    # reads the schema, which is the first message of the stream
+    reader = pa.ipc.open_stream(source)
+    con.register(SOURCE, reader)
+    try:
+        row = con.execute(sql).fetchone()
+    finally:
+        con.unregister(SOURCE)
+        cache.invalidate(written_tables(con, sql))
+    rows = row[0] if row else 0
+    logger.info(f"Ingested {rows} rows into {table}")
+    return rows
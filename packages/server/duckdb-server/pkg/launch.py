@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import duckdb
+from diskcache import Cache
+
+from pkg.cache import CompressedDisk, ResultCache
+from pkg.core import QueryService
+from pkg.preagg import PreAggregates
+from pkg.profiles import Profiler
+from pkg.server import server
+from pkg.sql import quote
+from pkg.warm import load_workload
+
+if TYPE_CHECKING:
+    import argparse
+
+logger = logging.getLogger(__name__)
+
+
+def connect_read_only(
+    database: str, config: dict[str, str | int]
+) -> duckdb.DuckDBPyConnection:
+    """Open a database file read-only, next to an in-memory database for writes.
+
+    The tables and views of the file are available under their usual names. Other
+    writes, such as Mosaic's pre-aggregated tables, go to the in-memory database,
+    so they only exist in this process.
+    """
+    con = duckdb.connect(config=config)
+    alias = Path(database).stem
+    escaped = database.replace("'", "''")
+    con.execute(f"ATTACH '{escaped}' AS {quote(alias)} (READ_ONLY)")
+
+    # views in the default database make the file's tables visible to all cursors,
+    # unlike a search path, which only applies to a single connection
+    for schema, name in file_relations(con, alias):
+        con.execute(f"CREATE SCHEMA IF NOT EXISTS {quote(schema)}")
+        con.execute(
+            f"CREATE VIEW {quote(schema, name)} AS FROM {quote(alias, schema, name)}"
+        )
+    return con
+
+
+def file_relations(con: duckdb.DuckDBPyConnection, alias: str) -> list[tuple[str, str]]:
+    """The schemas and names of the tables and views of an attached database."""
+    return con.execute(
+        """
+        SELECT schema_name, table_name FROM duckdb_tables() WHERE database_name = ?
+        UNION ALL
+        SELECT schema_name, view_name FROM duckdb_views()
+        WHERE database_name = ? AND NOT internal
+        """,
+        [alias, alias],
+    ).fetchall()
+
+
+def create_service(args: argparse.Namespace) -> QueryService:
+    """Open the database and cache of a server process."""
+    logger.info(f"Using DuckDB {args.database}")
+
+    config: dict[str, str | int] = {}
+    if args.threads is not None:
+        config["threads"] = args.threads
+    if args.memory_limit is not None:
+        config["memory_limit"] = args.memory_limit
+
+    # With several processes, only the results of the file's tables are the same
+    # in all of them, and the other results are persisted for this process only.
+    shared = None
+    if args.processes > 1 and args.database != ":memory:":
+        con = connect_read_only(args.database, config)
+        alias = Path(args.database).stem
+        shared = frozenset(name.lower() for _, name in file_relations(con, alias))
+    else:
+        con = duckdb.connect(args.database, config=config)
+        if args.processes > 1:
+            shared = frozenset()
+    cache = ResultCache(
+        Cache(
+            args.cache_dir,
+            size_limit=args.cache_size,
+            disk=CompressedDisk,
+            disk_codec=args.cache_compression,
+            # invalidation evicts the results of a table by their tags
+            tag_index=True,
+        ),
+        memory_limit=args.memory_cache_size,
+        shared_tables=shared,
+    )
+
+    logger.info(f"Caching in {cache.directory}")
+
+    profiler = Profiler(args.profile_threshold, args.profile_sample)
+    preaggs = PreAggregates(args.preagg_schema, args.preagg_budget)
+    warm = load_workload(args.warm) if args.warm else None
+
+    return QueryService(
+        con,
+        cache,
+        workers=args.workers,
+        stream=args.stream,
+        profiler=profiler,
+        preaggs=preaggs,
+        warm=warm,
+        warm_interval=args.warm_interval,
+        timeouts=dict(args.timeout),
+        max_queued=args.max_queued,
+        max_result_size=args.max_result_size,
+        sticky_writes=args.processes > 1,
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    """Run a server process."""
+    logging.basicConfig(stream=sys.stdout, level=args.log_level)
+    server(create_service(args), port=args.port)
+
+
+def split_resources(args: argparse.Namespace) -> None:
+    """Share the cores, memory and cache directory between the processes."""
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.processes)
+    if args.memory_limit is None and hasattr(os, "sysconf"):
+        # DuckDB's default limit is 80% of the memory, for each process
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        args.memory_limit = f"{int(memory * 0.8 / args.processes) // 1024**2}MiB"
+    if args.cache_dir is None:
+        args.cache_dir = tempfile.mkdtemp(prefix="duckdb-server-")
+
+
+def run_processes(args: argparse.Namespace) -> None:
+    """Run `args.processes` server processes on the same port."""
+    split_resources(args)
+
+    # each process listens on the same port, and the kernel spreads the
+    # connections between them (socketify binds with SO_REUSEPORT)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run, args=(args,), name=f"duckdb-server-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum: int, frame: object) -> None:
+        for process in processes:
+            process.terminate()
+
+    # do not leave the processes behind when the parent is stopped
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
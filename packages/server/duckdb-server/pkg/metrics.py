@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import bisect
+import threading
+from typing import TYPE_CHECKING, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+    from pkg.cache import ResultCache
+    from pkg.executor import QueryExecutor
+
+# upper bounds in seconds of the query latency buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+COMMANDS = frozenset(("arrow", "exec", "json", "batch", "ingest"))
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metric:
+    """A metric with one value per combination of label values."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+
+class Counter(Metric):
+    type = "counter"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation)
+        self.buckets = buckets
+        # per label values: the count of each bucket (plus +Inf) and the sum
+        self._histograms: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._histograms[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def get(self, **labels: str) -> float:
+        """The number of observations."""
+        histogram = self._histograms.get(tuple(sorted(labels.items())))
+        return sum(histogram[0]) if histogram else 0
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            histograms = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._histograms.items()
+            ]
+        bounds = [*(_format_value(bound) for bound in self.buckets), "+Inf"]
+        for labels, counts, total in histograms:
+            cumulative = 0
+            for bound, count in zip(bounds, counts, strict=True):
+                cumulative += count
+                yield f"{self.name}_bucket", (*labels, ("le", bound)), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    """A set of metrics that renders in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+        # called before rendering to update metrics that mirror other state
+        self.collectors: dict[str, Callable[[], None]] = {}
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collect in self.collectors.values():
+            collect()
+
+        lines: list[str] = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+                for name, labels, value in metric.samples()
+            )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+QUERY_DURATION = REGISTRY.register(
+    Histogram("duckdb_server_query_duration_seconds", "Time to answer a query.")
+)
+QUERY_ERRORS = REGISTRY.register(
+    Counter("duckdb_server_query_errors_total", "Queries that failed.")
+)
+QUERIES_CANCELLED = REGISTRY.register(
+    Counter("duckdb_server_queries_cancelled_total", "Queries cancelled by clients.")
+)
+QUERIES_REJECTED = REGISTRY.register(
+    Counter(
+        "duckdb_server_queries_rejected_total",
+        "Queries refused because the server was busy or their result too large.",
+    )
+)
+QUERY_TIMEOUTS = REGISTRY.register(
+    Counter(
+        "duckdb_server_query_timeouts_total",
+        "Queries interrupted because they ran longer than their timeout.",
+    )
+)
+QUERIES_IN_FLIGHT = REGISTRY.register(
+    Gauge("duckdb_server_queries_in_flight", "Queries being answered.")
+)
+QUERIES_COALESCED = REGISTRY.register(
+    Counter(
+        "duckdb_server_queries_coalesced_total",
+        "Queries that joined an identical running query.",
+    )
+)
+BYTES_SENT = REGISTRY.register(
+    Counter("duckdb_server_sent_bytes_total", "Bytes of results sent to clients.")
+)
+BACKPRESSURE_EVENTS = REGISTRY.register(
+    Counter(
+        "duckdb_server_backpressure_events_total",
+        "WebSocket sends that found the send buffer full.",
+    )
+)
+RESULTS_SUPERSEDED = REGISTRY.register(
+    Counter(
+        "duckdb_server_results_superseded_total",
+        "Unsent results dropped because their query was cancelled.",
+    )
+)
+CACHE_HITS = REGISTRY.register(
+    Counter("duckdb_server_cache_hits_total", "Results served from the cache.")
+)
+CACHE_MISSES = REGISTRY.register(
+    Counter("duckdb_server_cache_misses_total", "Results not found in the cache.")
+)
+CACHE_EVICTIONS = REGISTRY.register(
+    Counter(
+        "duckdb_server_cache_evictions_total",
+        "Results evicted from the memory cache.",
+    )
+)
+CACHE_INVALIDATIONS = REGISTRY.register(
+    Counter(
+        "duckdb_server_cache_invalidations_total",
+        "Results dropped because a query changed a table they read.",
+    )
+)
+CACHE_STALE = REGISTRY.register(
+    Counter(
+        "duckdb_server_cache_stale_total",
+        "Results dropped because a file they read has changed.",
+    )
+)
+CACHE_ENTRIES = REGISTRY.register(
+    Gauge("duckdb_server_cache_entries", "Results in the memory cache.")
+)
+CACHE_BYTES = REGISTRY.register(
+    Gauge("duckdb_server_cache_bytes", "Size of the results in the memory cache.")
+)
+PREAGG_TABLES = REGISTRY.register(
+    Gauge("duckdb_server_preagg_tables", "Pre-aggregated tables that exist.")
+)
+PREAGG_BYTES = REGISTRY.register(
+    Gauge(
+        "duckdb_server_preagg_bytes",
+        "Estimated size of the pre-aggregated tables that exist.",
+    )
+)
+PREAGG_EVICTIONS = REGISTRY.register(
+    Counter(
+        "duckdb_server_preagg_evictions_total",
+        "Pre-aggregated tables dropped to stay within the budget.",
+    )
+)
+PREAGG_REBUILDS = REGISTRY.register(
+    Counter(
+        "duckdb_server_preagg_rebuilds_total",
+        "Dropped pre-aggregated tables built again for a query.",
+    )
+)
+PREAGG_DEDUPLICATED = REGISTRY.register(
+    Counter(
+        "duckdb_server_preagg_deduplicated_total",
+        "Exec commands skipped because their pre-aggregated tables exist.",
+    )
+)
+
+
+def command_label(command: object) -> str:
+    """The command as a metric label, without letting clients add new labels."""
+    if isinstance(command, str) and command in COMMANDS:
+        return command
+    return "unknown"
+
+
+def collect_from(cache: ResultCache, executor: QueryExecutor) -> None:
+    """Mirror the counters of the cache and executor in the registry."""
+
+    def collect() -> None:
+        stats = cache.stats()
+        CACHE_HITS.set(stats["memory_hits"], tier="memory")
+        CACHE_HITS.set(stats["disk_hits"], tier="disk")
+        CACHE_MISSES.set(stats["misses"])
+        CACHE_EVICTIONS.set(stats["evictions"])
+        CACHE_INVALIDATIONS.set(stats["invalidations"])
+        CACHE_STALE.set(stats["stale"])
+        CACHE_ENTRIES.set(stats["entries"])
+        CACHE_BYTES.set(stats["bytes"])
+        QUERIES_COALESCED.set(executor.coalesced)
+        QUERIES_REJECTED.set(executor.scheduler.rejected, reason="busy")
+        QUERIES_REJECTED.set(executor.too_large, reason="size")
+        QUERY_TIMEOUTS.set(executor.timed_out)
+        preaggs = executor.preaggs.stats()
+        PREAGG_TABLES.set(preaggs["tables"])
+        PREAGG_BYTES.set(preaggs["bytes"])
+        PREAGG_EVICTIONS.set(preaggs["evictions"])
+        PREAGG_REBUILDS.set(preaggs["rebuilds"])
+        PREAGG_DEDUPLICATED.set(preaggs["deduplicated"])
+
+    REGISTRY.collectors["server"] = collect
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import argparse
+import os
+import re
+
+from pkg.cache import CODECS, DEFAULT_MEMORY_LIMIT
+from pkg.executor import ALL_COMMANDS, DEFAULT_WORKERS, TIMEOUT_COMMANDS
+from pkg.preagg import DEFAULT_SCHEMA
+from pkg.server import DEFAULT_PORT
+
+# prefix of the environment variables that set the defaults of the options
+ENV_PREFIX = "DUCKDB_SERVER_"
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes such as `1000`, `512MB` or `4GiB`."""
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)(?:I?B)?\s*", value.upper())
+    if match is None:
+        msg = f"invalid size: {value!r}"
+        raise argparse.ArgumentTypeError(msg)
+    number, unit = match.groups()
+    return int(number) * SIZE_UNITS[unit]
+
+
+def parse_timeout(value: str) -> tuple[str, float]:
+    """Parse the timeout of all commands or one, such as `30` or `exec=300`."""
+    command, _, seconds = value.strip().rpartition("=")
+    if command and command not in TIMEOUT_COMMANDS:
+        commands = ", ".join(sorted(TIMEOUT_COMMANDS))
+        msg = f"invalid timeout: {value!r}, the command is one of {commands}"
+        raise argparse.ArgumentTypeError(msg)
+    try:
+        timeout = float(seconds)
+    except ValueError:
+        timeout = 0
+    if not timeout > 0:
+        msg = f"invalid timeout: {value!r}"
+        raise argparse.ArgumentTypeError(msg)
+    return command or ALL_COMMANDS, timeout
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    def env(name: str, default: str | None = None) -> str | None:
+        return os.environ.get(ENV_PREFIX + name, default)
+
+    parser = argparse.ArgumentParser(
+        prog="duckdb-server",
+        description="A DuckDB server for Mosaic. "
+        f"Options can also be set with {ENV_PREFIX}* environment variables, "
+        f"e.g. {ENV_PREFIX}PORT.",
+    )
+    parser.add_argument(
+        "database",
+        nargs="?",
+        default=env("DATABASE", ":memory:"),
+        help='path of the database file, or ":memory:" (default: %(default)s)',
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=env("PORT", str(DEFAULT_PORT)),
+        help="HTTP and WebSocket port (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=env("WORKERS", str(DEFAULT_WORKERS)),
+        help="number of queries that run at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=env("PROCESSES", "1"),
+        help="number of server processes on the port; more than one opens the "
+        "database read-only (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=env("MAX_QUEUED"),
+        help="number of queries that may wait for a worker; more are rejected "
+        "(default: no limit)",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="append",
+        type=parse_timeout,
+        metavar="[COMMAND=]SECONDS",
+        default=[
+            parse_timeout(value) for value in (env("TIMEOUT") or "").split(",") if value
+        ],
+        help="interrupt queries that run longer, for all commands or one of "
+        f"{', '.join(sorted(TIMEOUT_COMMANDS))}, may be repeated (default: none)",
+    )
+    parser.add_argument(
+        "--max-result-size",
+        type=parse_size,
+        default=env("MAX_RESULT_SIZE"),
+        help="size limit of an arrow or json result, above which the query fails, "
+        "e.g. 512MB (default: no limit)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=env("THREADS"),
+        help="number of DuckDB threads (default: number of cores)",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        default=env("MEMORY_LIMIT"),
+        help="DuckDB memory limit, e.g. 4GB (default: 80%% of RAM)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=env("CACHE_DIR"),
+        help="directory of the persistent result cache (default: a new temp dir)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        default=env("CACHE_SIZE", "1GB"),
+        help="size limit of the persistent result cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-compression",
+        choices=["none", *CODECS],
+        default=env("CACHE_COMPRESSION", "zstd"),
+        help="codec of the results in the persistent cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-cache-size",
+        type=parse_size,
+        default=env("MEMORY_CACHE_SIZE", f"{DEFAULT_MEMORY_LIMIT // 1024**2}MB"),
+        help="size limit of the in-memory result cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=env("STREAM", "").lower() in {"1", "true", "yes"},
+        help="stream arrow results batch by batch",
+    )
+    parser.add_argument(
+        "--profile-threshold",
+        type=float,
+        default=env("PROFILE_THRESHOLD"),
+        help="keep DuckDB's profile of queries slower than this many milliseconds, "
+        "see /profiles (default: off)",
+    )
+    parser.add_argument(
+        "--profile-sample",
+        type=float,
+        default=env("PROFILE_SAMPLE", "0"),
+        help="fraction of queries whose profile is kept (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--preagg-budget",
+        type=parse_size,
+        default=env("PREAGG_BUDGET"),
+        help="size limit of Mosaic's pre-aggregated tables, beyond which the least "
+        "valuable are dropped and rebuilt when needed (default: no limit)",
+    )
+    parser.add_argument(
+        "--preagg-schema",
+        default=env("PREAGG_SCHEMA", DEFAULT_SCHEMA),
+        help="schema of Mosaic's pre-aggregated tables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--warm",
+        action="append",
+        metavar="PATH",
+        default=[path for path in (env("WARM") or "").split(os.pathsep) if path],
+        help="SQL file or recorded workload (JSON) to fill the cache with before "
+        "the port opens, may be repeated",
+    )
+    parser.add_argument(
+        "--warm-interval",
+        type=float,
+        metavar="SECONDS",
+        default=env("WARM_INTERVAL"),
+        help="run the warm-up queries again at this interval (default: only at start)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str.upper,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=env("LOG_LEVEL", "DEBUG"),
+        help="(default: %(default)s)",
+    )
+    return parser.parse_args(argv)
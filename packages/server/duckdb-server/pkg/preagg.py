@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any
+
+from pkg.sql import created_if_not_exists, quote, read_table_names
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    import duckdb
+
+logger = logging.getLogger(__name__)
+
+# the schema of Mosaic's pre-aggregated tables, see `PreAggregator` in mosaic-core
+DEFAULT_SCHEMA = "mosaic"
+
+# bytes per value of the column types, to estimate the size of a table
+TYPE_WIDTHS = {
+    "BOOLEAN": 1,
+    "TINYINT": 1,
+    "UTINYINT": 1,
+    "SMALLINT": 2,
+    "USMALLINT": 2,
+    "INTEGER": 4,
+    "UINTEGER": 4,
+    "FLOAT": 4,
+    "DATE": 4,
+    "BIGINT": 8,
+    "UBIGINT": 8,
+    "DOUBLE": 8,
+    "TIME": 8,
+    "TIMESTAMP": 8,
+    "TIMESTAMP WITH TIME ZONE": 8,
+}
+
+# strings, decimals, nested types and everything else
+DEFAULT_WIDTH = 16
+
+
+class _Table:
+    """A pre-aggregated table and what it takes to keep and rebuild it."""
+
+    def __init__(self, name: str, sql: str, cost: float) -> None:
+        self.name = name
+        # the statement that builds the table
+        self.sql = sql
+        # seconds to build the table
+        self.cost = cost
+        self.size = 0
+        self.credit = 0.0
+        self.used = time.time()
+        self.evicted = False
+
+
+class PreAggregates:
+    """Track the tables that Mosaic's pre-aggregator creates and keep them in budget.
+
+    Clients create a table in the `schema` with `CREATE TABLE IF NOT EXISTS` once
+    for every pre-aggregated view, and never drop it. The server records each
+    table's estimated size, build time and last use. Once the tables take up more
+    than `budget` bytes, it drops the table that is cheapest to keep losing, by
+    GreedyDual-Size: tables that were not used for a while go first, unless they
+    took long to build for their size. A dropped table is rebuilt from its
+    statement before the next query that reads it.
+
+    Sending the same creation statements again skips DuckDB as long as the
+    tables exist, so that they neither run nor invalidate cached results.
+    """
+
+    def __init__(self, schema: str = DEFAULT_SCHEMA, budget: int | None = None) -> None:
+        self.schema = schema.lower()
+        self.budget = budget
+
+        self._tables: dict[str, _Table] = {}
+        # the creation statements that ran, to skip them while their tables exist
+        self._created: set[str] = set()
+        # the aging of GreedyDual-Size, which rises to the credit of each victim
+        self._clock = 0.0
+        self._lock = threading.Lock()
+        # tables are built and dropped one at a time
+        self._building = threading.Lock()
+
+        self.deduplicated = 0
+        self.evictions = 0
+        self.rebuilds = 0
+
+    def created_tables(self, sql: str) -> list[tuple[str, str]] | None:
+        """The names and statements of the tables in the schema that `sql` creates.
+
+        None if it does anything else than creating schemas and tables unless they
+        exist, or creates tables elsewhere.
+        """
+        created = created_if_not_exists(sql)
+        if not created:
+            return None
+        tables = []
+        for kind, name, statement in created:
+            if kind == "schema" and name[-1] == self.schema:
+                continue
+            if kind != "table" or name[-2:-1] != (self.schema,):
+                return None
+            tables.append((name[-1], statement))
+        return tables
+
+    def exists(self, sql: str) -> bool:
+        """Whether `sql` creates tables that were already created and still exist."""
+        tables = self.created_tables(sql)
+        if not tables:
+            return False
+        with self._lock:
+            if sql not in self._created:
+                return False
+            for name, _ in tables:
+                table = self._tables.get(name)
+                if table is None or table.evicted:
+                    return False
+            self.deduplicated += 1
+        for name, _ in tables:
+            self._use(name)
+        return True
+
+    @contextmanager
+    def track(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> Iterator[None]:
+        """Record the tables that the exec command in the block creates or drops."""
+        start = time.perf_counter()
+        yield
+        cost = time.perf_counter() - start
+
+        tables = self.created_tables(sql)
+        if tables is None:
+            if self.schema in sql.lower():
+                self._forget_dropped(cursor, sql)
+            return
+
+        for name, statement in tables:
+            with self._lock:
+                table = self._tables.get(name)
+                if table is not None and not table.evicted:
+                    continue
+                self._tables[name] = table = _Table(name, statement, cost / len(tables))
+            table.size = self._estimate_size(cursor, name)
+            self._use(name)
+        with self._lock:
+            self._created.add(sql)
+        self._evict(cursor, keep={name for name, _ in tables})
+
+    def use(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> bool:
+        """Note the use of the tables a query reads and rebuild dropped ones.
+
+        Returns whether any table was rebuilt.
+        """
+        if self.schema not in sql.lower():
+            return False
+        read = {
+            name[-1]
+            for name in read_table_names(cursor, sql)
+            if name[-2:-1] == (self.schema,)
+        }
+        with self._lock:
+            names = [name for name in self._tables if name in read]
+        rebuilt = False
+        for name in names:
+            rebuilt = self._rebuild(cursor, name) or rebuilt
+            self._use(name)
+        if rebuilt:
+            self._evict(cursor, keep=set(names))
+        return rebuilt
+
+    def _use(self, name: str) -> None:
+        with self._lock:
+            table = self._tables.get(name)
+            if table is not None:
+                table.used = time.time()
+                table.credit = self._clock + table.cost / max(table.size, 1)
+
+    def _rebuild(self, cursor: duckdb.DuckDBPyConnection, name: str) -> bool:
+        with self._building:
+            table = self._tables.get(name)
+            if table is None or not table.evicted:
+                return False
+            logger.info(f"Rebuilding pre-aggregated table {name}")
+            start = time.perf_counter()
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {quote(self.schema)}")
+            cursor.execute(table.sql)
+            with self._lock:
+                table.cost = time.perf_counter() - start
+                table.evicted = False
+                self.rebuilds += 1
+            table.size = self._estimate_size(cursor, name)
+        return True
+
+    def _evict(self, cursor: duckdb.DuckDBPyConnection, keep: set[str]) -> None:
+        """Drop tables until they fit in the budget, except the ones to keep."""
+        if self.budget is None:
+            return
+        with self._building:
+            while True:
+                with self._lock:
+                    tables = [t for t in self._tables.values() if not t.evicted]
+                    if sum(t.size for t in tables) <= self.budget:
+                        return
+                    candidates = [t for t in tables if t.name not in keep]
+                    if not candidates:
+                        return
+                    victim = min(candidates, key=lambda t: t.credit)
+                    self._clock = victim.credit
+                    victim.evicted = True
+                    self.evictions += 1
+                logger.info(
+                    f"Dropping pre-aggregated table {victim.name} of {victim.size} bytes"
+                )
+                cursor.execute(
+                    f"DROP TABLE IF EXISTS {quote(self.schema, victim.name)}"
+                )
+
+    def _forget_dropped(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> None:
+        """Forget the tables that another statement, e.g. DROP SCHEMA, removed."""
+        existing = {
+            name
+            for (name,) in cursor.execute(
+                "SELECT lower(table_name) FROM duckdb_tables() "
+                "WHERE lower(schema_name) = ?",
+                [self.schema],
+            ).fetchall()
+        }
+        schema_exists = bool(
+            cursor.execute(
+                "SELECT 1 FROM duckdb_schemas() WHERE lower(schema_name) = ?",
+                [self.schema],
+            ).fetchall()
+        )
+        with self._lock:
+            for name, table in list(self._tables.items()):
+                # a dropped table stays gone if the statement mentions it
+                gone = name in sql or not schema_exists
+                if (table.evicted and gone) or (
+                    not table.evicted and name not in existing
+                ):
+                    del self._tables[name]
+            self._created.clear()
+
+    def _estimate_size(self, cursor: duckdb.DuckDBPyConnection, name: str) -> int:
+        # DuckDB does not report the memory of a table, so estimate it from the
+        # number of rows and the width of the columns
+        rows = cursor.execute(
+            "SELECT t.estimated_size, list(c.data_type) "
+            "FROM duckdb_tables() t JOIN duckdb_columns() c "
+            "USING (database_oid, schema_oid, table_oid) "
+            "WHERE lower(t.schema_name) = ? AND lower(t.table_name) = ? GROUP BY ALL",
+            [self.schema, name],
+        ).fetchall()
+        if not rows:
+            return 0
+        count, types = rows[0]
+        return count * sum(TYPE_WIDTHS.get(t, DEFAULT_WIDTH) for t in types)
+
+    def list(self) -> list[dict[str, Any]]:
+        """The tracked tables, most recently used first."""
+        with self._lock:
+            tables = sorted(self._tables.values(), key=lambda t: t.used, reverse=True)
+            return [
+                {
+                    "name": t.name,
+                    "bytes": t.size,
+                    "cost": round(t.cost, 6),
+                    "used": t.used,
+                    "evicted": t.evicted,
+                }
+                for t in tables
+            ]
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            tables = [t for t in self._tables.values() if not t.evicted]
+            return {
+                "tables": len(tables),
+                "bytes": sum(t.size for t in tables),
+                "evicted": len(self._tables) - len(tables),
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "rebuilds": self.rebuilds,
+            }
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any
+
+import duckdb
+import ujson
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from pkg.query import _QueryParams
+
+logger = logging.getLogger(__name__)
+
+# number of profiles kept, the oldest ones are dropped first
+DEFAULT_CAPACITY = 100
+
+
+class Profiler:
+    """Capture DuckDB's profiles of slow queries and of a sample of all queries.
+
+    Profiling is off unless a `threshold` in milliseconds or a `sample` rate is
+    given. With a threshold, every query runs with profiling on, which costs a few
+    percent, and the profiles of the queries that take longer are kept.
+    """
+
+    def __init__(
+        self,
+        threshold: float | None = None,
+        sample: float = 0,
+        capacity: int = DEFAULT_CAPACITY,
+    ) -> None:
+        self.threshold = threshold
+        self.sample = sample
+        self.capacity = capacity
+
+        self._profiles: OrderedDict[int, tuple[dict[str, Any], str]] = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold is not None or self.sample > 0
+
+    @contextmanager
+    def capture(
+        self, cursor: duckdb.DuckDBPyConnection, query: _QueryParams
+    ) -> Iterator[None]:
+        """Profile what runs on the cursor inside the block, if it may be kept."""
+        sampled = self.sample > 0 and random.random() < self.sample
+        if self.threshold is None and not sampled:
+            yield
+            return
+
+        cursor.execute("SET enable_profiling = 'no_output'")
+        start = time.perf_counter()
+        yield
+        duration = (time.perf_counter() - start) * 1_000
+
+        if sampled or duration >= self.threshold:  # pyright: ignore[reportOperatorIssue]
+            try:
+                profile = cursor.get_profiling_information(format="json")
+            except duckdb.Error:
+                logger.debug("Could not get the query profile", exc_info=True)
+                return
+            # nothing ran on the cursor if the result came from the cache
+            if not profile.lstrip("{ \n").startswith('"result"'):
+                self.add(query, duration, sampled, profile)
+
+    def add(
+        self, query: _QueryParams, duration: float, sampled: bool, profile: str
+    ) -> None:
+        with self._lock:
+            profile_id = self._next_id
+            self._next_id += 1
+            summary = {
+                "id": profile_id,
+                "time": time.time(),
+                "type": query.get("type"),
+                "sql": query.get("sql"),
+                "duration": round(duration, 3),
+                "sampled": sampled,
+            }
+            if "params" in query:
+                summary["params"] = query["params"]
+            self._profiles[profile_id] = (summary, profile)
+            while len(self._profiles) > self.capacity:
+                self._profiles.popitem(last=False)
+        logger.info(
+            f"Captured profile {profile_id} of a query that took {round(duration)} ms"
+        )
+
+    def list(self) -> list[dict[str, Any]]:
+        """The summaries of the kept profiles, newest first."""
+        with self._lock:
+            return [summary for summary, _ in reversed(self._profiles.values())]
+
+    def get(self, profile_id: int) -> dict[str, Any] | None:
+        """A kept profile with its query, or None if it was dropped."""
+        with self._lock:
+            entry = self._profiles.get(profile_id)
+        if entry is None:
+            return None
+        summary, profile = entry
+        return {**summary, "profile": ujson.loads(profile)}
@@ -1,67 +1,407 @@
 from __future__ import annotations
 
+import io
+import json
 import logging
+import re
+import struct
+from functools import partial
 from hashlib import sha256
-from typing import TYPE_CHECKING, Literal, TypedDict, TypeVar
+from typing import TYPE_CHECKING, Any, Literal, TypedDict, TypeVar
 
+import duckdb
 import pyarrow as pa
 
+from pkg.cache import file_state
+from pkg.preagg import DEFAULT_WIDTH, TYPE_WIDTHS
+from pkg.sql import (
+    EVERYTHING,
+    canonical_sql,
+    is_select,
+    quote,
+    read_files,
+    read_tables,
+    written_tables,
+)
+
 if TYPE_CHECKING:
-    from collections.abc import Callable
+    from collections.abc import Callable, Iterator
 
-    import duckdb
-    from diskcache import Cache
     from typing_extensions import NotRequired
 
-R = TypeVar("R", bound=str | bytes | None)
+    from pkg.cache import ResultCache
+
+R = TypeVar("R", bound=str | bytes)
 
 
 class _QueryParams(TypedDict):
-    type: Literal["arrow", "exec", "json"]
+    type: Literal["arrow", "exec", "json", "cancel", "batch", "ingest"]
     sql: str
     uuid: str  # name
+    params: NotRequired[list[Any] | dict[str, Any]]  # values of $1 or $name in sql
     persist: NotRequired[bool]
+    compression: NotRequired[Literal["lz4", "zstd"]]  # arrow
+    priority: NotRequired[int]  # 0 (high) to 2 (low), see pkg.executor.Priority
+    queries: NotRequired[list[_QueryParams]]  # batch
+    table: NotRequired[str]  # ingest
+    mode: NotRequired[Literal["create", "replace", "append"]]  # ingest
 
 
 logger = logging.getLogger(__name__)
 
+FLOAT_TYPES = frozenset(("FLOAT", "DOUBLE"))
+
+# floats inside lists, structs, maps and arrays, e.g. DOUBLE[] or STRUCT(x FLOAT)
+NESTED_FLOAT = re.compile(r"\b(?:FLOAT|DOUBLE)\b")
+
+# the non-finite numbers in DuckDB's JSON, and the strings to skip while finding them
+NON_FINITE = re.compile(r'("(?:[^"\\]|\\.)*")|-?Infinity|NaN')
+
+# rows of a json result that are serialized at a time, see `get_json`
+JSON_BATCH_ROWS = 65536
+
+
+class ResultTooLargeError(ValueError):
+    """A result that is, or is estimated to be, larger than the limit."""
+
+    def __init__(self, size: int, limit: int, estimated: bool = False) -> None:
+        about = "about" if estimated else "more than"
+        super().__init__(
+            f"The result of {about} {_format_size(size)} exceeds the limit of "
+            f"{_format_size(limit)}. Add a LIMIT or aggregate the data."
+        )
+
+
+def _format_size(size: int) -> str:
+    value = float(size)
+    for unit in ("bytes", "KB", "MB"):
+        if value < 1024:  # ruff: ignore[magic-value-comparison]
+            return f"{value:.0f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GB"
+
+
+def estimate_size(
+    con: duckdb.DuckDBPyConnection,
+    relation: duckdb.DuckDBPyRelation,
+    sql: str,
+    params: Params | None = None,
+) -> int | None:
+    """The planner's estimate of the result of a query in bytes, if it has one.
+
+    The `relation` of the query gives the column types.
+    """
+    # other statements run as soon as they are bound, and would run again
+    if not is_select(sql):
+        return None
+    try:
+        plan = con.execute(f"EXPLAIN (FORMAT JSON) {sql}", params).fetchall()
+    except duckdb.Error:
+        return None
+    if not plan:
+        return None
+    # only the root's estimate bounds the result, e.g. not the scan below a LIMIT
+    root = json.loads(plan[0][1])[0]
+    rows = root.get("extra_info", {}).get("Estimated Cardinality")
+    if rows is None or not str(rows).isdigit():
+        return None
+    width = sum(TYPE_WIDTHS.get(str(t), DEFAULT_WIDTH) for t in relation.types)
+    return int(rows) * width
+
 
-def get_key(sql: str, command: str) -> str:
-    return f"{sha256(sql.encode('utf-8')).hexdigest()}.{command}"
+def check_size(
+    con: duckdb.DuckDBPyConnection,
+    relation: duckdb.DuckDBPyRelation,
+    sql: str,
+    params: Params | None,
+    max_bytes: int | None,
+) -> None:
+    """Reject a query whose result is estimated to be above `max_bytes`."""
+    if max_bytes is None:
+        return
+    size = estimate_size(con, relation, sql, params)
+    if size is not None and size > max_bytes:
+        raise ResultTooLargeError(size, max_bytes, estimated=True)
 
 
-def retrieve(cache: Cache, query: _QueryParams, get: Callable[[str], R]) -> R:
+# codecs for the bodies of Arrow IPC messages
+COMPRESSIONS = frozenset(("lz4", "zstd"))
+
+
+Params = list[Any] | dict[str, Any]
+
+
+def get_key(sql: str, command: str, params: Params | None = None) -> str:
+    text = canonical_sql(sql)
+    if params is not None:
+        # a template is only parsed once, whatever values it is used with
+        text += "\0" + json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return f"{sha256(text.encode('utf-8')).hexdigest()}.{command}"
+
+
+def get_params(query: _QueryParams) -> Params | None:
+    """The values of the parameters of a query's SQL, if it has any."""
+    params = query.get("params")
+    if params is not None and not isinstance(params, list | dict):
+        msg = f"Invalid params {params!r}, expected a list or an object"
+        raise TypeError(msg)
+    return params
+
+
+def get_compression(query: _QueryParams) -> str | None:
+    """The codec a client asked for to compress an arrow result, if any."""
+    compression = query.get("compression")
+    if compression is not None and compression not in COMPRESSIONS:
+        msg = f"Unsupported compression {compression!r}"
+        raise ValueError(msg)
+    return compression
+
+
+def get_query_key(query: _QueryParams) -> str:
+    """The cache key of a query, which differs for each codec of an arrow result."""
+    command = query["type"]
+    if command == "arrow" and (compression := get_compression(query)):
+        command = f"arrow.{compression}"
+    return get_key(query["sql"], command, get_params(query))
+
+
+def retrieve(
+    cache: ResultCache,
+    query: _QueryParams,
+    get: Callable[[str], R],
+    tables: Callable[[str], frozenset[str]] | None = None,
+    files: Callable[[str], frozenset[str]] | None = None,
+) -> R:
     sql = query.get("sql")
-    command = query.get("type")
 
-    key = get_key(sql, command)
-    result = cache.get(key)
+    persist = query.get("persist", False)
+
+    key = get_query_key(query)
+    result = cache.get(key, persist)
 
-    if result:
+    if result is not None:
         logger.debug("Cache hit")
     else:
+        epoch = cache.epoch
+        # before the query runs, so that files changing meanwhile make it stale
+        state = file_state(files(sql)) if files else ()
         result = get(sql)
-        if query.get("persist", False):
-            cache[key] = result
+        cache.set(
+            key,
+            result,
+            persist,
+            tables(sql) if tables else EVERYTHING,
+            epoch,
+            state,
+        )
     return result  # pyright: ignore[reportReturnType]
 
 
-def get_arrow(con: duckdb.DuckDBPyConnection, sql: str) -> pa.RecordBatchReader:
-    return con.query(sql).arrow()
+def get_arrow(
+    con: duckdb.DuckDBPyConnection, sql: str, params: Params | None = None
+) -> pa.RecordBatchReader:
+    return con.sql(sql, params=params).arrow()
+
 
+def _write_options(compression: str | None) -> pa.ipc.IpcWriteOptions:
+    return pa.ipc.IpcWriteOptions(compression=compression)  # pyright: ignore[reportArgumentType]
 
-def arrow_to_bytes(reader: pa.RecordBatchReader) -> bytes:
-    sink = pa.BufferOutputStream()
-    with pa.ipc.new_stream(sink, reader.schema) as writer:
+
+def arrow_to_bytes(
+    reader: pa.RecordBatchReader,
+    compression: str | None = None,
+    max_bytes: int | None = None,
+) -> bytes:
+    # Write straight into Python memory: BytesIO.getvalue returns its buffer
+    # without a copy, whereas a pa.BufferOutputStream would need to_pybytes().
+    # socketify only sends bytes, so the result cannot stay an Arrow buffer.
+    sink = io.BytesIO()
+    options = _write_options(compression)
+    with pa.ipc.new_stream(sink, reader.schema, options=options) as writer:
         for batch in reader:
             writer.write(batch)
-    return sink.getvalue().to_pybytes()
+            if max_bytes is not None and sink.tell() > max_bytes:
+                raise ResultTooLargeError(sink.tell(), max_bytes)
+    return sink.getvalue()
+
+
+def arrow_to_chunks(
+    reader: pa.RecordBatchReader, compression: str | None = None
+) -> Iterator[bytes]:
+    """Encode a reader as an Arrow IPC stream, one chunk per record batch.
+
+    The first chunk also carries the schema, the last one the end-of-stream marker.
+    Only one record batch is held in memory at a time.
+    """
+    sink = io.BytesIO()
+    options = _write_options(compression)
+    with pa.ipc.new_stream(sink, reader.schema, options=options) as writer:
+        for batch in reader:
+            writer.write(batch)
+            yield _take(sink)
+    yield _take(sink)
+
+
+def _take(sink: io.BytesIO) -> bytes:
+    # getvalue shares the buffer with the returned bytes instead of copying it,
+    # and truncating afterwards gives the sink a fresh buffer
+    chunk = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return chunk
+
+
+def stream_arrow(
+    con: duckdb.DuckDBPyConnection, cache: ResultCache, query: _QueryParams
+) -> Iterator[bytes]:
+    """Stream an arrow query as IPC chunks.
+
+    Chunks are only collected for the cache if the query is persisted.
+    """
+    sql = query["sql"]
+    key = get_query_key(query)
+    persist = query.get("persist", False)
+
+    cached = cache.get(key, persist)
+    if cached is not None:
+        logger.debug("Cache hit")
+        yield cached  # pyright: ignore[reportReturnType]
+        return
+
+    epoch = cache.epoch
+    state = file_state(read_files(con, sql)) if persist else ()
+    chunks: list[bytes] = []
+    reader = get_arrow(con, sql, get_params(query))
+    for chunk in arrow_to_chunks(reader, get_compression(query)):
+        if persist:
+            chunks.append(chunk)
+        yield chunk
+    if persist:
+        cache.set(key, b"".join(chunks), True, read_tables(con, sql), epoch, state)
+
+
+def get_arrow_bytes(
+    con: duckdb.DuckDBPyConnection,
+    sql: str,
+    compression: str | None = None,
+    params: Params | None = None,
+    max_bytes: int | None = None,
+) -> bytes:
+    relation = con.sql(sql, params=params)
+    check_size(con, relation, sql, params, max_bytes)
+    return arrow_to_bytes(relation.arrow(), compression, max_bytes)
+
+
+def get_json(
+    con: duckdb.DuckDBPyConnection,
+    sql: str,
+    params: Params | None = None,
+    max_bytes: int | None = None,
+) -> str:
+    result = con.sql(sql, params=params)
+    check_size(con, result, sql, params, max_bytes)
+
+    # Columns are taken by position, since names may repeat. DuckDB renames the
+    # repeated ones, e.g. to a_1, as pandas did.
+    columns = []
+    nested = False
+    for i, (name, dtype) in enumerate(zip(result.columns, result.types, strict=True)):
+        column = f"#{i + 1}"
+        if str(dtype) in FLOAT_TYPES:
+            # JSON has no NaN or Infinity, so send non-finite numbers as null
+            column = f"CASE WHEN isfinite({column}) THEN {column} END"
+        elif NESTED_FLOAT.search(str(dtype)):
+            nested = True
+        columns.append(f"{column} AS {quote(name)}")
+
+    # DuckDB serializes each row, and joining the rows keeps the result order
+    rows = result.project(", ".join(columns)).set_alias("__rows")
+    serialized = rows.project("to_json(__rows)")
+    parts: list[str] = []
+    size = 2
+    # fetch a batch at a time to stop once the result is too large
+    while batch := serialized.fetchmany(JSON_BATCH_ROWS):
+        for (row,) in batch:
+            parts.append(_finite(row) if nested else row)
+            size += len(row) + 1
+        if max_bytes is not None and size > max_bytes:
+            raise ResultTooLargeError(size, max_bytes)
+    return "[" + ",".join(parts) + "]"
+
+
+def _finite(row: str) -> str:
+    # the non-finite numbers in nested values, which SQL cannot reach as easily
+    return NON_FINITE.sub(lambda match: match.group(1) or "null", row)
+
+
+def run_query(
+    con: duckdb.DuckDBPyConnection,
+    cache: ResultCache,
+    query: _QueryParams,
+    max_bytes: int | None = None,
+) -> bytes | str | None:
+    """Run a query, or answer it from the cache.
+
+    Arrow and json results above `max_bytes` fail with `ResultTooLargeError`.
+    """
+    sql = query["sql"]
+    command = query["type"]
+    params = get_params(query)
+
+    if command == "exec":
+        tables = written_tables(con, sql)
+        try:
+            con.execute(sql, params)
+        finally:
+            # statements before a failing one may have written already
+            if cache.invalidate(tables):
+                logger.debug(f"Invalidated cached results reading {sorted(tables)}")
+        return None
+    if command == "arrow":
+        return retrieve(
+            cache,
+            query,
+            partial(
+                get_arrow_bytes,
+                con,
+                compression=get_compression(query),
+                params=params,
+                max_bytes=max_bytes,
+            ),
+            partial(read_tables, con),
+            partial(read_files, con),
+        )
+    if command == "json":
+        return retrieve(
+            cache,
+            query,
+            partial(get_json, con, params=params, max_bytes=max_bytes),
+            partial(read_tables, con),
+            partial(read_files, con),
+        )
+
+    msg = f"Unknown command {command}"
+    raise ValueError(msg)
 
 
-def get_arrow_bytes(con: duckdb.DuckDBPyConnection, sql: str) -> bytes:
-    return arrow_to_bytes(get_arrow(con, sql))
+def encode_batch(
+    queries: list[_QueryParams], results: list[bytes | str | BaseException | None]
+) -> bytes:
+    """Multiplex the results of a batch into a single binary message.
 
+    The message starts with the length of a JSON header as a big-endian uint32.
+    The header lists the type, payload size and error (if any) of each query, and
+    the payloads follow in the same order.
+    """
+    header: list[dict[str, str | int]] = []
+    payloads: list[bytes] = []
+    for query, result in zip(queries, results, strict=True):
+        if isinstance(result, BaseException):
+            header.append({"type": query["type"], "size": 0, "error": str(result)})
+            continue
+        payload = result.encode("utf-8") if isinstance(result, str) else result or b""
+        header.append({"type": query["type"], "size": len(payload)})
+        payloads.append(payload)
 
-def get_json(con: duckdb.DuckDBPyConnection, sql: str) -> str | None:
-    result = con.query(sql).df()
-    return result.to_json(orient="records")
+    encoded = json.dumps(header).encode("utf-8")
+    return b"".join([struct.pack(">I", len(encoded)), encoded, *payloads])
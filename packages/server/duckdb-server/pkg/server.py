@@ -1,119 +1,310 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import sys
-import time
-from functools import partial
-from typing import TYPE_CHECKING, Any, Protocol
+from collections import deque
+from contextlib import suppress
+from typing import TYPE_CHECKING, Any
 
 import ujson
 from socketify import App, CompressOptions, OpCode
 
-from pkg.query import get_arrow_bytes, get_json, retrieve
+from pkg import core, metrics
+from pkg.compression import (
+    COMPRESS_THRESHOLD,
+    OFFLOAD_THRESHOLD,
+    compress,
+    negotiate,
+)
+from pkg.core import CORS_HEADERS, Handler, error_status, ingest_query
+from pkg.ingest import Upload
 
 if TYPE_CHECKING:
-    import duckdb
-    from diskcache import Cache
-    from duckdb import DuckDBPyConnection as Con
+    from collections.abc import AsyncIterator
+
     from socketify import Request as Req
     from socketify import Response as Res
     from socketify import SendStatus as Status
     from socketify import WebSocket as Ws
 
+    from pkg.core import QueryService
     from pkg.query import _QueryParams
 
 logger = logging.getLogger(__name__)
 
-SLOW_QUERY_THRESHOLD = 5000
-
-
-class Handler(Protocol):
-    def done(self) -> None: ...
-    def arrow(self, buffer: bytes) -> None: ...
-    def json(self, data: Any) -> None: ...
-    def error(self, error: Any) -> None: ...
+DEFAULT_PORT = 3000
+
+# bytes a WebSocket may buffer before further sends are dropped
+MAX_BACKPRESSURE = 64 * 1024
+
+# bytes of unsent results above which a client's next query waits
+HIGH_WATER_MARK = 8 * 1024 * 1024
+
+# seconds between checks of the send buffer while waiting for it to drain
+DRAIN_INTERVAL = 0.01
+
+# largest WebSocket message the server accepts, e.g. a batch of queries
+MAX_PAYLOAD_LENGTH = 16 * 1024 * 1024
+
+
+class SocketClient(core.SocketClient):
+    """State of one WebSocket connection, attached to the socket on upgrade.
+
+    Results go through an outbox that only hands them to the socket while its
+    send buffer is below `MAX_BACKPRESSURE`, since the socket drops messages
+    sent above it. Once the outbox and send buffer together hold more than
+    `HIGH_WATER_MARK` bytes, the client's next query waits for them to drain,
+    so a slow client cannot make the server hold on to more and more results.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        # set whenever the socket drains its send buffer (or closes)
+        self.drained = asyncio.Event()
+
+        # results waiting for room in the send buffer, with the uuid of their query
+        self.outbox: deque[tuple[str | None, bytes | str, OpCode]] = deque()
+        self.outbox_bytes = 0
+        self.flusher: asyncio.Task[None] | None = None
+        # set while the fragments of a message are sent, which nothing may interrupt
+        self.streaming = False
+
+    def cancel(self, uuid: str | None) -> None:
+        if not self.supersede(uuid):
+            super().cancel(uuid)
+
+    def supersede(self, uuid: str | None) -> bool:
+        """Replace the unsent result of a cancelled query with the cancel error."""
+        for i, (queued, data, _) in enumerate(self.outbox):
+            if queued == uuid:
+                error = ujson.dumps({"error": "Query cancelled"})
+                self.outbox[i] = (uuid, error, OpCode.TEXT)
+                self.outbox_bytes += len(error) - len(data)
+                metrics.RESULTS_SUPERSEDED.inc()
+                logger.info(f"Dropped unsent result of query {uuid}")
+                return True
+        return False
+
+    def backlog(self, ws: Ws) -> int:
+        """Bytes of results that the client has not received yet."""
+        return self.outbox_bytes + ws.get_buffered_amount()
+
+    def enqueue(
+        self, ws: Ws, uuid: str | None, data: bytes | str, opcode: OpCode
+    ) -> None:
+        # results may arrive from the pool after the socket has gone away
+        if self.closed:
+            logger.debug("Dropping result for closed WebSocket")
+            return
+        self.outbox.append((uuid, data, opcode))
+        self.outbox_bytes += len(data)
+        self.flush(ws)
+        if self.outbox and self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.keep_flushing(ws))
+
+    def flush(self, ws: Ws) -> None:
+        """Send queued results while the send buffer has room for them."""
+        while (
+            self.outbox
+            and not self.closed
+            and not self.streaming
+            and ws.get_buffered_amount() <= MAX_BACKPRESSURE
+        ):
+            _, data, opcode = self.outbox.popleft()
+            self.outbox_bytes -= len(data)
+            check(ws, ws.send(data, opcode), data)
+
+    async def keep_flushing(self, ws: Ws) -> None:
+        try:
+            while self.outbox and not self.closed:
+                await self.wait_for_drain()
+                self.flush(ws)
+        finally:
+            self.flusher = None
+
+    async def wait_for_drain(self) -> None:
+        # drain events are not delivered for every write, so poll as well
+        self.drained.clear()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.drained.wait(), DRAIN_INTERVAL)
+
+    async def wait_for_room(self, ws: Ws) -> None:
+        """Wait until the client has received enough results to run another query."""
+        if self.backlog(ws) > HIGH_WATER_MARK:
+            logger.debug(f"Pausing queries of slow WebSocket: {self.backlog(ws)}")
+        while not self.closed and self.backlog(ws) > HIGH_WATER_MARK:
+            await self.wait_for_drain()
+            self.flush(ws)
+
+    def close(self) -> None:
+        self.outbox.clear()
+        self.outbox_bytes = 0
+        self.drained.set()
+        super().close()
+
+
+def check(ws: Ws, ok: Ws | Status | None, data: bytes | str) -> None:
+    metrics.BYTES_SENT.inc(len(data), transport="ws")
+    if not ok:
+        metrics.BACKPRESSURE_EVENTS.inc()
+        logger.debug(f"WebSocket backpressure: {ws.get_buffered_amount()}")
 
 
 class SocketHandler(Handler):
-    def __init__(self, ws: Ws) -> None:
+    def __init__(self, ws: Ws, client: SocketClient, uuid: str | None = None) -> None:
         self.ws: Ws = ws
-
-    def check(self, ok: Ws | Status | None) -> None:
-        if not ok:
-            logger.warning(f"WebSocket backpressure: {self.ws.get_buffered_amount()}")
+        self.client = client
+        self.uuid = uuid
+        # set while the fragments of the result go out
+        self.sending = False
+
+    def send(self, data: bytes | str, opcode: OpCode) -> None:
+        self.client.enqueue(self.ws, self.uuid, data, opcode)
+
+    async def drain(self) -> None:
+        """Wait until earlier results are sent and the send buffer has room."""
+        while not self.client.closed and (
+            (self.client.outbox and not self.client.streaming)
+            or self.ws.get_buffered_amount() > MAX_BACKPRESSURE
+        ):
+            await self.client.wait_for_drain()
+            self.client.flush(self.ws)
 
     def done(self) -> None:
-        ok = self.ws.send({}, OpCode.TEXT)
-        self.check(ok)
+        self.send("{}", OpCode.TEXT)
 
     def arrow(self, buffer: bytes) -> None:
-        ok = self.ws.send(buffer, OpCode.BINARY)
-        self.check(ok)
+        self.send(buffer, OpCode.BINARY)
+
+    async def arrow_stream(self, first: bytes, rest: AsyncIterator[bytes]) -> None:
+        # Send the IPC stream as the fragments of a single binary message. Each
+        # chunk is held back until the next one arrives so that the final chunk
+        # can complete the message.
+        pending = first
+        try:
+            async for chunk in rest:
+                # fragments sent over the backpressure limit would be dropped
+                await self.drain()
+                if self.client.closed:
+                    return
+                if self.sending:
+                    ok = self.ws.send_fragment(pending)
+                else:
+                    ok = self.ws.send_first_fragment(pending, OpCode.BINARY)
+                    self.sending = self.client.streaming = True
+                check(self.ws, ok, pending)
+                pending = chunk
+
+            await self.drain()
+            if self.client.closed:
+                return
+            if self.sending:
+                check(self.ws, self.ws.send_last_fragment(pending), pending)
+                self.sending = self.client.streaming = False
+            else:
+                self.arrow(pending)
+        finally:
+            # let results that were queued meanwhile (e.g. cancel errors) go out
+            self.client.streaming = False
+            self.client.flush(self.ws)
 
-    def json(self, data: Any) -> None:
-        ok = self.ws.send(data, OpCode.TEXT)
-        self.check(ok)
+    def json(self, data: str) -> None:
+        self.send(data, OpCode.TEXT)
 
     def error(self, error: object) -> None:
-        ok = self.ws.send({"error": str(error)}, OpCode.TEXT)
-        self.check(ok)
+        if self.sending:
+            # cannot interleave an error with a partially sent message
+            if not self.client.closed:
+                self.ws.end(1011, "Error while streaming result")
+            return
+        self.send(ujson.dumps({"error": str(error)}), OpCode.TEXT)
 
 
 class HTTPHandler(Handler):
-    def __init__(self, res: Res) -> None:
+    """Answer an HTTP request, compressed with the `encoding` the client accepts.
+
+    Bodies above `OFFLOAD_THRESHOLD` are compressed on a thread, and the response
+    goes out once they are.
+    """
+
+    def __init__(self, res: Res, encoding: str | None = None) -> None:
         self.res = res
+        self.encoding = encoding
+        self.streaming = False
+        self.sending: asyncio.Task[None] | None = None
+
+    def start(self, status: int | None = None) -> None:
+        # uWS sends 200 once a header is written, so the status goes first
+        if status is not None:
+            self.res.write_status(status)
+        write_cors_headers(self.res)
 
     def done(self) -> None:
+        self.start()
         self.res.end("")
 
+    def send(self, body: bytes | str, content_type: str) -> None:
+        if self.encoding is None or len(body) < COMPRESS_THRESHOLD:
+            self.end(body, content_type)
+        elif len(body) < OFFLOAD_THRESHOLD:
+            self.end(compress(body, self.encoding), content_type, self.encoding)
+        else:
+            self.sending = asyncio.ensure_future(
+                self.send_compressed(body, content_type, self.encoding)
+            )
+
+    async def send_compressed(
+        self, body: bytes | str, content_type: str, encoding: str
+    ) -> None:
+        data = await asyncio.to_thread(compress, body, encoding)
+        if not self.res.aborted:
+            self.end(data, content_type, encoding)
+
+    def end(
+        self, body: bytes | str, content_type: str, encoding: str | None = None
+    ) -> None:
+        self.start()
+        self.res.write_header("Content-Type", content_type)
+        self.res.write_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.res.write_header("Content-Encoding", encoding)
+        self.res.end(body)
+        metrics.BYTES_SENT.inc(len(body), transport="http")
+
     def arrow(self, buffer: bytes) -> None:
+        self.send(buffer, "application/octet-stream")
+
+    async def arrow_stream(self, first: bytes, rest: AsyncIterator[bytes]) -> None:
+        # without a content length, the chunks go out with chunked transfer encoding
+        self.start()
         self.res.write_header("Content-Type", "application/octet-stream")
-        self.res.end(buffer)
+        self.streaming = True
+        self.res.write(first)
+        metrics.BYTES_SENT.inc(len(first), transport="http")
+        async for chunk in rest:
+            if self.res.aborted:
+                return
+            self.res.write(chunk)
+            metrics.BYTES_SENT.inc(len(chunk), transport="http")
+        self.res.end("")
+        self.streaming = False
 
-    def json(self, data: Any) -> None:
-        self.res.write_header("Content-Type", "application/json")
-        self.res.end(data)
+    def json(self, data: str) -> None:
+        self.send(data, "application/json")
 
     def error(self, error: object) -> None:
-        self.res.write_status(500)
+        if self.streaming:
+            # the status line is already sent, so signal the error by closing
+            self.res.close()
+            return
+        self.start(error_status(error))
         self.res.end(str(error))
 
 
-def handle_query(
-    handler: Handler,
-    con: duckdb.DuckDBPyConnection,
-    cache: Cache,
-    query: _QueryParams,
-) -> None:
-    logger.debug(f"{query=}")
-
-    start = time.time()
-
-    sql = query["sql"]
-    command = query["type"]
-
-    try:
-        if command == "exec":
-            con.execute(sql)
-            handler.done()
-        elif command == "arrow":
-            buffer = retrieve(cache, query, partial(get_arrow_bytes, con))
-            handler.arrow(buffer)
-        elif command == "json":
-            json = retrieve(cache, query, partial(get_json, con))
-            handler.json(json)
-        else:
-            msg = f"Unknown command {command}"
-            raise ValueError(msg)
-    except Exception as e:
-        logger.exception("Error processing query")
-        handler.error(e)
-
-    total = round((time.time() - start) * 1_000)
-    if total > SLOW_QUERY_THRESHOLD:
-        logger.warning(f"DONE. Slow query took {total} ms.\n{sql}")
-    else:
-        logger.info(f"DONE. Query took {total} ms.\n{sql}")
+def write_cors_headers(res: Res) -> None:
+    for name, value in CORS_HEADERS:
+        res.write_header(name, value)
 
 
 def on_error(error: object, res: Res, req: Req) -> None:
@@ -123,7 +314,7 @@ def on_error(error: object, res: Res, req: Req) -> None:
         res.end(f"Error {error}")
 
 
-def server(con: Con, cache: Cache) -> None:
+def server(service: QueryService, port: int = DEFAULT_PORT) -> None:
     # SSL server
     # app = App(AppOptions(key_file_name="./localhost-key.pem", cert_file_name="./localhost.pem"))
     app = App()
@@ -131,8 +322,23 @@ def server(con: Con, cache: Cache) -> None:
     # faster serialization than standard json
     app.json_serializer(ujson)
 
-    def ws_message(ws: Ws, message: str | bytes | bytearray, opcode: OpCode) -> None:
-        handler = SocketHandler(ws)
+    def ws_upgrade(res: Res, req: Req, context: Any) -> None:
+        res.upgrade(
+            req.get_header("sec-websocket-key"),
+            req.get_header("sec-websocket-protocol"),
+            req.get_header("sec-websocket-extensions"),
+            context,
+            SocketClient(),
+        )
+
+    async def ws_message(
+        ws: Ws, message: str | bytes | bytearray, opcode: OpCode
+    ) -> None:
+        client: SocketClient = ws.get_user_data()
+        if opcode == OpCode.BINARY:
+            client.receive(bytes(message))  # pyright: ignore[reportArgumentType]
+            return
+        handler = SocketHandler(ws, client)
 
         try:
             query: _QueryParams = ujson.loads(message)
@@ -141,51 +347,139 @@ def server(con: Con, cache: Cache) -> None:
             handler.error(e)
             return
 
-        handle_query(handler, con, cache, query)
+        uuid = query.get("uuid")
+        if query["type"] == "cancel":
+            client.cancel(uuid)
+            return
+        handler.uuid = uuid
+        upload = None
+        if query["type"] == "ingest":
+            upload = client.start_upload()
+
+        async def run() -> None:
+            async with client.lock:
+                await client.wait_for_room(ws)
+                await service.handle(handler, query, client, upload)
+
+        task = asyncio.ensure_future(run())
+        if uuid is not None:
+            client.queries[uuid] = (task, handler)
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info(f"Cancelled query {uuid}")
+            metrics.QUERIES_CANCELLED.inc()
+            # still answer, since clients may match responses by order
+            handler.error("Query cancelled")
+        finally:
+            if uuid is not None:
+                client.queries.pop(uuid, None)
+
+    def ws_drain(ws: Ws) -> None:
+        logger.debug(f"WebSocket drained: {ws.get_buffered_amount()}")
+        client: SocketClient = ws.get_user_data()
+        client.flush(ws)
+        client.drained.set()
+
+    def ws_close(ws: Ws, code: int, message: bytes | None) -> None:
+        client: SocketClient = ws.get_user_data()
+        client.close()
 
     async def http_handler(res: Res, req: Req) -> None:
-        res.write_header("Access-Control-Allow-Origin", "*")
-        res.write_header("Access-Control-Request-Method", "*")
-        res.write_header("Access-Control-Allow-Methods", "OPTIONS, POST, GET")
-        res.write_header("Access-Control-Allow-Headers", "*")
-        res.write_header("Access-Control-Max-Age", "2592000")
-
         method = req.get_method()
 
-        handler = HTTPHandler(res)
+        handler = HTTPHandler(res, negotiate(req.get_header("accept-encoding")))
+        # HTTP requests from one address take turns with other clients
+        client = res.get_remote_address()
         data: _QueryParams
         if method == "OPTIONS":
             handler.done()
-        elif method == "GET":
+            return
+        if method == "GET":
             message: str | bytes | bytearray = req.get_query("query")  # pyright: ignore[reportAssignmentType]
             data = ujson.loads(message)
-            handle_query(handler, con, cache, data)
         elif method == "POST":
             maybe_data: _QueryParams | None = await res.get_json()
-            if maybe_data:
-                handle_query(handler, con, cache, maybe_data)
-            else:
+            if not maybe_data:
                 raise NotImplementedError
+            data = maybe_data
+        else:
+            raise NotImplementedError
+        if data.get("compression"):
+            # the Arrow IPC bodies are compressed already
+            handler.encoding = None
+        await service.handle(handler, data, client)
+
+    async def ingest_handler(res: Res, req: Req) -> None:
+        if req.get_method() == "OPTIONS":
+            HTTPHandler(res).done()
+            return
+        query = ingest_query(req.get_query("table"), req.get_query("mode"))
+        upload = Upload()
+
+        def on_data(res: Res, chunk: bytes | None, is_end: bool) -> None:
+            if chunk:
+                upload.feed(chunk)
+            if is_end:
+                upload.finish()
+
+        res.on_data(on_data)
+        res.on_aborted(lambda res: upload.finish(ConnectionError("Upload aborted")))
+        await service.handle(HTTPHandler(res), query, res.get_remote_address(), upload)
+
+    def metrics_handler(res: Res, req: Req) -> None:
+        res.write_header("Content-Type", "text/plain; version=0.0.4")
+        res.end(service.metrics())
+
+    def profiles_handler(res: Res, req: Req) -> None:
+        res.write_header("Content-Type", "application/json")
+        res.end(service.profiles())
+
+    def profile_handler(res: Res, req: Req) -> None:
+        profile_id = req.get_parameter(0)
+        profile = service.profile(profile_id)
+        if profile is None:
+            res.write_status(404)
+            res.end(f"No profile {profile_id}")
+            return
+        res.write_header("Content-Type", "application/json")
+        res.end(profile)
 
     app.ws(
         "/*",
         {
             "compression": CompressOptions.SHARED_COMPRESSOR,
+            "upgrade": ws_upgrade,
             "message": ws_message,
-            "drain": lambda ws: logger.warning(
-                f"WebSocket backpressure: {ws.get_buffered_amount()}"
-            ),
+            "close": ws_close,
+            "drain": ws_drain,
+            "max_backpressure": MAX_BACKPRESSURE,
+            "max_payload_length": MAX_PAYLOAD_LENGTH,
         },
     )
 
+    def preaggs_handler(res: Res, req: Req) -> None:
+        res.write_header("Content-Type", "application/json")
+        res.end(service.preaggregates())
+
     app.any("/", http_handler)
+    app.any("/ingest", ingest_handler)
+    app.get("/metrics", metrics_handler)
+    app.get("/profiles", profiles_handler)
+    app.get("/profiles/:id", profile_handler)
+    app.get("/preaggregates", preaggs_handler)
 
     app.set_error_handler(on_error)
+    # runs before the server opens its port, so the first clients hit the cache
+    app.on_start(service.start)
 
     app.listen(
-        3000,
+        port,
         lambda config: sys.stdout.write(
             f"DuckDB Server listening at ws://localhost:{config.port} and http://localhost:{config.port}\n"
         ),
     )
-    app.run()
+    try:
+        app.run()
+    finally:
+        service.shutdown()
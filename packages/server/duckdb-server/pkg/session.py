@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import re
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from pkg.sql import mentioned_names, session_statements
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    import duckdb
+
+
+class Session:
+    """The state that DuckDB keeps per connection, shared by all commands.
+
+    Each command runs on its own cursor, which DuckDB treats as a separate
+    connection, so settings, variables and temporary objects would only last for
+    the command that made them. Instead, the statements that change settings (SET,
+    RESET and USE) are run again on every new cursor, and temporary tables, views
+    and macros live on a single shared cursor, on which the commands that mention
+    them run one at a time.
+    """
+
+    def __init__(self, con: duckdb.DuckDBPyConnection) -> None:
+        self.con = con
+        self.shared = con.cursor()
+
+        self._settings: list[str] = []
+        self._temporary: set[str] = set()
+        # matches the names of the temporary objects in SQL that does not parse
+        self._mentions: re.Pattern[str] | None = None
+        self._lock = threading.Lock()
+        # the shared cursor runs one command at a time
+        self._using = threading.Lock()
+
+    @contextmanager
+    def cursor(self, sql: str) -> Iterator[duckdb.DuckDBPyConnection]:
+        """A cursor to run `sql` on, with the settings and temporary objects."""
+        temporary, settings = session_statements(sql)
+        if temporary or self.uses_temporary(sql):
+            with self._using:
+                yield self.shared
+        else:
+            with self._lock:
+                replayed = list(self._settings)
+            with self.con.cursor() as cursor:
+                for statement in replayed:
+                    cursor.execute(statement)
+                yield cursor
+
+        # only statements that ran without an error change the session
+        if temporary:
+            self._add_temporary(temporary)
+        if settings:
+            self._add_settings(settings)
+
+    def uses_temporary(self, sql: str) -> bool:
+        """Whether the SQL reads a temporary table or calls a temporary macro."""
+        with self._lock:
+            temporary = self._temporary
+            mentions = self._mentions
+        if mentions is None:
+            return False
+        names = mentioned_names(sql)
+        if names is None:
+            # other statements than queries only have their text to go by
+            return mentions.search(sql) is not None
+        return not names.isdisjoint(temporary)
+
+    def _add_temporary(self, names: frozenset[str]) -> None:
+        with self._lock:
+            # a new set, since others may read the old one without the lock
+            self._temporary = self._temporary | names
+            alternatives = "|".join(map(re.escape, sorted(self._temporary)))
+            self._mentions = re.compile(
+                rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE
+            )
+
+    def _add_settings(self, settings: tuple[str, ...]) -> None:
+        with self._using:
+            for statement in settings:
+                self.shared.execute(statement)
+        with self._lock:
+            for statement in settings:
+                # only the last of the same statements counts
+                if statement in self._settings:
+                    self._settings.remove(statement)
+                self._settings.append(statement)
@@ -0,0 +1,419 @@
+from __future__ import annotations
+
+import glob
+import json
+import logging
+import os
+import re
+import threading
+from functools import cache, lru_cache
+from typing import TYPE_CHECKING, Any
+
+import duckdb
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+# Positions in the SQL text differ with whitespace. Quotes inside string constants
+# are escaped in the JSON, so the pattern cannot match the contents of a string.
+QUERY_LOCATION = re.compile(r',?"query_location":\d+')
+
+_parser = threading.local()
+
+
+@cache
+def _parser_database() -> duckdb.DuckDBPyConnection:
+    # parsing does not touch any data, so a small in-memory database will do
+    return duckdb.connect(config={"threads": 1})
+
+
+def _parser_cursor() -> duckdb.DuckDBPyConnection:
+    if not hasattr(_parser, "cursor"):
+        _parser.cursor = _parser_database().cursor()
+    return _parser.cursor
+
+
+@lru_cache(maxsize=4096)
+def canonical_sql(sql: str) -> str:
+    """The parse tree of a SELECT query, or the SQL text if it is not one.
+
+    Queries that only differ in whitespace, comments, keyword case or identifier
+    quoting have the same parse tree.
+    """
+    try:
+        row = (
+            _parser_cursor()
+            .execute(
+                "SELECT json_serialize_sql(?, skip_empty := true, skip_null := true)",
+                [sql],
+            )
+            .fetchone()
+        )
+    except duckdb.Error:
+        logger.debug("Could not parse query for the cache key", exc_info=True)
+        return sql
+    # other statements and invalid SQL come back as an error object
+    if row is None or row[0].startswith('{"error":true'):
+        return sql
+    return QUERY_LOCATION.sub("", row[0])
+
+
+# A result that depends on any table, or a write that may change any table.
+ANY_TABLE = "*"
+
+EVERYTHING = frozenset((ANY_TABLE,))
+
+# Statements that do not change any data, the catalog, or how names resolve.
+READ_ONLY_STATEMENTS = frozenset(
+    (
+        duckdb.StatementType.SELECT,
+        duckdb.StatementType.EXPLAIN,
+        duckdb.StatementType.PRAGMA,
+        duckdb.StatementType.PREPARE,
+        duckdb.StatementType.TRANSACTION,
+        duckdb.StatementType.LOAD,
+        duckdb.StatementType.EXTENSION,
+        duckdb.StatementType.ANALYZE,
+        duckdb.StatementType.VACUUM,
+        duckdb.StatementType.EXPORT,
+    )
+)
+
+# Parts of the parse tree whose results depend on more than the tables they name,
+# such as table functions like read_parquet and catalog queries like SHOW TABLES.
+OPAQUE_REFS = re.compile(r'"type":"(?:TABLE_FUNCTION|SHOW_REF)"')
+
+_COMMENTS = r"(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/)*"
+_IDENTIFIER = r'(?:"(?:[^"]|"")*"|[^\s."(),;]+)'
+_NAME = rf"(?:{_IDENTIFIER}\s*\.\s*)*{_IDENTIFIER}"
+
+# The object a statement writes to, for the statements that write to one.
+WRITE_TARGETS = [
+    re.compile(pattern, re.IGNORECASE | re.DOTALL)
+    for pattern in (
+        (
+            rf"^{_COMMENTS}(?P<create>CREATE)\s+(?P<replace>OR\s+REPLACE\s+)?"
+            rf"(?:(?:TEMP|TEMPORARY|PERSISTENT)\s+)?(?P<object>\w+)\s+"
+            rf"(?:IF\s+NOT\s+EXISTS\s+)?(?P<name>{_NAME})"
+        ),
+        (
+            rf"^{_COMMENTS}(?:DROP|ALTER)\s+(?P<object>\w+)\s+(?:IF\s+EXISTS\s+)?"
+            rf"(?P<name>{_NAME})"
+        ),
+        (
+            rf"^{_COMMENTS}(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|UPDATE|DELETE\s+FROM"
+            rf"|TRUNCATE(?:\s+TABLE)?|MERGE\s+INTO)\s+(?P<name>{_NAME})"
+        ),
+        rf"^{_COMMENTS}COPY\s+(?P<name>{_NAME})\s*(?:\([^)]*\)\s*)?FROM\b",
+    )
+]
+
+# A file written by COPY ... TO, which queries may read by its name.
+COPY_TO_FILE = re.compile(r"\bTO\s+'((?:[^']|'')*)'", re.IGNORECASE)
+
+TABLE_OBJECTS = frozenset(("table", "view"))
+
+
+# A statement that creates a schema, table or view unless it exists already.
+CREATE_IF_NOT_EXISTS = re.compile(
+    rf"^{_COMMENTS}CREATE\s+(?P<object>SCHEMA|TABLE|VIEW)\s+IF\s+NOT\s+EXISTS\s+"
+    rf"(?P<name>{_NAME})",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+# A statement that creates an object that only exists for its connection.
+CREATE_TEMPORARY = re.compile(
+    rf"^{_COMMENTS}CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP|TEMPORARY)\s+"
+    rf"(?:TABLE|VIEW|MACRO|FUNCTION|SEQUENCE|TYPE)\s+(?:IF\s+NOT\s+EXISTS\s+)?"
+    rf"(?P<name>{_NAME})",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def split_name(name: str) -> tuple[str, ...]:
+    """The unquoted, lowercase identifiers of a possibly qualified name."""
+    identifiers = re.findall(_IDENTIFIER, name) or [name]
+    return tuple(
+        (
+            identifier[1:-1].replace('""', '"')
+            if identifier.startswith('"') and identifier.endswith('"')
+            else identifier
+        ).lower()
+        for identifier in identifiers
+    )
+
+
+def quote(*identifiers: str) -> str:
+    """The identifiers quoted and joined into a possibly qualified name."""
+    return ".".join('"' + part.replace('"', '""') + '"' for part in identifiers)
+
+
+def normalize(name: str) -> str:
+    """The unqualified name of a table or file, for matching reads and writes."""
+    return split_name(name)[-1]
+
+
+@lru_cache(maxsize=1024)
+def created_if_not_exists(sql: str) -> tuple[tuple[str, tuple[str, ...], str], ...]:
+    """The objects the statements create unless they exist, as (kind, name, SQL).
+
+    Empty if any statement does something else, so that running the SQL again
+    may change the database.
+    """
+    try:
+        statements = _parser_cursor().extract_statements(sql)
+    except duckdb.Error:
+        return ()
+
+    created = []
+    for statement in statements:
+        match = CREATE_IF_NOT_EXISTS.match(statement.query)
+        if match is None:
+            return ()
+        created.append(
+            (match["object"].lower(), split_name(match["name"]), statement.query)
+        )
+    return tuple(created)
+
+
+@lru_cache(maxsize=1024)
+def session_statements(sql: str) -> tuple[frozenset[str], tuple[str, ...]]:
+    """The temporary objects the statements create, and the statements that change
+    settings (SET, RESET and USE), which both only apply to their connection.
+    """
+    try:
+        statements = _parser_cursor().extract_statements(sql)
+    except duckdb.Error:
+        return frozenset(), ()
+
+    temporary: set[str] = set()
+    settings: list[str] = []
+    for statement in statements:
+        if statement.type == duckdb.StatementType.SET:
+            settings.append(statement.query.strip())
+        elif match := CREATE_TEMPORARY.match(statement.query):
+            temporary.add(normalize(match["name"]))
+    return frozenset(temporary), tuple(settings)
+
+
+@lru_cache(maxsize=1024)
+def is_select(sql: str) -> bool:
+    """Whether the SQL is a single SELECT statement, which only runs when fetched."""
+    try:
+        statements = _parser_cursor().extract_statements(sql)
+    except duckdb.Error:
+        return False
+    return len(statements) == 1 and statements[0].type == duckdb.StatementType.SELECT
+
+
+def read_tables(con: duckdb.DuckDBPyConnection, sql: str) -> frozenset[str]:
+    """The tables and files a query reads, or `EVERYTHING` if they are unknown.
+
+    Views are expanded to the tables they read.
+    """
+    parsed = canonical_sql(sql)
+    if parsed == sql or OPAQUE_REFS.search(parsed):
+        return EVERYTHING
+    try:
+        tables = con.get_table_names(sql)
+    except duckdb.Error:
+        logger.debug("Could not get the tables of a query", exc_info=True)
+        return EVERYTHING
+    return frozenset(table.lower() for table in tables) or EVERYTHING
+
+
+def read_table_names(
+    con: duckdb.DuckDBPyConnection, sql: str
+) -> frozenset[tuple[str, ...]]:
+    """The qualified names of the tables a query reads, split as by `split_name`.
+
+    Unlike `read_tables`, this includes tables that do not exist, and is empty if
+    DuckDB cannot tell the tables.
+    """
+    try:
+        tables = con.get_table_names(sql, qualified=True)
+    except duckdb.Error:
+        logger.debug("Could not get the tables of a query", exc_info=True)
+        return frozenset()
+    return frozenset(split_name(table) for table in tables)
+
+
+# Characters of a glob pattern, such as read_parquet('data/*.parquet').
+GLOB_CHARACTERS = re.compile(r"[*?[]")
+
+# The query of a view, in the SQL that duckdb_views() reports for it.
+VIEW_QUERY = re.compile(
+    rf"^{_COMMENTS}CREATE\s+(?:OR\s+REPLACE\s+)?(?:(?:TEMP|TEMPORARY)\s+)?VIEW\s+"
+    rf"(?:IF\s+NOT\s+EXISTS\s+)?{_NAME}\s*(?:\([^)]*\)\s*)?AS\s+(?P<query>.*?)[\s;]*$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# views read through views up to this depth are checked for the files they read
+MAX_VIEW_DEPTH = 8
+
+
+def _names(node: Any) -> Iterator[tuple[str, str]]:
+    # the tables and string constants of a parse tree, as ("table" | "value", text)
+    if isinstance(node, dict):
+        if node.get("type") == "BASE_TABLE" and "table_name" in node:
+            yield "table", node["table_name"]
+        value = node.get("value")
+        if (
+            node.get("type") == "VALUE_CONSTANT"
+            and isinstance(value, dict)
+            and value.get("type", {}).get("id") == "VARCHAR"
+            and "value" in value
+        ):
+            yield "value", value["value"]
+        for child in node.values():
+            yield from _names(child)
+    elif isinstance(node, list):
+        for child in node:
+            yield from _names(child)
+
+
+@lru_cache(maxsize=1024)
+def mentioned_names(sql: str) -> frozenset[str] | None:
+    """The lowercase names of the tables and functions a SELECT query mentions.
+
+    None for other statements, whose parse tree DuckDB does not serialize.
+    """
+    parsed = canonical_sql(sql)
+    if parsed == sql:
+        return None
+    return frozenset(_mentions(json.loads(parsed)))
+
+
+def _mentions(node: Any) -> Iterator[str]:
+    if isinstance(node, dict):
+        if node.get("type") == "BASE_TABLE" and "table_name" in node:
+            yield node["table_name"].lower()
+        elif node.get("class") == "FUNCTION" and "function_name" in node:
+            yield node["function_name"].lower()
+        for child in node.values():
+            yield from _mentions(child)
+    elif isinstance(node, list):
+        for child in node:
+            yield from _mentions(child)
+
+
+def _local_source(name: str) -> str | None:
+    if "://" in name:
+        return None
+    path = os.path.abspath(os.path.expanduser(name))
+    if GLOB_CHARACTERS.search(name):
+        return path if glob.glob(path, recursive=True) else None
+    return path if os.path.isfile(path) else None
+
+
+def read_files(con: duckdb.DuckDBPyConnection, sql: str) -> frozenset[str]:
+    """The local files and glob patterns a query reads, also through views.
+
+    Files are found by name, e.g. in `read_parquet('flights.parquet')` or
+    `FROM 'data/*.csv'`, so this may include files that the query only mentions.
+    """
+    sources: set[str] = set()
+    pending = [(sql, 0)]
+    seen: set[str] = set()
+    while pending:
+        text, depth = pending.pop()
+        parsed = canonical_sql(text)
+        if parsed == text:
+            continue
+        for kind, name in _names(json.loads(parsed)):
+            if source := _local_source(name):
+                sources.add(source)
+            elif kind == "table" and depth < MAX_VIEW_DEPTH and name not in seen:
+                seen.add(name)
+                views = con.execute(
+                    "SELECT sql FROM duckdb_views() WHERE lower(view_name) = ?",
+                    [normalize(name)],
+                ).fetchall()
+                pending += [
+                    (match["query"], depth + 1)
+                    for (view,) in views
+                    if (match := VIEW_QUERY.match(view))
+                ]
+    return frozenset(sources)
+
+
+def written_tables(con: duckdb.DuckDBPyConnection, sql: str) -> frozenset[str]:
+    """The tables and files the statements may change, or `EVERYTHING`.
+
+    Invalid SQL does not run, so it writes nothing.
+    """
+    try:
+        statements = con.extract_statements(sql)
+    except duckdb.Error:
+        return frozenset()
+
+    tables: set[str] = set()
+    for statement in statements:
+        if statement.type in READ_ONLY_STATEMENTS or _exists(con, statement.query):
+            continue
+        written = _written_by(statement.type, statement.query)
+        if written is None:
+            return EVERYTHING
+        tables |= written
+    return frozenset(tables)
+
+
+def _exists(con: duckdb.DuckDBPyConnection, sql: str) -> bool:
+    # whether the statement creates an object unless it exists, and it does
+    match = CREATE_IF_NOT_EXISTS.match(sql)
+    if match is None:
+        return False
+    *qualifiers, name = split_name(match["name"])
+
+    if match["object"].lower() == "schema":
+        query = (
+            "SELECT 1 FROM duckdb_schemas() WHERE lower(schema_name) = ? "
+            "AND lower(database_name) = lower(coalesce(?, current_database()))"
+        )
+        values = [name, qualifiers[-1] if qualifiers else None]
+    else:
+        # the (database, schema) that the name may refer to, where None stands for
+        # the current one, and a single qualifier names a schema or a database
+        places: list[tuple[str | None, str | None]] = [(None, None)]
+        if len(qualifiers) == 1:
+            places = [(None, qualifiers[0]), (qualifiers[0], "main")]
+        elif qualifiers:
+            places = [(qualifiers[-2], qualifiers[-1])]
+        query = (
+            "SELECT 1 FROM (SELECT database_name, schema_name, table_name AS name "
+            "FROM duckdb_tables() UNION ALL "
+            "SELECT database_name, schema_name, view_name FROM duckdb_views()) "
+            "WHERE lower(name) = ? AND ("
+            + " OR ".join(
+                "lower(database_name) = lower(coalesce(?, current_database())) "
+                "AND lower(schema_name) = lower(coalesce(?, current_schema()))"
+                for _ in places
+            )
+            + ")"
+        )
+        values = [name, *(part for place in places for part in place)]
+    try:
+        return bool(con.execute(query, values).fetchall())
+    except duckdb.Error:
+        return False
+
+
+def _written_by(kind: duckdb.StatementType, sql: str) -> set[str] | None:
+    if kind == duckdb.StatementType.COPY and (match := COPY_TO_FILE.search(sql)):
+        return {match.group(1).replace("''", "'").lower()}
+
+    for pattern in WRITE_TARGETS:
+        if match := pattern.match(sql):
+            groups = match.groupdict()
+            target = groups.get("object")
+            if target is None or target.lower() in TABLE_OBJECTS:
+                return {normalize(groups["name"])}
+            # Creating a sequence, index or macro does not change earlier results,
+            # but replacing or dropping a macro or schema may change any of them.
+            if groups.get("create") and not groups.get("replace"):
+                return set()
+            return None
+    return None
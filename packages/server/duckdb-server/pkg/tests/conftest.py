@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import duckdb
+import pytest
+from diskcache import Cache
+
+from pkg.cache import ResultCache
+from pkg.executor import QueryExecutor
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> ResultCache:
+    return ResultCache(Cache(tmp_path))
+
+
+@pytest.fixture
+def executor(cache: ResultCache) -> QueryExecutor:
+    return QueryExecutor(duckdb.connect(), cache, workers=2)
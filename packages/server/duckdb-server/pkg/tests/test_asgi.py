@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import io
+import json
+from typing import TYPE_CHECKING, Any
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from pkg.asgi import ASGIApp
+from pkg.core import QueryService
+
+if TYPE_CHECKING:
+    from pkg.cache import ResultCache
+    from pkg.query import _QueryParams
+
+
+@pytest.fixture
+def service(cache: ResultCache) -> QueryService:
+    return QueryService(duckdb.connect(), cache, workers=2)
+
+
+async def call(
+    app: ASGIApp, scope: dict[str, Any], messages: list[dict[str, Any]], answers: int
+) -> list[dict[str, Any]]:
+    """Send the messages to the app, and disconnect once it sent `answers` messages."""
+    sent: list[dict[str, Any]] = []
+    pending = list(messages)
+
+    async def receive() -> dict[str, Any]:
+        if pending:
+            return pending.pop(0)
+        while len(sent) < answers:
+            await asyncio.sleep(0.01)
+        return {"type": f"{scope['type']}.disconnect"}
+
+    async def send(message: dict[str, Any]) -> None:
+        sent.append(message)
+
+    await asyncio.wait_for(app(scope, receive, send), 10)
+    return sent
+
+
+def http(
+    app: ASGIApp,
+    method: str,
+    path: str,
+    body: bytes = b"",
+    query_string: bytes = b"",
+    headers: list[tuple[bytes, bytes]] | None = None,
+) -> tuple[int, dict[bytes, bytes], bytes]:
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": headers or [],
+        "client": ("127.0.0.1", 1234),
+    }
+    request = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = asyncio.run(call(app, scope, request, 0))
+    start, *rest = sent
+    return (
+        start["status"],
+        dict(start["headers"]),
+        b"".join(message["body"] for message in rest),
+    )
+
+
+def post(app: ASGIApp, query: _QueryParams) -> tuple[int, dict[bytes, bytes], bytes]:
+    return http(app, "POST", "/", json.dumps(query).encode())
+
+
+def ipc_stream(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def test_http(service: QueryService) -> None:
+    app = ASGIApp(service)
+
+    status, headers, body = post(app, {"type": "json", "sql": "SELECT 1 AS a"})
+    assert status == 200
+    assert body == b'[{"a":1}]'
+    assert headers[b"content-type"] == b"application/json"
+    assert headers[b"access-control-allow-origin"] == b"*"
+
+    query = json.dumps({"type": "arrow", "sql": "SELECT range AS a FROM range(10)"})
+    _, _, body = http(app, "GET", "/", query_string=f"query={query}".encode())
+    assert pa.ipc.open_stream(body).read_all().num_rows == 10
+
+    status, _, body = post(app, {"type": "json", "sql": "FROM missing"})
+    assert status == 500
+    assert b"missing" in body
+
+    assert http(app, "POST", "/", b"not json")[0] == 400
+    assert http(app, "GET", "/elsewhere")[0] == 404
+    assert http(app, "GET", "/metrics")[0] == 200
+
+
+def test_http_refused(cache: ResultCache) -> None:
+    service = QueryService(duckdb.connect(), cache, max_result_size=1000)
+    app = ASGIApp(service)
+
+    status, _, body = post(app, {"type": "json", "sql": "FROM range(100000)"})
+    assert status == 413
+    assert b"Add a LIMIT" in body
+
+
+def test_sticky_writes(cache: ResultCache) -> None:
+    service = QueryService(duckdb.connect(), cache, workers=2, sticky_writes=True)
+    app = ASGIApp(service)
+
+    # the next request of the client may reach another process
+    status, _, body = post(app, {"type": "exec", "sql": "CREATE TABLE t (a INT)"})
+    assert status == 403
+    assert b"WebSocket" in body
+    status, _, _ = http(app, "POST", "/ingest", ipc_stream(pa.table({"x": [1]})))
+    assert status == 403
+
+    # while the queries of a WebSocket all reach this one
+    messages = [
+        {"type": "websocket.connect"},
+        {
+            "type": "websocket.receive",
+            "text": json.dumps({"type": "exec", "sql": "CREATE TABLE t (a INT)"}),
+        },
+    ]
+    scope = {"type": "websocket", "path": "/", "headers": []}
+    _, sent = asyncio.run(call(app, scope, messages, 2))
+    assert sent["text"] == "{}"
+    assert post(app, {"type": "json", "sql": "SELECT count(*) AS n FROM t"})[2] == (
+        b'[{"n":0}]'
+    )
+
+
+def test_http_compression(service: QueryService) -> None:
+    app = ASGIApp(service)
+    query = {"type": "json", "sql": "SELECT range AS a FROM range(1000)"}
+
+    _, headers, body = http(
+        app,
+        "POST",
+        "/",
+        json.dumps(query).encode(),
+        headers=[(b"accept-encoding", b"gzip")],
+    )
+    assert headers[b"content-encoding"] == b"gzip"
+    assert len(json.loads(gzip.decompress(body))) == 1000
+
+
+def test_http_stream(cache: ResultCache) -> None:
+    service = QueryService(duckdb.connect(), cache, workers=2, stream=True)
+    app = ASGIApp(service)
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "query_string": b"",
+        "headers": [],
+        "client": ("127.0.0.1", 1234),
+    }
+    query = {"type": "arrow", "sql": "SELECT range AS a FROM range(10)", "uuid": ""}
+    request = [{"type": "http.request", "body": json.dumps(query).encode()}]
+    start, *chunks = asyncio.run(call(app, scope, request, 0))
+
+    assert start["status"] == 200
+    assert chunks[-1]["more_body"] is False
+    body = b"".join(chunk["body"] for chunk in chunks)
+    assert pa.ipc.open_stream(body).read_all().num_rows == 10
+
+
+def test_ingest(service: QueryService) -> None:
+    app = ASGIApp(service)
+    data = ipc_stream(pa.table({"x": range(100)}))
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/ingest",
+        "query_string": b"table=uploaded",
+        "headers": [],
+        "client": ("127.0.0.1", 1234),
+    }
+    # the body arrives in parts
+    request = [
+        {"type": "http.request", "body": data[:100], "more_body": True},
+        {"type": "http.request", "body": data[100:], "more_body": False},
+    ]
+    sent = asyncio.run(call(app, scope, request, 0))
+    assert sent[1]["body"] == b'{"rows":100}'
+
+    _, _, body = post(app, {"type": "json", "sql": "SELECT sum(x) AS s FROM uploaded"})
+    assert body == b'[{"s":4950}]'
+
+
+def test_websocket(service: QueryService) -> None:
+    app = ASGIApp(service)
+
+    def text(query: _QueryParams) -> dict[str, Any]:
+        return {"type": "websocket.receive", "text": json.dumps(query)}
+
+    messages = [
+        {"type": "websocket.connect"},
+        text({"type": "exec", "sql": "CREATE TABLE t (a INT)", "uuid": "1"}),
+        text({"type": "ingest", "table": "u", "mode": "create", "uuid": "2"}),
+        {"type": "websocket.receive", "bytes": ipc_stream(pa.table({"x": [1, 2]}))},
+        {"type": "websocket.receive", "bytes": b""},
+        text({"type": "arrow", "sql": "FROM u", "uuid": "3"}),
+        # cancelled before it runs, and still answered in order
+        text({"type": "json", "sql": "SELECT 1", "uuid": "4"}),
+        text({"type": "cancel", "uuid": "4"}),
+        text({"type": "json", "sql": "SELECT 2 AS b", "uuid": "5"}),
+    ]
+    scope = {"type": "websocket", "path": "/", "headers": []}
+    accept, *sent = asyncio.run(call(app, scope, messages, 6))
+
+    assert accept == {"type": "websocket.accept"}
+    assert [message.get("text") for message in sent] == [
+        "{}",
+        '{"rows":2}',
+        None,
+        '{"error":"Query cancelled"}',
+        '[{"b":2}]',
+    ]
+    assert pa.ipc.open_stream(sent[2]["bytes"]).read_all().num_rows == 2
+
+
+def test_websocket_ingest_without_end(service: QueryService) -> None:
+    app = ASGIApp(service)
+    data = ipc_stream(pa.table({"x": [1, 2]}))
+
+    def text(query: _QueryParams) -> dict[str, Any]:
+        return {"type": "websocket.receive", "text": json.dumps(query)}
+
+    messages = [
+        {"type": "websocket.connect"},
+        text({"type": "ingest", "table": "u", "uuid": "1"}),
+        {"type": "websocket.receive", "bytes": data[:10]},
+        # the first upload never ends, which fails it instead of the socket
+        text({"type": "ingest", "table": "v", "uuid": "2"}),
+        {"type": "websocket.receive", "bytes": data},
+        {"type": "websocket.receive", "bytes": b""},
+    ]
+    scope = {"type": "websocket", "path": "/", "headers": []}
+    _, *sent = asyncio.run(call(app, scope, messages, 3))
+
+    assert [message.get("text") for message in sent] == [
+        '{"error":"Upload ended by the next ingest"}',
+        '{"rows":2}',
+    ]
+
+
+def test_lifespan_warms_cache(cache: ResultCache) -> None:
+    service = QueryService(
+        duckdb.connect(),
+        cache,
+        workers=2,
+        warm=[{"type": "json", "sql": "SELECT 1 AS a", "uuid": "", "persist": True}],
+    )
+    app = ASGIApp(service)
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+    sent = asyncio.run(call(app, {"type": "lifespan"}, messages, 2))
+    assert [message["type"] for message in sent] == [
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+    assert service.executor.cache.stats()["entries"] == 1
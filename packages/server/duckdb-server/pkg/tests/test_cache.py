@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import os
+import sys
+from typing import TYPE_CHECKING
+
+import pytest
+from diskcache import Cache
+
+from pkg.cache import DEPENDENCY_KEY, CompressedDisk, ResultCache, file_state
+from pkg.query import get_key, retrieve
+from pkg.sql import EVERYTHING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def disk(tmp_path: Path) -> Cache:
+    return Cache(tmp_path)
+
+
+def test_memory_hit(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    cache.set("a", b"1")
+
+    assert cache.get("a") == b"1"
+    assert cache.get("b") is None
+    assert cache.memory_hits == 1
+    assert cache.misses == 1
+    # not persisted
+    assert "a" not in disk
+
+
+def test_persist_and_disk_hit(disk: Cache) -> None:
+    ResultCache(disk).set("a", b"1", persist=True)
+
+    # a fresh cache (e.g. after a restart) finds the entry on disk
+    cache = ResultCache(disk)
+    assert cache.get("a") == b"1"
+    assert cache.disk_hits == 1
+    # and promotes it to memory
+    assert cache.get("a") == b"1"
+    assert cache.memory_hits == 1
+
+
+def test_persisted_memory_hit_is_written_to_disk(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    cache.set("a", b"1")
+
+    assert cache.get("a", persist=True) == b"1"
+    assert disk["a"] == b"1"
+
+
+def test_persisted_memory_hit_skips_disk(
+    disk: Cache, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = ResultCache(disk)
+    cache.set("a", b"1", persist=True)
+    ResultCache(disk).set("b", b"2", persist=True)
+    assert cache.get("b", persist=True) == b"2"
+
+    def read(*_: object) -> None:
+        raise AssertionError
+
+    # results written to disk, or read from it, are known to be there
+    monkeypatch.setattr(Cache, "__contains__", read)
+    monkeypatch.setattr(Cache, "get", read)
+    assert cache.get("a", persist=True) == b"1"
+    assert cache.get("b", persist=True) == b"2"
+
+
+def test_evicts_least_recently_used_by_size(disk: Cache) -> None:
+    value = b"x" * 100
+    cache = ResultCache(disk, memory_limit=3 * sys.getsizeof(value))
+    cache.set("a", value)
+    cache.set("b", value)
+    cache.set("c", value)
+    cache.get("a")
+    cache.set("d", value)
+
+    assert cache.evictions == 1
+    assert cache.get("b") is None
+    assert cache.get("a") == value
+    assert cache.size <= cache.memory_limit
+
+
+def test_skips_results_larger_than_limit(disk: Cache) -> None:
+    cache = ResultCache(disk, memory_limit=10)
+    cache.set("a", b"x" * 100)
+
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_retrieve_caches_results(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    calls: list[str] = []
+
+    def get(sql: str) -> str:
+        calls.append(sql)
+        return "[]"
+
+    query = {"type": "json", "sql": "SELECT 1", "uuid": "1"}
+    assert retrieve(cache, query, get) == "[]"  # pyright: ignore[reportArgumentType]
+    assert retrieve(cache, query, get) == "[]"  # pyright: ignore[reportArgumentType]
+    assert calls == ["SELECT 1"]
+    assert get_key("SELECT 1", "json") not in disk
+
+
+def test_invalidate_dependent_results(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    cache.set("a", b"1", persist=True, tables={"flights"})
+    cache.set("b", b"2", persist=True, tables={"weather"})
+    cache.set("c", b"3", tables={"flights", "weather"})
+    cache.set("d", b"4")
+    cache.set("e", b"5", persist=True, tables={"flights", "airports"})
+
+    # results that may read any table are dropped as well
+    assert cache.invalidate({"flights"}) == 4
+    assert cache.get("b") == b"2"
+    assert "a" not in disk
+    assert ResultCache(disk).get("e") is None
+    assert len(cache) == 1
+    assert cache.invalidations == 4
+
+    # a result whose mark the cull dropped is not used either
+    cache.set("f", b"6", persist=True, tables={"airports"})
+    del disk[DEPENDENCY_KEY.format(key="f", table="airports")]
+    assert ResultCache(disk).get("f") is None
+
+    # after a restart, the dependencies of persisted results are known from disk
+    fresh = ResultCache(disk)
+    assert fresh.get("b") == b"2"
+    fresh.invalidate({"weather"})
+    assert fresh.get("b") is None
+    assert "b" not in disk
+
+
+def test_shared_disk(disk: Cache, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = ResultCache(disk, shared_tables={"flights"})
+    cache.set("a", b"1", persist=True, tables={"flights"})
+    cache.set("b", b"2", persist=True, tables={"preagg"})
+    cache.set("c", b"3", persist=True)
+
+    # another process only finds the results that read the shared tables
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    other = ResultCache(disk, shared_tables={"flights"})
+    assert other.get("a") == b"1"
+    assert other.get("b") is None
+    assert other.get("c") is None
+    monkeypatch.undo()
+    assert ResultCache(disk, shared_tables={"flights"}).get("b") == b"2"
+
+    # once a process wrote a table of that name, its results are its own
+    other.invalidate({"flights"})
+    other.set("d", b"4", persist=True, tables={"flights"})
+    assert cache.get("d") is None
+    assert other.get("d") == b"4"
+
+
+def test_shared_disk_write_everything(
+    disk: Cache, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = ResultCache(disk, shared_tables={"flights"})
+    cache.set("a", b"1", persist=True, tables={"flights"})
+    cache.set("b", b"2", persist=True, tables={"preagg"})
+
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    other = ResultCache(disk, shared_tables={"flights"})
+    other.set("c", b"3", persist=True, tables={"preagg"})
+    assert other.invalidate(EVERYTHING) == 1
+    assert other.get("a") is None
+    assert other.get("c") is None
+    monkeypatch.undo()
+
+    # the other processes keep their results
+    assert ResultCache(disk, shared_tables={"flights"}).get("a") == b"1"
+    assert ResultCache(disk, shared_tables={"flights"}).get("b") == b"2"
+
+
+def test_invalidate_everything(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    cache.set("a", b"1", persist=True, tables={"flights"})
+
+    assert cache.invalidate(EVERYTHING) == 1
+    assert cache.get("a") is None
+    assert "a" not in disk
+
+
+def test_skips_results_computed_during_a_write(disk: Cache) -> None:
+    cache = ResultCache(disk)
+    epoch = cache.epoch
+    cache.invalidate({"flights"})
+    cache.set("a", b"1", tables={"weather"}, epoch=epoch)
+
+    assert cache.get("a") is None
+
+
+def test_drops_results_of_changed_files(disk: Cache, tmp_path: Path) -> None:
+    (tmp_path / "data").mkdir()
+    path = tmp_path / "data" / "a.csv"
+    path.write_text("x\n1\n")
+    pattern = str(tmp_path / "data" / "*.csv")
+
+    cache = ResultCache(disk)
+    cache.set("a", b"1", persist=True, files=file_state([str(path)]))
+    cache.set("b", b"2", persist=True, files=file_state([pattern]))
+    assert cache.get("a") == b"1"
+
+    # a rewritten file makes the results that read it stale, also on disk
+    path.write_text("x\n1\n2\n")
+    assert cache.get("a") is None
+    assert cache.stale == 1
+    assert "a" not in disk
+    assert ResultCache(disk).get("b") is None
+
+    # as does a new file that matches a pattern
+    cache.set("b", b"2", persist=True, files=file_state([pattern]))
+    assert ResultCache(disk).get("b") == b"2"
+    (tmp_path / "data" / "b.csv").write_text("x\n3\n")
+    assert cache.get("b") is None
+
+
+@pytest.mark.parametrize("codec", ["lz4", "zstd"])
+def test_compressed_disk(tmp_path: Path, codec: str) -> None:
+    value = b"\xff\xff\xff\xff" + b"x" * 100_000
+    text = '[{"a":1}]' * 10_000
+
+    with Cache(tmp_path / "plain") as plain:
+        plain["a"] = value
+        plain_size = plain.volume()
+
+    with Cache(tmp_path / "compressed", disk=CompressedDisk, disk_codec=codec) as disk:
+        disk["a"] = value
+        assert disk.volume() < plain_size
+        disk["b"] = text
+        disk["c"] = {"a", "b"}
+
+        assert disk["a"] == value
+        assert disk["b"] == text
+        assert disk["c"] == {"a", "b"}
+
+    # results written with one codec can be read with any other
+    with Cache(tmp_path / "compressed", disk=CompressedDisk, disk_codec="none") as disk:
+        assert disk["a"] == value
+        disk["d"] = value
+        assert disk["d"] == value
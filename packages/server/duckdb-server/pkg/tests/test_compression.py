@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import gzip
+import zlib
+
+import pyarrow as pa
+import pytest
+
+from pkg.compression import compress, negotiate
+
+
+@pytest.mark.parametrize(
+    ("accept", "coding"),
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("br", None),
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("gzip, deflate", "gzip"),
+        ("deflate", "deflate"),
+        ("gzip;q=0.5, zstd;q=0.1", "gzip"),
+        ("zstd;q=0, *", "gzip"),
+        ("GZIP", "gzip"),
+        ("gzip;q=nope", None),
+    ],
+)
+def test_negotiate(accept: str | None, coding: str | None) -> None:
+    assert negotiate(accept) == coding
+
+
+def test_compress() -> None:
+    body = '[{"a":1}]' * 1000
+    data = body.encode()
+
+    assert gzip.decompress(compress(body, "gzip")) == data
+    assert zlib.decompress(compress(body, "deflate")) == data
+    zstd = compress(data, "zstd")
+    assert pa.decompress(zstd, len(data), codec="zstd", asbytes=True) == data
+    with pytest.raises(ValueError, match="Unsupported content coding"):
+        compress(body, "br")
@@ -0,0 +1,550 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from pkg.executor import (
+    MAX_BYPASSES,
+    Priority,
+    QueryExecutor,
+    Scheduler,
+    ServerBusyError,
+    WriteRefusedError,
+    get_priority,
+)
+from pkg.query import ResultTooLargeError, get_key
+
+if TYPE_CHECKING:
+    from pkg.cache import ResultCache
+    from pkg.executor import _Job
+    from pkg.query import _QueryParams
+
+
+def test_submit(executor: QueryExecutor) -> None:
+    result = asyncio.run(
+        executor.submit({"type": "json", "sql": "SELECT 1 AS a", "uuid": "1"})
+    )
+    assert result == '[{"a":1}]'
+
+
+def test_exec_visible_to_other_cursors(executor: QueryExecutor) -> None:
+    async def run() -> bytes | str | None:
+        await executor.submit(
+            {"type": "exec", "sql": "CREATE TABLE t AS SELECT 1 AS a", "uuid": "1"}
+        )
+        return await executor.submit(
+            {"type": "json", "sql": "SELECT a FROM t", "uuid": "2"}
+        )
+
+    assert asyncio.run(run()) == '[{"a":1}]'
+
+
+def test_session_state(executor: QueryExecutor) -> None:
+    async def run() -> list[bytes | str | None]:
+        return [
+            await executor.submit({"type": "exec", "sql": sql, "uuid": str(i)})
+            if sql.startswith(("CREATE", "SET"))
+            else await executor.submit({"type": "json", "sql": sql, "uuid": str(i)})
+            for i, sql in enumerate(
+                [
+                    "CREATE TEMP TABLE tt AS SELECT 1 AS a",
+                    "SET VARIABLE x = 2",
+                    "SELECT a + getvariable('x') AS b FROM tt",
+                ]
+            )
+        ]
+
+    assert asyncio.run(run())[-1] == '[{"b":3}]'
+
+
+def test_parallel(executor: QueryExecutor) -> None:
+    async def run() -> list[bytes | str | None]:
+        return await asyncio.gather(
+            *(
+                executor.submit(
+                    {"type": "json", "sql": f"SELECT {i} AS a", "uuid": str(i)}
+                )
+                for i in range(4)
+            )
+        )
+
+    assert asyncio.run(run()) == [f'[{{"a":{i}}}]' for i in range(4)]
+
+
+def test_unknown_command(executor: QueryExecutor) -> None:
+    with pytest.raises(ValueError, match="Unknown command"):
+        asyncio.run(executor.submit({"type": "nope", "sql": "SELECT 1", "uuid": "1"}))  # pyright: ignore[reportArgumentType]
+
+
+def test_stream(executor: QueryExecutor) -> None:
+    sql = "SELECT range AS a FROM range(3000000)"
+
+    async def run(persist: bool) -> list[bytes]:
+        query = {"type": "arrow", "sql": sql, "uuid": "1", "persist": persist}
+        return [chunk async for chunk in executor.stream(query)]  # pyright: ignore[reportArgumentType]
+
+    chunks = asyncio.run(run(persist=False))
+    assert len(chunks) > 1
+    assert pa.ipc.open_stream(b"".join(chunks)).read_all().num_rows == 3000000
+    assert executor.cache.get(get_key(sql, "arrow")) is None
+
+    asyncio.run(run(persist=True))
+    assert executor.cache.get(get_key(sql, "arrow")) == b"".join(chunks)
+    # served from the cache as a single chunk
+    assert asyncio.run(run(persist=True)) == [b"".join(chunks)]
+
+
+def test_stream_error(executor: QueryExecutor) -> None:
+    async def run() -> None:
+        query = {"type": "arrow", "sql": "SELECT nope", "uuid": "1"}
+        async for _ in executor.stream(query):  # pyright: ignore[reportArgumentType]
+            pass
+
+    with pytest.raises(duckdb.BinderException):
+        asyncio.run(run())
+
+
+def test_stream_stops_early(executor: QueryExecutor) -> None:
+    async def run() -> bytes:
+        query = {"type": "arrow", "sql": "SELECT * FROM range(10000000)", "uuid": "1"}
+        async for chunk in executor.stream(query):  # pyright: ignore[reportArgumentType]
+            return chunk
+        return b""
+
+    assert asyncio.run(run())
+
+
+def test_coalesce_identical_queries(cache: ResultCache) -> None:
+    calls: list[str] = []
+
+    class CountingExecutor(QueryExecutor):
+        def execute(
+            self, query: _QueryParams, job: _Job | None = None
+        ) -> bytes | str | None:
+            calls.append(query["sql"])
+            return super().execute(query, job)
+
+    executor = CountingExecutor(duckdb.connect(), cache)
+    query: _QueryParams = {"type": "arrow", "sql": "SELECT 1 AS a", "uuid": "1"}
+
+    async def run() -> list[bytes | str | None]:
+        return await asyncio.gather(*(executor.submit(query) for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert calls == ["SELECT 1 AS a"]
+    assert executor.coalesced == 4
+    assert all(result is results[0] for result in results)
+    assert not executor.inflight
+
+
+def test_coalesce_keeps_persist_separate(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache)
+    sql = "SELECT 1 AS a"
+
+    async def run() -> None:
+        await asyncio.gather(
+            executor.submit({"type": "json", "sql": sql, "uuid": "1"}),
+            executor.submit({"type": "json", "sql": sql, "uuid": "2", "persist": True}),
+        )
+
+    asyncio.run(run())
+
+    assert executor.coalesced == 0
+    assert get_key(sql, "json") in cache.disk
+
+
+def test_no_coalescing_across_writes(executor: QueryExecutor) -> None:
+    executor.con.execute("CREATE TABLE t AS SELECT 1 AS a")
+    sql = "SELECT sum(a) AS s FROM t, range(300000000)"
+
+    async def run() -> list[bytes | str | None]:
+        first = asyncio.ensure_future(
+            executor.submit({"type": "json", "sql": sql, "uuid": "1"})
+        )
+        await asyncio.sleep(0.05)
+        await executor.submit(
+            {
+                "type": "exec",
+                "sql": "CREATE OR REPLACE TABLE t AS SELECT 2 AS a",
+                "uuid": "2",
+            }
+        )
+        # the first query still runs on the old table
+        assert not first.done()
+        second = await executor.submit({"type": "json", "sql": sql, "uuid": "3"})
+        return [await first, second]
+
+    assert asyncio.run(run()) == ['[{"s":300000000}]', '[{"s":600000000}]']
+    assert executor.coalesced == 0
+
+
+def test_cancel_running_query(executor: QueryExecutor) -> None:
+    query: _QueryParams = {
+        "type": "json",
+        "sql": "SELECT count(*) FROM range(100000000000)",
+        "uuid": "1",
+    }
+
+    async def run() -> None:
+        task = asyncio.ensure_future(executor.submit(query))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the worker is free again for the next query
+        assert await asyncio.wait_for(
+            executor.submit({"type": "json", "sql": "SELECT 1 AS a", "uuid": "2"}), 5
+        )
+
+    asyncio.run(run())
+    assert not executor.inflight
+
+
+def test_cancelled_query_keeps_its_worker(cache: ResultCache) -> None:
+    con = duckdb.connect()
+    # DuckDB cannot interrupt a Python function while it runs
+    con.create_function("nap", lambda s: time.sleep(s) or s, [float], float)
+    executor = QueryExecutor(con, cache, workers=1)
+
+    async def run() -> int:
+        query: _QueryParams = {"type": "json", "sql": "SELECT nap(0.5)", "uuid": "1"}
+        task = asyncio.ensure_future(executor.submit(query))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        free = executor.scheduler.free
+        await asyncio.wait_for(
+            executor.submit({"type": "json", "sql": "SELECT 1 AS a", "uuid": "2"}), 5
+        )
+        return free
+
+    assert asyncio.run(run()) == 0
+
+
+def test_cancel_keeps_shared_query(executor: QueryExecutor) -> None:
+    sql = "SELECT count(*) AS n FROM range(20000000)"
+
+    async def run() -> bytes | str | None:
+        first = asyncio.ensure_future(
+            executor.submit({"type": "json", "sql": sql, "uuid": "1"})
+        )
+        second = asyncio.ensure_future(
+            executor.submit({"type": "json", "sql": sql, "uuid": "2"})
+        )
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == '[{"n":20000000}]'
+
+
+def test_submit_batch(executor: QueryExecutor) -> None:
+    queries: list[_QueryParams] = [
+        {"type": "json", "sql": "SELECT 1 AS a", "uuid": "1"},
+        {"type": "exec", "sql": "CREATE TABLE t AS SELECT 2 AS a", "uuid": "2"},
+        {"type": "json", "sql": "SELECT a FROM t", "uuid": "3"},
+        {"type": "json", "sql": "SELECT nope", "uuid": "4"},
+    ]
+
+    results = asyncio.run(executor.submit_batch(queries))
+
+    assert results[:3] == ['[{"a":1}]', None, '[{"a":2}]']
+    assert isinstance(results[3], duckdb.BinderException)
+
+
+def test_refuse_writes(executor: QueryExecutor) -> None:
+    def submit(sql: str, writes: bool = False) -> bytes | str | None:
+        query: _QueryParams = {"type": "exec", "sql": sql, "uuid": "1"}
+        return asyncio.run(executor.submit(query, writes=writes))
+
+    submit("CREATE TABLE t (a INT)", writes=True)
+    submit("CREATE SCHEMA mosaic; CREATE TABLE mosaic.p AS SELECT 1 AS n", writes=True)
+
+    # a command that changes nothing is not a write
+    assert submit("CREATE TABLE IF NOT EXISTS t (a INT)") is None
+    for sql in (
+        "CREATE TABLE u (a INT)",
+        "SET threads = 2",
+        # pre-aggregated tables only exist in the process that created them
+        "CREATE TABLE IF NOT EXISTS mosaic.p AS SELECT 1 AS n",
+    ):
+        with pytest.raises(WriteRefusedError):
+            submit(sql)
+
+
+def test_get_priority() -> None:
+    assert get_priority({"type": "json", "sql": "", "uuid": "1"}) == Priority.NORMAL
+    assert get_priority({"type": "exec", "sql": "", "uuid": "1"}) == Priority.LOW
+    assert get_priority({"type": "exec", "sql": "", "uuid": "1", "priority": 0}) == 0
+    assert get_priority({"type": "json", "sql": "", "uuid": "1", "priority": -5}) == 0
+    assert get_priority({"type": "json", "sql": "", "uuid": "1", "priority": 99}) == 2
+    with pytest.raises(TypeError, match="Invalid priority"):
+        get_priority({"type": "json", "sql": "", "uuid": "1", "priority": "high"})  # pyright: ignore[reportArgumentType]
+
+
+def test_scheduler_order() -> None:
+    order: list[str] = []
+
+    async def run() -> None:
+        scheduler = Scheduler(1)
+        await scheduler.acquire(Priority.NORMAL)
+
+        async def wait(name: str, priority: int, client: str) -> None:
+            await scheduler.acquire(priority, client)
+            order.append(name)
+            scheduler.release()
+
+        waiters = [
+            asyncio.ensure_future(wait(name, priority, client))
+            for name, priority, client in [
+                ("a-exec-1", Priority.LOW, "a"),
+                ("a-exec-2", Priority.LOW, "a"),
+                ("a-1", Priority.NORMAL, "a"),
+                ("a-2", Priority.NORMAL, "a"),
+                ("a-3", Priority.NORMAL, "a"),
+                ("b-1", Priority.NORMAL, "b"),
+                ("b-2", Priority.NORMAL, "b"),
+                ("c-brush", Priority.HIGH, "c"),
+            ]
+        ]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*waiters)
+        assert scheduler.free == 1
+
+    asyncio.run(run())
+
+    # by priority, and taking turns between clients within a priority
+    assert order == [
+        "c-brush",
+        "a-1",
+        "b-1",
+        "a-2",
+        "b-2",
+        "a-3",
+        "a-exec-1",
+        "a-exec-2",
+    ]
+
+
+def test_scheduler_low_priority_does_not_starve() -> None:
+    async def run() -> int:
+        scheduler = Scheduler(1)
+        await scheduler.acquire(Priority.NORMAL)
+        low = asyncio.ensure_future(scheduler.acquire(Priority.LOW, "writer"))
+        await asyncio.sleep(0)
+
+        # normal queries keep arriving, and each one finishes after the next arrived
+        runs = 0
+        while not low.done():
+            normal = asyncio.ensure_future(scheduler.acquire(Priority.NORMAL, "a"))
+            await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.sleep(0)
+            if normal.done():
+                runs += 1
+            else:
+                normal.cancel()
+        return runs
+
+    assert asyncio.run(run()) == MAX_BYPASSES
+
+
+def test_scheduler_cancelled_waiter() -> None:
+    async def run() -> None:
+        scheduler = Scheduler(1)
+        await scheduler.acquire(Priority.NORMAL)
+
+        waiter = asyncio.ensure_future(scheduler.acquire(Priority.NORMAL, "a"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert not scheduler.waiting
+
+        scheduler.release()
+        # the slot is free again instead of going to the cancelled waiter
+        await asyncio.wait_for(scheduler.acquire(Priority.NORMAL, "b"), 1)
+
+    asyncio.run(run())
+
+
+def test_scheduler_max_queued() -> None:
+    async def run() -> None:
+        scheduler = Scheduler(1, max_queued=1)
+        await scheduler.acquire(Priority.NORMAL)
+        waiter = asyncio.ensure_future(scheduler.acquire(Priority.NORMAL, "a"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(ServerBusyError):
+            await scheduler.acquire(Priority.NORMAL, "b")
+        assert scheduler.rejected == 1
+
+        # once the waiter runs, the queue has room again
+        scheduler.release()
+        await waiter
+        queued = asyncio.ensure_future(scheduler.acquire(Priority.NORMAL, "b"))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+        queued.cancel()
+
+    asyncio.run(run())
+
+
+def test_timeout(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache, workers=1, timeouts={"*": 0.2})
+    slow = "SELECT count(*) FROM range(100000000000)"
+
+    async def run() -> bytes | str | None:
+        with pytest.raises(TimeoutError):
+            await executor.submit({"type": "json", "sql": slow, "uuid": "1"})
+        # the worker is free again for the next query
+        return await asyncio.wait_for(
+            executor.submit({"type": "json", "sql": "SELECT 1 AS a", "uuid": "2"}), 5
+        )
+
+    assert asyncio.run(run()) == '[{"a":1}]'
+    assert executor.timed_out == 1
+
+
+def test_max_result_size(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache, max_result_size=100_000)
+
+    def submit(sql: str, command: str) -> bytes | str | None:
+        return asyncio.run(executor.submit({"type": command, "sql": sql, "uuid": "1"}))
+
+    # rejected by the planner's estimate before the query runs
+    with pytest.raises(ResultTooLargeError, match="about"):
+        submit("SELECT range AS a FROM range(1000000)", "arrow")
+    # the planner has no estimate of a limit, but the encoded result is too large
+    with pytest.raises(ResultTooLargeError, match="more than"):
+        submit("SELECT range AS a FROM range(1000000) LIMIT 500000", "json")
+    assert executor.too_large == 2
+    assert (
+        submit("SELECT count(*) AS n FROM range(1000000)", "json") == '[{"n":1000000}]'
+    )
+
+    # binding a statement other than a SELECT runs it, so it is not estimated
+    executor.con.execute("CREATE TABLE t (a INT)")
+    for command in ("arrow", "json"):
+        submit("INSERT INTO t VALUES (1) RETURNING a", command)
+    assert executor.con.execute("SELECT count(*) FROM t").fetchone() == (2,)
+
+
+def test_priority_across_clients(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache, workers=1)
+    slow = "SELECT count(*) AS n FROM range(50000000)"
+
+    async def run() -> list[str]:
+        done: list[str] = []
+
+        async def submit(query: _QueryParams, client: str) -> None:
+            await executor.submit(query, client)
+            done.append(query["uuid"])
+
+        tasks = [
+            asyncio.ensure_future(
+                submit({"type": "json", "sql": slow, "uuid": "busy"}, "a")
+            )
+        ]
+        await asyncio.sleep(0)
+        tasks += [
+            asyncio.ensure_future(
+                submit(
+                    {
+                        "type": "exec",
+                        "sql": f"SET VARIABLE v{i} = {i}",
+                        "uuid": f"exec-{i}",
+                    },
+                    "a",
+                )
+            )
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        tasks.append(
+            asyncio.ensure_future(
+                submit(
+                    {
+                        "type": "json",
+                        "sql": "SELECT 1 AS a",
+                        "uuid": "brush",
+                        "priority": 0,
+                    },
+                    "b",
+                )
+            )
+        )
+        await asyncio.gather(*tasks)
+        return done
+
+    assert asyncio.run(run()) == ["busy", "brush", "exec-0", "exec-1", "exec-2"]
+
+
+def test_exec_invalidates_dependent_results(executor: QueryExecutor) -> None:
+    async def query(sql: str, persist: bool = False) -> bytes | str | None:
+        return await executor.submit(
+            {"type": "json", "sql": sql, "uuid": "1", "persist": persist}
+        )
+
+    async def run() -> list[bytes | str | None]:
+        await executor.submit(
+            {"type": "exec", "sql": "CREATE TABLE t AS SELECT 1 AS a", "uuid": "1"}
+        )
+        await executor.submit(
+            {"type": "exec", "sql": "CREATE TABLE u AS SELECT 1 AS b", "uuid": "1"}
+        )
+        before = [await query("SELECT a FROM t", persist=True), await query("FROM u")]
+        await executor.submit(
+            {
+                "type": "exec",
+                "sql": "CREATE OR REPLACE TABLE t AS SELECT 2 AS a",
+                "uuid": "1",
+            }
+        )
+        return [*before, await query("SELECT a FROM t", persist=True)]
+
+    assert asyncio.run(run()) == ['[{"a":1}]', '[{"b":1}]', '[{"a":2}]']
+    # the result for the other table is still cached
+    assert executor.cache.get(get_key("FROM u", "json")) == '[{"b":1}]'
+    assert executor.cache.invalidations == 1
+
+    # creating an existing table unless it exists, as Mosaic's clients do on
+    # every page load, keeps the results that read it
+    asyncio.run(
+        executor.submit(
+            {
+                "type": "exec",
+                "sql": "CREATE TABLE IF NOT EXISTS u AS SELECT 2 AS b",
+                "uuid": "1",
+            }
+        )
+    )
+    assert executor.cache.get(get_key("FROM u", "json")) == '[{"b":1}]'
+    assert executor.cache.invalidations == 1
+
+
+def test_params(executor: QueryExecutor) -> None:
+    sql = "SELECT $1 + 1 AS a"
+
+    async def run() -> list[bytes | str | None]:
+        return await asyncio.gather(
+            *(
+                executor.submit({"type": "json", "sql": sql, "uuid": "1", "params": p})
+                for p in ([1], [2], [1])
+            )
+        )
+
+    assert asyncio.run(run()) == ['[{"a":2}]', '[{"a":3}]', '[{"a":2}]']
+    # only queries with the same values share a result
+    assert executor.coalesced == 1
+    with pytest.raises(TypeError, match="Invalid params"):
+        asyncio.run(
+            executor.submit({"type": "json", "sql": sql, "uuid": "1", "params": 1})  # pyright: ignore[reportArgumentType]
+        )
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import TYPE_CHECKING
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from pkg.executor import QueryExecutor
+from pkg.ingest import Upload
+from pkg.query import get_key
+
+if TYPE_CHECKING:
+    from pkg.cache import ResultCache
+
+
+def ipc_stream(rows: int, start: int = 0) -> bytes:
+    table = pa.table({"a": pa.array(range(start, start + rows), pa.int64())})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=1000):
+            writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def test_upload_reads_as_bytes_arrive() -> None:
+    upload = Upload()
+
+    def send() -> None:
+        for chunk in (b"ab", b"cde", b"f"):
+            upload.feed(chunk)
+        upload.finish()
+
+    threading.Thread(target=send).start()
+
+    assert upload.read(4) == b"abcd"
+    assert upload.read() == b"ef"
+    assert upload.read(1) == b""
+
+
+def test_upload_error() -> None:
+    upload = Upload()
+    upload.feed(b"ab")
+    upload.finish(ConnectionError("gone"))
+
+    with pytest.raises(ConnectionError):
+        upload.read(4)
+
+
+def ingest(
+    executor: QueryExecutor, data: bytes, mode: str = "create", chunk: int = 4096
+) -> int:
+    async def run() -> int:
+        upload = Upload()
+        task = asyncio.ensure_future(
+            executor.ingest(
+                {"type": "ingest", "sql": "", "uuid": "1", "table": "t", "mode": mode},  # pyright: ignore[reportArgumentType]
+                upload,
+            )
+        )
+        # the worker writes batches while the upload arrives
+        for i in range(0, len(data), chunk):
+            upload.feed(data[i : i + chunk])
+            await asyncio.sleep(0)
+        upload.finish()
+        return await task
+
+    return asyncio.run(run())
+
+
+def test_ingest(executor: QueryExecutor) -> None:
+    sql = "SELECT count(*) AS n FROM t"
+
+    assert ingest(executor, ipc_stream(10_000)) == 10_000
+    assert asyncio.run(executor.submit({"type": "json", "sql": sql, "uuid": "1"})) == (
+        '[{"n":10000}]'
+    )
+
+    assert ingest(executor, ipc_stream(500, start=10_000), mode="append") == 500
+    # the cached result of the table is gone
+    assert executor.cache.get(get_key(sql, "json")) is None
+    assert executor.con.execute("SELECT max(a) FROM t").fetchone() == (10_499,)
+
+    assert ingest(executor, ipc_stream(5), mode="replace") == 5
+    with pytest.raises(duckdb.CatalogException):
+        ingest(executor, ipc_stream(5))
+
+
+def test_ingest_errors(executor: QueryExecutor) -> None:
+    with pytest.raises(ValueError, match="Unsupported ingest mode"):
+        ingest(executor, ipc_stream(5), mode="upsert")
+    with pytest.raises(pa.ArrowInvalid):
+        ingest(executor, b"not an arrow stream")
+
+
+def test_ingest_timeout(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache, timeouts={"ingest": 0.2})
+
+    async def run() -> int:
+        upload = Upload()
+        # the rest of the stream never arrives
+        upload.feed(ipc_stream(10_000)[:1000])
+        query = {"type": "ingest", "sql": "", "uuid": "1", "table": "t"}
+        return await asyncio.wait_for(executor.ingest(query, upload), 5)  # pyright: ignore[reportArgumentType]
+
+    with pytest.raises(TimeoutError, match=r"timed out after 0\.2 seconds"):
+        asyncio.run(run())
+    assert executor.timed_out == 1
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import duckdb
+import pytest
+
+from pkg.launch import connect_read_only, create_service, split_resources
+from pkg.options import parse_args
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_connect_read_only(tmp_path: Path) -> None:
+    database = str(tmp_path / "data.db")
+    with duckdb.connect(database) as con:
+        con.execute("CREATE TABLE flights AS SELECT 1 AS a")
+        con.execute("CREATE SCHEMA s")
+        con.execute("CREATE VIEW s.v AS SELECT a + 1 AS b FROM flights")
+
+    con = connect_read_only(database, {})
+    # other processes may open the file at the same time
+    with duckdb.connect(database, read_only=True) as other:
+        assert other.execute("FROM flights").fetchall() == [(1,)]
+
+    # the file's tables are visible to every cursor under their usual names
+    cursor = con.cursor()
+    assert cursor.execute("FROM flights").fetchall() == [(1,)]
+    assert cursor.execute("FROM s.v").fetchall() == [(2,)]
+    assert cursor.execute("FROM data.flights").fetchall() == [(1,)]
+
+    # writes to the file fail, other writes stay in memory
+    with pytest.raises(duckdb.Error):
+        cursor.execute("INSERT INTO data.flights VALUES (2)")
+    cursor.execute("CREATE SCHEMA mosaic")
+    cursor.execute("CREATE TABLE mosaic.preagg AS SELECT count(*) AS n FROM flights")
+    assert con.cursor().execute("FROM mosaic.preagg").fetchall() == [(1,)]
+
+
+def test_split_resources() -> None:
+    args = parse_args(["--processes", "4", "--memory-limit", "1GB"])
+    split_resources(args)
+
+    assert args.threads >= 1
+    assert args.memory_limit == "1GB"
+    # the processes share the persistent cache
+    assert args.cache_dir is not None
+
+
+def test_create_service_shares_file_tables(tmp_path: Path) -> None:
+    database = str(tmp_path / "data.db")
+    with duckdb.connect(database) as con:
+        con.execute("CREATE TABLE flights AS SELECT 1 AS a")
+
+    args = parse_args([database, "--processes", "2", "--cache-dir", str(tmp_path)])
+    service = create_service(args)
+    assert service.executor.cache.shared_tables == {"flights"}
+    assert service.sticky_writes
+    service.shutdown()
+
+    # without a file, every process has its own tables
+    args = parse_args(["--processes", "2", "--cache-dir", str(tmp_path)])
+    service = create_service(args)
+    assert service.executor.cache.shared_tables == set()
+    service.shutdown()
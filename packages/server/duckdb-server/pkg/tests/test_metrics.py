@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+from pkg import metrics
+from pkg.metrics import Counter, Gauge, Histogram, Registry
+
+if TYPE_CHECKING:
+    from pkg.executor import QueryExecutor
+
+
+def test_render() -> None:
+    registry = Registry()
+    counter = registry.register(Counter("requests_total", "Requests."))
+    gauge = registry.register(Gauge("in_flight", "In flight."))
+    counter.inc(command="arrow")
+    counter.inc(2, command="arrow")
+    counter.inc(command='say "hi"')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert registry.render() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{command="arrow"} 3\n'
+        'requests_total{command="say \\"hi\\""} 1\n'
+        "# HELP in_flight In flight.\n"
+        "# TYPE in_flight gauge\n"
+        "in_flight 1\n"
+    )
+
+
+def test_histogram() -> None:
+    registry = Registry()
+    histogram = registry.register(Histogram("latency", "Latency.", buckets=(0.1, 1)))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, command="json")
+
+    assert histogram.get(command="json") == 4
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{command="json",le="0.1"} 2',
+        'latency_bucket{command="json",le="1"} 3',
+        'latency_bucket{command="json",le="+Inf"} 4',
+        'latency_sum{command="json"} 3.65',
+        'latency_count{command="json"} 4',
+    ]
+
+
+def test_collect_from_cache_and_executor(executor: QueryExecutor) -> None:
+    metrics.collect_from(executor.cache, executor)
+
+    query = {"type": "json", "sql": "SELECT 1 AS a", "uuid": "1"}
+    asyncio.run(executor.submit(query))  # pyright: ignore[reportArgumentType]
+    asyncio.run(executor.submit(query))  # pyright: ignore[reportArgumentType]
+
+    text = metrics.REGISTRY.render()
+    assert 'duckdb_server_cache_hits_total{tier="memory"} 1' in text
+    assert "duckdb_server_cache_misses_total 1" in text
+    assert "duckdb_server_cache_entries 1" in text
+
+
+def test_command_label() -> None:
+    assert metrics.command_label("arrow") == "arrow"
+    assert metrics.command_label("DROP TABLE x") == "unknown"
+    assert metrics.command_label(["arrow"]) == "unknown"
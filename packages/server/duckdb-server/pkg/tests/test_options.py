@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import argparse
+import os
+
+import pytest
+
+from pkg.options import parse_args, parse_size, parse_timeout
+
+
+def test_parse_size() -> None:
+    assert parse_size("1000") == 1000
+    assert parse_size("512MB") == 512 * 1024**2
+    assert parse_size("4GiB") == 4 * 1024**3
+    assert parse_size("2 kb") == 2048
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_size("lots")
+
+
+def test_parse_timeout() -> None:
+    assert parse_timeout("30") == ("*", 30)
+    assert parse_timeout("exec=1.5") == ("exec", 1.5)
+    for value in ("0", "soon", "batch=10"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_timeout(value)
+
+
+def test_defaults() -> None:
+    args = parse_args([])
+
+    assert args.database == ":memory:"
+    assert args.port == 3000
+    assert args.processes == 1
+    assert args.threads is None
+    assert args.cache_dir is None
+    assert args.cache_size == 1024**3
+    assert args.cache_compression == "zstd"
+    assert args.warm == []
+    assert args.warm_interval is None
+    assert args.timeout == []
+    assert args.max_queued is None
+    assert args.max_result_size is None
+
+
+def test_arguments() -> None:
+    args = parse_args(
+        ["data.db", "--port", "4000", "--threads", "4", "--memory-limit", "2GB"]
+    )
+
+    assert args.database == "data.db"
+    assert args.port == 4000
+    assert args.threads == 4
+    assert args.memory_limit == "2GB"
+
+
+def test_environment(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("DUCKDB_SERVER_PORT", "4000")
+    monkeypatch.setenv("DUCKDB_SERVER_CACHE_SIZE", "10MB")
+    monkeypatch.setenv("DUCKDB_SERVER_LOG_LEVEL", "info")
+
+    args = parse_args([])
+    assert args.port == 4000
+    assert args.cache_size == 10 * 1024**2
+    assert args.log_level == "INFO"
+
+    monkeypatch.setenv("DUCKDB_SERVER_WARM", f"a.sql{os.pathsep}b.json")
+    assert parse_args(["--warm", "c.sql"]).warm == ["a.sql", "b.json", "c.sql"]
+
+    monkeypatch.setenv("DUCKDB_SERVER_TIMEOUT", "60,exec=600")
+    assert dict(parse_args([]).timeout) == {"*": 60, "exec": 600}
+
+    # arguments take precedence over the environment
+    assert parse_args(["--port", "5000"]).port == 5000
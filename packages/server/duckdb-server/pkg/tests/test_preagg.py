@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import TYPE_CHECKING
+
+import duckdb
+import pyarrow as pa
+
+from pkg.executor import QueryExecutor
+from pkg.preagg import PreAggregates
+
+if TYPE_CHECKING:
+    from pkg.cache import ResultCache
+    from pkg.query import _QueryParams
+
+
+def create(table: str, rows: int = 1000) -> str:
+    # as sent by Mosaic's PreAggregator
+    return (
+        "CREATE SCHEMA IF NOT EXISTS mosaic;\n"
+        f'CREATE TABLE IF NOT EXISTS "mosaic"."{table}" AS '
+        f"SELECT range AS x, count(*) AS n FROM range({rows}) GROUP BY x"
+    )
+
+
+def make_executor(cache: ResultCache, budget: int | None = None) -> QueryExecutor:
+    return QueryExecutor(
+        duckdb.connect(),
+        cache,
+        workers=2,
+        preaggs=PreAggregates(budget=budget),
+    )
+
+
+def run(executor: QueryExecutor, *sqls: str) -> list[bytes | str | None]:
+    async def submit() -> list[bytes | str | None]:
+        return [
+            await executor.submit(
+                {
+                    "type": "exec" if sql.startswith("CREATE") else "json",
+                    "sql": sql,
+                    "uuid": "1",
+                }
+            )
+            for sql in sqls
+        ]
+
+    return asyncio.run(submit())
+
+
+def tables(executor: QueryExecutor) -> set[str]:
+    rows = executor.con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE schema_name = 'mosaic'"
+    ).fetchall()
+    return {name for (name,) in rows}
+
+
+def test_created_tables() -> None:
+    preaggs = PreAggregates()
+
+    assert preaggs.created_tables(create("preagg_1")) == [
+        ("preagg_1", create("preagg_1").split(";")[1])
+    ]
+    assert preaggs.created_tables("CREATE TABLE mosaic.t AS SELECT 1") is None
+    assert preaggs.created_tables("CREATE TABLE IF NOT EXISTS t AS SELECT 1") is None
+
+
+def test_skips_existing_tables(cache: ResultCache) -> None:
+    executor = make_executor(cache)
+    query = 'SELECT sum(n) AS n FROM "mosaic"."preagg_1"'
+
+    run(executor, create("preagg_1"), query, create("preagg_1"), create("preagg_1"))
+
+    assert executor.preaggs.deduplicated == 2
+    # the repeated creation did not invalidate the result
+    assert executor.cache.invalidations == 0
+    assert [t["name"] for t in executor.preaggs.list()] == ["preagg_1"]
+
+
+def test_evicts_and_rebuilds_within_budget(cache: ResultCache) -> None:
+    # room for two of the tables of 1000 rows of two BIGINTs
+    executor = make_executor(cache, budget=40_000)
+
+    run(executor, create("preagg_1"), create("preagg_2"))
+    run(executor, 'SELECT sum(n) AS n FROM "mosaic"."preagg_1"')
+    run(executor, create("preagg_3"))
+
+    # the least recently used table was dropped
+    assert tables(executor) == {"preagg_1", "preagg_3"}
+    stats = executor.preaggs.stats()
+    assert (stats["tables"], stats["evicted"], stats["evictions"]) == (2, 1, 1)
+    assert stats["bytes"] <= 40_000
+
+    # and comes back when a query reads it
+    result = run(executor, 'SELECT sum(n) AS n FROM "mosaic"."preagg_2"')
+    assert json.loads(result[0]) == [{"n": 1000}]  # pyright: ignore[reportArgumentType]
+    assert executor.preaggs.rebuilds == 1
+    assert "preagg_2" in tables(executor)
+    assert len(tables(executor)) == 2
+
+
+def test_forgets_dropped_schema(cache: ResultCache) -> None:
+    executor = make_executor(cache, budget=20_000)
+
+    run(executor, create("preagg_1"), create("preagg_2"))
+    asyncio.run(
+        executor.submit(
+            {
+                "type": "exec",
+                "sql": 'DROP SCHEMA IF EXISTS "mosaic" CASCADE',
+                "uuid": "1",
+            }
+        )
+    )
+
+    assert executor.preaggs.list() == []
+    # the creation runs again rather than being skipped
+    run(executor, create("preagg_1"))
+    assert tables(executor) == {"preagg_1"}
+
+
+def test_use_reads_table_names(cache: ResultCache) -> None:
+    # room for one table
+    executor = make_executor(cache, budget=20_000)
+
+    run(executor, create("preagg_1"), create("preagg_12"))
+    assert tables(executor) == {"preagg_12"}
+
+    # a longer name that starts with the dropped table's does not rebuild it
+    run(executor, "SELECT sum(n) AS n FROM mosaic.preagg_12")
+    assert executor.preaggs.rebuilds == 0
+
+    # while a quoted name in other case does
+    result = run(executor, 'SELECT sum(n) AS n FROM "MOSAIC"."PREAGG_1"')
+    assert json.loads(result[0]) == [{"n": 1000}]  # pyright: ignore[reportArgumentType]
+    assert executor.preaggs.rebuilds == 1
+
+
+def test_stream_rebuilds_dropped_table(cache: ResultCache) -> None:
+    executor = make_executor(cache, budget=20_000)
+    run(executor, create("preagg_1"), create("preagg_2"))
+    assert tables(executor) == {"preagg_2"}
+
+    # the table is dropped again between the rebuild and the query
+    use = executor.preaggs.use
+    calls: list[str] = []
+
+    def use_later(cursor: duckdb.DuckDBPyConnection, sql: str) -> bool:
+        calls.append(sql)
+        return len(calls) > 1 and use(cursor, sql)
+
+    executor.preaggs.use = use_later  # pyright: ignore[reportAttributeAccessIssue]
+
+    async def stream() -> bytes:
+        query: _QueryParams = {
+            "type": "arrow",
+            "sql": 'SELECT sum(n) AS n FROM "mosaic"."preagg_1"',
+            "uuid": "1",
+        }
+        return b"".join([chunk async for chunk in executor.stream(query)])
+
+    result = pa.ipc.open_stream(asyncio.run(stream())).read_all()
+    assert result.to_pylist() == [{"n": 1000}]
+    assert len(calls) == 2
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+import duckdb
+
+from pkg.executor import QueryExecutor
+from pkg.profiles import Profiler
+
+if TYPE_CHECKING:
+    from pkg.cache import ResultCache
+    from pkg.query import _QueryParams
+
+
+def run(executor: QueryExecutor, *queries: _QueryParams) -> None:
+    async def submit() -> None:
+        for query in queries:
+            await executor.submit(query)
+
+    asyncio.run(submit())
+
+
+def test_profiles_slow_queries(cache: ResultCache) -> None:
+    profiler = Profiler(threshold=0)
+    executor = QueryExecutor(duckdb.connect(), cache, profiler=profiler)
+    query: _QueryParams = {
+        "type": "json",
+        "sql": "SELECT count(*) AS n FROM range(1000)",
+        "uuid": "1",
+    }
+
+    # the second query is answered from the cache, so there is nothing to profile
+    run(executor, query, query)
+
+    [summary] = profiler.list()
+    assert summary["sql"] == query["sql"]
+    assert not summary["sampled"]
+    profile = profiler.get(summary["id"])
+    assert profile is not None
+    assert profile["profile"]["rows_returned"] == 1
+    assert profile["profile"]["children"]
+
+
+def test_profiles_exec_of_pre_aggregated_table(cache: ResultCache) -> None:
+    profiler = Profiler(threshold=0)
+    executor = QueryExecutor(duckdb.connect(), cache, profiler=profiler)
+    sql = "CREATE TABLE IF NOT EXISTS mosaic.t AS SELECT range AS a FROM range(10)"
+    run(
+        executor,
+        {"type": "exec", "sql": "CREATE SCHEMA mosaic", "uuid": "1"},
+        {"type": "exec", "sql": sql, "uuid": "2"},
+    )
+
+    # the profile is the statement's, not the one of recording the table's size
+    summary = profiler.list()[0]
+    assert summary["sql"] == sql
+    profile = profiler.get(summary["id"])
+    assert profile is not None
+    assert profile["profile"]["query_name"] == sql
+
+
+def test_profiles_off_by_default(cache: ResultCache) -> None:
+    executor = QueryExecutor(duckdb.connect(), cache)
+    run(executor, {"type": "json", "sql": "SELECT 1", "uuid": "1"})
+
+    assert not executor.profiler.enabled
+    assert executor.profiler.list() == []
+
+
+def test_sampled_profiles_rotate(cache: ResultCache) -> None:
+    profiler = Profiler(sample=1, capacity=2)
+    executor = QueryExecutor(duckdb.connect(), cache, profiler=profiler)
+    run(
+        executor,
+        *({"type": "json", "sql": f"SELECT {i}", "uuid": "1"} for i in range(3)),
+    )
+
+    assert [(p["id"], p["sql"], p["sampled"]) for p in profiler.list()] == [
+        (3, "SELECT 2", True),
+        (2, "SELECT 1", True),
+    ]
+    assert profiler.get(1) is None
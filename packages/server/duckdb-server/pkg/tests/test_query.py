@@ -1,17 +1,56 @@
 from __future__ import annotations
 
+import json
+import struct
 from functools import partial
+from typing import TYPE_CHECKING
 
 import duckdb
 import pyarrow as pa
+import pytest
 
-from pkg.query import get_arrow, get_json, get_key
+from pkg.query import (
+    arrow_to_bytes,
+    arrow_to_chunks,
+    encode_batch,
+    get_arrow,
+    get_json,
+    get_key,
+    get_query_key,
+)
+
+if TYPE_CHECKING:
+    from pkg.query import _QueryParams
 
 
 def test_key() -> None:
     assert (
         get_key("SELECT 1", "arrow")
-        == "e004ebd5b5532a4b85984a62f8ad48a81aa3460c1ca07701f386135d72cdecf5.arrow"
+        == "fed334b81e1a1e6c0ab9ad215cc767eceb37250f6dc0d092946f0ef1d97b3906.arrow"
+    )
+
+
+def test_key_ignores_formatting() -> None:
+    key = get_key('SELECT "a", count(*) AS n FROM "t" WHERE x > 1 GROUP BY a', "json")
+
+    assert key == get_key(
+        "select a,\n  COUNT(*) as n\nfrom t -- comment\nwhere x>1 group by a", "json"
+    )
+    assert key != get_key('SELECT "a", count(*) AS n FROM "t" GROUP BY a', "json")
+    # string constants and the case of column names in the result still matter
+    assert get_key("SELECT 'a'", "json") != get_key("SELECT 'A'", "json")
+    assert get_key("SELECT a FROM t", "json") != get_key("SELECT A FROM t", "json")
+    assert get_key("SELECT 1", "json") != get_key("SELECT 1", "arrow")
+
+
+def test_key_of_template() -> None:
+    sql = "SELECT a FROM t WHERE b > $1"
+
+    assert get_key(sql, "json", [1]) == get_key(sql, "json", [1])
+    assert get_key(sql, "json", [1]) != get_key(sql, "json", [2])
+    assert get_key(sql, "json", [1]) != get_key(sql, "json")
+    assert get_key("SELECT $a", "json", {"a": 1, "b": 2}) == get_key(
+        "SELECT $a", "json", {"b": 2, "a": 1}
     )
 
 
@@ -21,6 +60,15 @@ def test_query_json() -> None:
     assert partial(get_json, con)("SELECT 1 AS a") == '[{"a":1}]'
 
 
+def test_query_params() -> None:
+    con = duckdb.connect()
+    sql = "SELECT range AS a FROM range(5) WHERE range > $min AND range < $max"
+
+    assert get_json(con, sql, {"min": 1, "max": 4}) == '[{"a":2},{"a":3}]'
+    reader = get_arrow(con, "SELECT $1 AS a, $2 AS b", [1, "x"])
+    assert reader.read_all().to_pylist() == [{"a": 1, "b": "x"}]
+
+
 def test_query_arrow() -> None:
     con = duckdb.connect()
 
@@ -28,3 +76,138 @@ def test_query_arrow() -> None:
     table = pa.Table.from_pylist([{"a": 1}], schema=my_schema)
 
     assert partial(get_arrow, con)("SELECT 1 AS a").read_all() == table
+
+
+def test_arrow_to_chunks() -> None:
+    con = duckdb.connect()
+
+    reader = con.query("SELECT range AS a FROM range(3000000)").arrow()
+    chunks = list(arrow_to_chunks(reader))
+
+    # one chunk per record batch and one for the end-of-stream marker
+    assert len(chunks) > 2
+    assert pa.ipc.open_stream(b"".join(chunks)).read_all().num_rows == 3000000
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd"])
+def test_arrow_compression(compression: str) -> None:
+    con = duckdb.connect()
+    sql = "SELECT range % 10 AS a FROM range(100000)"
+
+    plain = arrow_to_bytes(con.query(sql).arrow())
+    compressed = arrow_to_bytes(con.query(sql).arrow(), compression)
+    chunks = b"".join(arrow_to_chunks(con.query(sql).arrow(), compression))
+
+    assert len(compressed) < len(plain) / 10
+    expected = pa.ipc.open_stream(plain).read_all()
+    assert pa.ipc.open_stream(compressed).read_all() == expected
+    assert pa.ipc.open_stream(chunks).read_all() == expected
+
+
+def test_query_key_depends_on_compression() -> None:
+    query: _QueryParams = {"type": "arrow", "sql": "SELECT 1", "uuid": "1"}
+
+    assert get_query_key(query) == get_key("SELECT 1", "arrow")
+    assert get_query_key({**query, "compression": "zstd"}) != get_query_key(query)
+    # json results are not compressed
+    assert get_query_key({**query, "type": "json", "compression": "zstd"}) == get_key(
+        "SELECT 1", "json"
+    )
+    with pytest.raises(ValueError, match="Unsupported compression"):
+        get_query_key({**query, "compression": "gzip"})  # pyright: ignore[reportArgumentType]
+
+
+def test_arrow_to_chunks_empty() -> None:
+    con = duckdb.connect()
+
+    reader = con.query("SELECT 1 AS a WHERE false").arrow()
+    table = pa.ipc.open_stream(b"".join(arrow_to_chunks(reader))).read_all()
+
+    assert table.num_rows == 0
+    assert table.schema.names == ["a"]
+
+
+def test_arrow_to_bytes_single_copy() -> None:
+    con = duckdb.connect()
+    table = con.query("SELECT range AS a, range * 2 AS b FROM range(2000000)").arrow()
+    table = table.read_all()
+    reader = pa.RecordBatchReader.from_batches(table.schema, table.to_batches())
+
+    # track the Arrow memory allocated while encoding
+    default_pool = pa.default_memory_pool()
+    pool = pa.proxy_memory_pool(default_pool)
+    pa.set_memory_pool(pool)
+    try:
+        result = arrow_to_bytes(reader)
+    finally:
+        pa.set_memory_pool(default_pool)
+
+    assert isinstance(result, bytes)
+    assert len(result) > 32_000_000
+    # the IPC stream is written into Python memory directly, without an
+    # intermediate Arrow buffer of the same size
+    assert pool.max_memory() < len(result) / 10
+    assert pa.ipc.open_stream(result).read_all() == table
+
+
+def test_query_json_types() -> None:
+    con = duckdb.connect()
+
+    result = get_json(
+        con,
+        """SELECT DATE '2024-01-02' AS d, 'nan'::DOUBLE AS n, 'inf'::FLOAT AS i,
+        [1, 2] AS l, 'NaN' AS "s""q" """,
+    )
+    assert result == '[{"d":"2024-01-02","n":null,"i":null,"l":[1,2],"s\\"q":"NaN"}]'
+
+
+def test_query_json_repeated_names() -> None:
+    con = duckdb.connect()
+
+    result = get_json(con, "SELECT 1 AS a, 2 AS a, 3 AS A, 'nan'::DOUBLE AS a")
+    assert result == '[{"a":1,"a_1":2,"A_2":3,"a_3":null}]'
+
+
+def test_query_json_nested_non_finite() -> None:
+    con = duckdb.connect()
+
+    result = get_json(
+        con,
+        """SELECT [1.5, 'nan'::DOUBLE, '-inf'::DOUBLE] AS l,
+        {'x': 'inf'::FLOAT, 's': 'NaN "Infinity"'} AS s""",
+    )
+    assert result == '[{"l":[1.5,null,null],"s":{"x":null,"s":"NaN \\"Infinity\\""}}]'
+
+
+def test_query_json_order() -> None:
+    con = duckdb.connect()
+
+    result = get_json(con, "SELECT range AS a FROM range(3) ORDER BY a DESC")
+    assert result == '[{"a":2},{"a":1},{"a":0}]'
+    assert get_json(con, "SELECT 1 AS a WHERE false") == "[]"
+
+
+def test_encode_batch() -> None:
+    arrow = arrow_to_bytes(get_arrow(duckdb.connect(), "SELECT 1 AS a"))
+    message = encode_batch(
+        [
+            {"type": "arrow", "sql": "SELECT 1 AS a", "uuid": "1"},
+            {"type": "exec", "sql": "SELECT 1", "uuid": "2"},
+            {"type": "json", "sql": "SELECT nope", "uuid": "3"},
+            {"type": "json", "sql": "SELECT 'é' AS b", "uuid": "4"},
+        ],
+        [arrow, None, ValueError("nope"), '[{"b":"é"}]'],
+    )
+
+    (length,) = struct.unpack(">I", message[:4])
+    header = json.loads(message[4 : 4 + length])
+    assert header == [
+        {"type": "arrow", "size": len(arrow)},
+        {"type": "exec", "size": 0},
+        {"type": "json", "size": 0, "error": "nope"},
+        {"type": "json", "size": len('[{"b":"é"}]'.encode())},
+    ]
+
+    payloads = memoryview(message)[4 + length :]
+    assert pa.ipc.open_stream(payloads[: len(arrow)]).read_all().num_rows == 1
+    assert json.loads(bytes(payloads[len(arrow) :])) == [{"b": "é"}]
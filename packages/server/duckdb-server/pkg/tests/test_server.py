@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+from socketify import OpCode
+
+from pkg.server import MAX_BACKPRESSURE, SocketClient
+
+
+class FakeSocket:
+    """Records sent messages and reports a send buffer that the test controls."""
+
+    def __init__(self) -> None:
+        self.sent: list[bytes | str] = []
+        self.buffered = 0
+
+    def get_buffered_amount(self) -> int:
+        return self.buffered
+
+    def send(self, data: bytes | str, opcode: OpCode) -> bool:
+        self.sent.append(data)
+        self.buffered += len(data)
+        return True
+
+
+def test_outbox_waits_for_drain() -> None:
+    async def run() -> None:
+        ws: Any = FakeSocket()
+        client = SocketClient()
+
+        client.enqueue(ws, "1", b"x" * (MAX_BACKPRESSURE + 1), OpCode.BINARY)
+        client.enqueue(ws, "2", b"y", OpCode.BINARY)
+        # the second result waits until the first leaves the send buffer
+        assert ws.sent == [b"x" * (MAX_BACKPRESSURE + 1)]
+        assert client.outbox_bytes == 1
+
+        ws.buffered = 0
+        await asyncio.sleep(0.05)
+        assert ws.sent[1:] == [b"y"]
+        assert client.flusher is None
+
+    asyncio.run(run())
+
+
+def test_cancel_supersedes_unsent_result() -> None:
+    async def run() -> None:
+        ws: Any = FakeSocket()
+        ws.buffered = MAX_BACKPRESSURE + 1
+        client = SocketClient()
+
+        client.enqueue(ws, "1", b"result", OpCode.BINARY)
+        client.cancel("1")
+        ws.buffered = 0
+        await asyncio.sleep(0.05)
+
+        assert ws.sent == ['{"error":"Query cancelled"}']
+
+    asyncio.run(run())
+
+
+def test_wait_for_room() -> None:
+    async def run() -> None:
+        ws: Any = FakeSocket()
+        client = SocketClient()
+        client.enqueue(ws, "1", b"x" * (MAX_BACKPRESSURE + 1), OpCode.BINARY)
+
+        waiter = asyncio.ensure_future(client.wait_for_room(ws))
+        await asyncio.sleep(0)
+        # below the high-water mark, the next query does not wait
+        assert waiter.done()
+
+        ws.buffered = 100 * 1024 * 1024
+        waiter = asyncio.ensure_future(client.wait_for_room(ws))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        ws.buffered = 0
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(run())
+
+
+def test_close_drops_unsent_results() -> None:
+    async def run() -> None:
+        ws: Any = FakeSocket()
+        ws.buffered = MAX_BACKPRESSURE + 1
+        client = SocketClient()
+
+        client.enqueue(ws, "1", b"result", OpCode.BINARY)
+        client.close()
+        client.enqueue(ws, "2", b"late", OpCode.BINARY)
+        await asyncio.sleep(0.05)
+
+        assert ws.sent == []
+        assert client.outbox_bytes == 0
+
+    asyncio.run(run())
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import duckdb
+import pytest
+
+from pkg.session import Session
+
+
+@pytest.fixture
+def session() -> Session:
+    return Session(duckdb.connect())
+
+
+def run(session: Session, sql: str) -> list[tuple[object, ...]]:
+    with session.cursor(sql) as cursor:
+        return cursor.execute(sql).fetchall()
+
+
+def test_temporary_objects(session: Session) -> None:
+    run(session, "CREATE TEMP TABLE tt AS SELECT 42 AS a")
+    run(session, "CREATE TEMP MACRO plus_one(a) AS a + 1")
+
+    assert run(session, "SELECT plus_one(a) FROM tt") == [(43,)]
+    run(session, "INSERT INTO tt VALUES (1)")
+    assert run(session, "SELECT count(*) FROM TT") == [(2,)]
+    assert not session.uses_temporary("SELECT * FROM tt_other")
+
+
+def test_temporary_names_in_other_words(session: Session) -> None:
+    run(session, "CREATE TEMP TABLE date AS SELECT 1 AS a")
+
+    assert session.uses_temporary("SELECT a FROM Date")
+    assert session.uses_temporary("INSERT INTO date VALUES (2)")
+    # a column or a string of the same name does not read the table
+    assert not session.uses_temporary("SELECT date, 'date' FROM flights")
+
+
+def test_settings(session: Session) -> None:
+    run(session, "CREATE SCHEMA s; CREATE TABLE s.t AS SELECT 1 AS a")
+    run(session, "SET VARIABLE x = 1")
+    run(session, "SET VARIABLE x = 2; USE memory.s")
+
+    assert run(session, "SELECT getvariable('x') + a FROM t") == [(3,)]
+
+    # temporary objects see the settings too
+    run(session, "CREATE TEMP TABLE tt AS SELECT getvariable('x') AS x")
+    assert run(session, "SELECT x FROM tt") == [(2,)]
+
+
+def test_failed_statements_do_not_count(session: Session) -> None:
+    with pytest.raises(duckdb.Error):
+        run(session, "SET VARIABLE x = 1; CREATE TEMP TABLE tt AS FROM missing")
+    assert not session.uses_temporary("FROM tt")
+    assert run(session, "SELECT getvariable('x')") == [(None,)]
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import duckdb
+import pytest
+
+from pkg.sql import (
+    EVERYTHING,
+    canonical_sql,
+    is_select,
+    quote,
+    read_files,
+    read_table_names,
+    read_tables,
+    session_statements,
+    written_tables,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def con() -> duckdb.DuckDBPyConnection:
+    con = duckdb.connect()
+    con.execute("CREATE TABLE flights AS SELECT 1 AS a")
+    con.execute("CREATE VIEW v AS SELECT a FROM flights")
+    return con
+
+
+def test_canonical_sql_falls_back_to_text() -> None:
+    assert canonical_sql("CREATE TABLE t (a INT)") == "CREATE TABLE t (a INT)"
+    assert canonical_sql("SELEC 1") == "SELEC 1"
+    assert '"query_location"' not in canonical_sql("SELECT 1")
+
+
+def test_read_tables(con: duckdb.DuckDBPyConnection) -> None:
+    assert read_tables(con, 'SELECT * FROM main."Flights"') == {"flights"}
+    # views are expanded to the tables they read
+    assert read_tables(con, "SELECT * FROM v") == {"flights"}
+    assert read_tables(con, "SELECT * FROM 'data.parquet'") == {"data.parquet"}
+    # table functions and catalog queries may read anything
+    assert read_tables(con, "SELECT * FROM read_parquet('data.parquet')") == EVERYTHING
+    assert read_tables(con, "SHOW TABLES") == EVERYTHING
+    assert read_tables(con, "SELECT 1") == EVERYTHING
+
+
+def test_read_table_names(con: duckdb.DuckDBPyConnection) -> None:
+    assert read_table_names(con, 'SELECT * FROM "Mosaic"."Preagg_1", t') == {
+        ("mosaic", "preagg_1"),
+        ("t",),
+    }
+    assert read_table_names(con, "SELECT nope(") == set()
+
+
+def test_read_files(
+    con: duckdb.DuckDBPyConnection, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "a.csv").write_text("x\n1\n")
+    (tmp_path / "b.csv").write_text("x\n2\n")
+    con.execute("CREATE VIEW files AS FROM read_csv('data/*.csv')")
+    con.execute("CREATE VIEW both_files AS FROM files UNION ALL FROM 'b.csv'")
+
+    pattern = str(tmp_path / "data" / "*.csv")
+    assert read_files(con, "FROM read_csv(['b.csv', 'missing.csv'])") == {
+        str(tmp_path / "b.csv")
+    }
+    # views are expanded to the files they read
+    assert read_files(con, "FROM both_files") == {pattern, str(tmp_path / "b.csv")}
+    assert read_files(con, "FROM flights") == set()
+    assert read_files(con, "FROM 's3://bucket/b.csv'") == set()
+
+
+@pytest.mark.parametrize(
+    ("sql", "tables"),
+    [
+        ("CREATE OR REPLACE TABLE flights AS SELECT * FROM 'x.parquet'", {"flights"}),
+        ("CREATE TEMP TABLE IF NOT EXISTS s.preagg AS SELECT 1", {"preagg"}),
+        ('INSERT INTO main."Flights" SELECT 2', {"flights"}),
+        ("UPDATE flights SET a = 1", {"flights"}),
+        ("DELETE FROM flights", {"flights"}),
+        ("DROP VIEW IF EXISTS v", {"v"}),
+        ("ALTER TABLE flights RENAME TO f", {"flights"}),
+        ("COPY flights FROM 'x.csv'", {"flights"}),
+        ("COPY (SELECT 1) TO 'Out.parquet'", {"out.parquet"}),
+        ("-- comment\nCREATE TABLE a (x INT); INSERT INTO b VALUES (1)", {"a", "b"}),
+        ("LOAD spatial", set()),
+        # creating an object unless it exists writes nothing when it does
+        ("CREATE TABLE IF NOT EXISTS flights AS SELECT 2 AS a", set()),
+        ("CREATE VIEW IF NOT EXISTS memory.main.v AS SELECT 1", set()),
+        ("CREATE TABLE IF NOT EXISTS main.flights AS SELECT 2 AS a", set()),
+        ("CREATE TABLE IF NOT EXISTS other.flights AS SELECT 2 AS a", {"flights"}),
+        ("CREATE TABLE IF NOT EXISTS f AS SELECT 2 AS a", {"f"}),
+        ("CREATE SCHEMA IF NOT EXISTS main", set()),
+        ("CREATE MACRO m(x) AS x", set()),
+        ("SELEC 1", set()),
+        ("CREATE OR REPLACE MACRO m(x) AS x", EVERYTHING),
+        ("ATTACH ':memory:' AS other", EVERYTHING),
+        ("SET search_path = 'other'", EVERYTHING),
+        ("WITH x AS (SELECT 1) INSERT INTO flights SELECT * FROM x", EVERYTHING),
+    ],
+)
+def test_written_tables(
+    con: duckdb.DuckDBPyConnection, sql: str, tables: set[str]
+) -> None:
+    assert written_tables(con, sql) == tables
+
+
+def test_quote() -> None:
+    assert quote('my "table"') == '"my ""table"""'
+    assert quote("db", "main", "t.1") == '"db"."main"."t.1"'
+
+
+def test_is_select() -> None:
+    assert is_select("WITH t AS (SELECT 1) FROM t;")
+    assert not is_select("INSERT INTO t VALUES (1) RETURNING a")
+    assert not is_select("SELECT 1; SELECT 2")
+    assert not is_select("SELEC 1")
+
+
+def test_session_statements() -> None:
+    assert session_statements("SELECT 1") == (frozenset(), ())
+    assert session_statements(
+        "CREATE TEMP TABLE Tt AS SELECT 1; CREATE TEMPORARY MACRO m(a) AS a; "
+        "CREATE TABLE t (a INT); SET VARIABLE x = 1; USE memory.main"
+    ) == ({"tt", "m"}, ("SET VARIABLE x = 1", "USE memory.main"))
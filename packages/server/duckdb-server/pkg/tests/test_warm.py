@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import TYPE_CHECKING
+
+from pkg.executor import Priority, QueryExecutor
+from pkg.query import get_key
+from pkg.warm import load_workload, warm_cache
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_load_workload(tmp_path: Path) -> None:
+    (tmp_path / "setup.sql").write_text(
+        "CREATE TABLE t AS SELECT range AS a FROM range(10);\nSELECT count(*) FROM t;\n"
+    )
+    (tmp_path / "workload.jsonl").write_text(
+        json.dumps({"type": "json", "sql": "SELECT max(a) FROM t", "uuid": "1"})
+        + "\n"
+        + json.dumps({"type": "cancel", "uuid": "1"})
+        + "\n"
+    )
+
+    queries = load_workload(
+        [str(tmp_path / "setup.sql"), str(tmp_path / "workload.jsonl")]
+    )
+
+    assert [(query["type"], query["sql"]) for query in queries] == [
+        ("exec", "CREATE TABLE t AS SELECT range AS a FROM range(10)"),
+        ("arrow", "SELECT count(*) FROM t"),
+        ("json", "SELECT max(a) FROM t"),
+    ]
+    assert queries[1]["persist"]
+    assert all(query["priority"] == Priority.LOW for query in queries)
+
+
+def test_warm_cache(tmp_path: Path, executor: QueryExecutor) -> None:
+    (tmp_path / "warm.json").write_text(
+        json.dumps(
+            [
+                {"type": "exec", "sql": "CREATE TABLE t AS SELECT 1 AS a"},
+                {"type": "json", "sql": "SELECT a FROM t"},
+                {"type": "json", "sql": "SELECT nope"},
+            ]
+        )
+    )
+
+    asyncio.run(warm_cache(executor, load_workload([str(tmp_path / "warm.json")])))
+
+    # a failing query does not stop the others
+    assert executor.cache.get(get_key("SELECT a FROM t", "json")) == '[{"a":1}]'
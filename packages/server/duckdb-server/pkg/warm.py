@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import duckdb
+
+from pkg.executor import Priority
+
+if TYPE_CHECKING:
+    from pkg.executor import QueryExecutor
+    from pkg.query import _QueryParams
+
+logger = logging.getLogger(__name__)
+
+# commands a workload may contain
+WARM_COMMANDS = frozenset(("arrow", "json", "exec"))
+
+# warm-up queries take turns with clients like any other client
+WARM_CLIENT = "warm-up"
+
+
+def read_sql(text: str) -> list[_QueryParams]:
+    """Queries from a SQL script: SELECTs are cached, other statements are run."""
+    queries: list[_QueryParams] = []
+    for statement in duckdb.extract_statements(text):
+        sql = statement.query.strip().rstrip(";").rstrip()
+        if statement.type == duckdb.StatementType.SELECT:
+            queries.append({"type": "arrow", "sql": sql, "uuid": "", "persist": True})
+        else:
+            queries.append({"type": "exec", "sql": sql, "uuid": ""})
+    return queries
+
+
+def read_workload(text: str) -> list[_QueryParams]:
+    """Queries from a JSON array or JSON lines of query messages."""
+    stripped = text.lstrip()
+    if stripped.startswith("["):
+        messages = json.loads(stripped)
+    else:
+        messages = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    queries: list[_QueryParams] = []
+    for message in messages:
+        if message.get("type") not in WARM_COMMANDS or "sql" not in message:
+            logger.warning(f"Skipping {message!r} in the warm-up workload")
+            continue
+        queries.append({**message, "uuid": message.get("uuid", "")})
+    return queries
+
+
+def load_workload(paths: list[str]) -> list[_QueryParams]:
+    """Read the queries of SQL files (*.sql) and recorded workloads (JSON)."""
+    queries: list[_QueryParams] = []
+    for path in map(Path, paths):
+        text = path.read_text()
+        queries += read_sql(text) if path.suffix == ".sql" else read_workload(text)
+    for query in queries:
+        query.setdefault("priority", Priority.LOW)
+    return queries
+
+
+async def warm_cache(executor: QueryExecutor, queries: list[_QueryParams]) -> None:
+    """Run the queries in parallel, and statements in order, to fill the cache."""
+    start = time.time()
+    hits = executor.cache.memory_hits + executor.cache.disk_hits
+
+    size = len(queries) or 1
+    if executor.scheduler.max_queued is not None:
+        # with a bounded queue, a slice at a time leaves room for the clients
+        size = executor.workers
+    results: list[bytes | str | BaseException | None] = []
+    for i in range(0, len(queries), size):
+        results += await executor.submit_batch(queries[i : i + size], WARM_CLIENT)
+
+    errors = [
+        (query, result)
+        for query, result in zip(queries, results, strict=True)
+        if isinstance(result, BaseException)
+    ]
+    for query, error in errors:
+        logger.warning(f"Warm-up query failed: {error}\n{query['sql']}")
+    cached = executor.cache.memory_hits + executor.cache.disk_hits - hits
+    total = round((time.time() - start) * 1_000)
+    logger.info(
+        f"Warmed the cache with {len(queries)} queries in {total} ms "
+        f"({cached} already cached, {len(errors)} failed)"
+    )
+
+
+async def keep_warm(
+    executor: QueryExecutor, queries: list[_QueryParams], interval: float
+) -> None:
+    """Run the queries again every `interval` seconds, e.g. after invalidations.
+
+    Statements other than queries only run at startup, since running them again
+    could change the data and invalidate the cache.
+    """
+    queries = [query for query in queries if query["type"] != "exec"]
+    while True:
+        await asyncio.sleep(interval)
+        await warm_cache(executor, queries)
@@ -1,10 +1,16 @@
 from __future__ import annotations
 
+import asyncio
 import inspect
+import json
 import logging
 import pathlib
+import re
+import threading
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import TYPE_CHECKING, Any, Literal, Protocol, TypedDict
 
 import anywidget
@@ -18,6 +24,8 @@ from mosaic_widget.frame_interop import (
 )
 
 if TYPE_CHECKING:
+    from concurrent.futures import Future
+
     from narwhals.typing import IntoFrame
     from typing_extensions import Buffer, NotRequired, TypeIs
 
@@ -26,11 +34,22 @@ logger.addHandler(logging.NullHandler())
 
 SLOW_QUERY_THRESHOLD = 5000
 
+# JSON has no NaN or Infinity, so json results have null for non-finite numbers,
+# as in the results of the DuckDB server
+FLOAT_TYPES = frozenset(("FLOAT", "DOUBLE"))
+
+# floats inside lists, structs, maps and arrays, e.g. DOUBLE[] or STRUCT(x FLOAT)
+NESTED_FLOAT = re.compile(r"\b(?:FLOAT|DOUBLE)\b")
+
+# the non-finite numbers in DuckDB's JSON, and the strings to skip while finding them
+NON_FINITE = re.compile(r'("(?:[^"\\]|\\.)*")|-?Infinity|NaN')
+
 
 class _QueryParams(TypedDict):
-    type: Literal["arrow", "exec", "json"]
+    type: Literal["arrow", "exec", "json", "cancel"]
     sql: str
     uuid: str  # name
+    params: NotRequired[list[Any] | dict[str, Any]]  # values of $1 or $name in sql
     persist: NotRequired[bool]
 
 
@@ -65,6 +84,33 @@ def _register_frame_data(spec: dict[str, Any], data: dict[str, Any]) -> dict[str
     )
 
 
+def _to_json(relation: duckdb.DuckDBPyRelation) -> str:
+    """The rows of a relation as a JSON array, serialized by DuckDB."""
+    # Columns are taken by position, since names may repeat. DuckDB renames the
+    # repeated ones, e.g. to a_1.
+    columns = []
+    nested = False
+    for i, (name, dtype) in enumerate(
+        zip(relation.columns, relation.types, strict=True)
+    ):
+        column = f"#{i + 1}"
+        if str(dtype) in FLOAT_TYPES:
+            column = f"CASE WHEN isfinite({column}) THEN {column} END"
+        elif NESTED_FLOAT.search(str(dtype)):
+            nested = True
+        quoted = '"' + name.replace('"', '""') + '"'
+        columns.append(f"{column} AS {quoted}")
+
+    rows = relation.project(", ".join(columns)).set_alias("__rows")
+    records = rows.project("to_json(__rows)").fetchall()
+    if nested:
+        records = [
+            (NON_FINITE.sub(lambda match: match.group(1) or "null", row),)
+            for (row,) in records
+        ]
+    return "[" + ",".join(row for (row,) in records) + "]"
+
+
 class MosaicWidget(anywidget.AnyWidget):
     _esm = pathlib.Path(__file__).parent / "static" / "index.js"
     _css = pathlib.Path(__file__).parent / "static" / "index.css"
@@ -96,7 +142,9 @@ class MosaicWidget(anywidget.AnyWidget):
             spec (dict or object with a to_dict() method, optional): The initial
                 Mosaic specification. Defaults to {}.
             con (connection, optional): A DuckDB connection.
-                Defaults to duckdb.connect().
+                Defaults to duckdb.connect(). Queries run on a cursor of it, which
+                does not see objects registered on the connection itself, so pass
+                those in `data` instead.
             data (dict, optional): DataFrames/Arrow objects to "register" with DuckDB.
                 Defaults to {}. Keys are table names, values are objects to register as
                 virtual tables (similar to SQL VIEWs). Supports pandas/polars DataFrames
@@ -125,45 +173,111 @@ class MosaicWidget(anywidget.AnyWidget):
         super().__init__(*args, **kwargs)
         self.spec = spec_
         self.con = con
+        # Queries run one at a time on a background thread so that the kernel
+        # can still receive cancel messages while a query is running. A DuckDB
+        # connection is not meant for several threads, so they get a cursor.
+        self._cursor = con.cursor()
         self._registered_tables: set[str] = set()
         for name, df in data.items():
-            self.con.register(name, frame_to_duckdb_registrable(df))
+            registrable = frame_to_duckdb_registrable(df)
+            self.con.register(name, registrable)
+            self._cursor.register(name, registrable)
             self._registered_tables.add(name)
+
+        self._queries = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="mosaic-widget"
+        )
+        self._pending: dict[str, Future[None]] = {}
+        self._running: str | None = None
+        self._running_lock = threading.Lock()
         self.on_msg(self._handle_custom_msg)
 
     def _handle_custom_msg(
         self, content: _QueryParams, buffers: list[bytes | Buffer]
     ) -> None:
         logger.debug(f"{content=}, {buffers=}")
+
+        uuid = content["uuid"]
+        if content["type"] == "cancel":
+            self._cancel(uuid)
+            return
+
+        try:
+            # the kernel's event loop, which sends the results of the query
+            loop: asyncio.AbstractEventLoop | None = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        future = self._queries.submit(self._run_query, content, loop)
+        self._pending[uuid] = future
+        future.add_done_callback(lambda _: self._pending.pop(uuid, None))
+
+    def _cancel(self, uuid: str) -> None:
+        future = self._pending.get(uuid)
+        if future is None:
+            logger.debug(f"No query {uuid} to cancel")
+            return
+        if future.cancel():
+            logger.info(f"Cancelled query {uuid}")
+            self.send({"error": "Query cancelled", "uuid": uuid})
+            return
+        with self._running_lock:
+            if self._running == uuid:
+                # the query fails with an interrupt error, which is sent as usual
+                self._cursor.interrupt()
+
+    def _reply(
+        self,
+        loop: asyncio.AbstractEventLoop | None,
+        content: dict[str, Any],
+        buffers: list[Any] | None = None,
+    ) -> None:
+        """Send a message from the query thread on the kernel's thread."""
+        if loop is None or loop.is_closed():
+            # without an event loop, e.g. outside of a kernel, send it from here
+            self.send(content, buffers)
+        else:
+            loop.call_soon_threadsafe(partial(self.send, content, buffers))
+
+    def _run_query(
+        self, content: _QueryParams, loop: asyncio.AbstractEventLoop | None = None
+    ) -> None:
         start = time.time()
 
         uuid = content["uuid"]
         sql = content["sql"]
         command = content["type"]
+        params = content.get("params")
 
+        with self._running_lock:
+            self._running = uuid
         try:
             if command == "arrow":
-                result = self.con.query(sql).arrow()
+                result = self._cursor.sql(sql, params=params).arrow()
                 sink = pa.BufferOutputStream()
                 with pa.ipc.new_stream(sink, result.schema) as writer:
                     for batch in result:
                         writer.write(batch)
+                # pa.Buffer supports the buffer protocol, so the comm can send it
+                # without first copying it into bytes
                 buf = sink.getvalue()
 
-                self.send({"type": "arrow", "uuid": uuid}, buffers=[buf.to_pybytes()])
+                self._reply(loop, {"type": "arrow", "uuid": uuid}, [buf])
             elif command == "exec":
-                self.con.execute(sql)
-                self.send({"type": "exec", "uuid": uuid})
+                self._cursor.execute(sql, params)
+                self._reply(loop, {"type": "exec", "uuid": uuid})
             elif command == "json":
-                result = self.con.query(sql).df()
-                json = result.to_dict(orient="records")
-                self.send({"type": "json", "uuid": uuid, "result": json})
+                # let DuckDB serialize the rows instead of going through pandas
+                result = json.loads(_to_json(self._cursor.sql(sql, params=params)))
+                self._reply(loop, {"type": "json", "uuid": uuid, "result": result})
             else:
                 msg = f"Unknown command {command}"
                 raise ValueError(msg)
         except Exception as e:
             logger.exception("Error processing query")
-            self.send({"error": str(e), "uuid": uuid})
+            self._reply(loop, {"error": str(e), "uuid": uuid})
+        finally:
+            with self._running_lock:
+                self._running = None
 
         total = round((time.time() - start) * 1_000)
         if total > SLOW_QUERY_THRESHOLD:
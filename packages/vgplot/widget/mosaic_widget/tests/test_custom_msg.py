@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import tracemalloc
+from typing import Any
+
+import pyarrow as pa
+import pytest
+
+from mosaic_widget import MosaicWidget
+
+
+class RecordingWidget(MosaicWidget):
+    """Records the messages the widget sends instead of sending them to a comm."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.sent: list[tuple[dict[str, Any], list[Any] | None]] = []
+        # the threads that sent the messages
+        self.threads: list[int] = []
+
+    def send(self, content: dict[str, Any], buffers: list[Any] | None = None) -> None:
+        self.sent.append((content, buffers))
+        self.threads.append(threading.get_ident())
+
+    def handle(self, content: dict[str, Any]) -> None:
+        """Handle a message and wait until all queued queries are done."""
+        self._handle_custom_msg(content, [])  # pyright: ignore[reportArgumentType]
+        self._queries.submit(lambda: None).result()
+
+
+@pytest.fixture
+def widget() -> RecordingWidget:
+    return RecordingWidget()
+
+
+def test_arrow(widget: RecordingWidget) -> None:
+    widget.handle({"type": "arrow", "sql": "SELECT 1 AS a", "uuid": "1"})
+
+    [(content, buffers)] = widget.sent
+    assert content == {"type": "arrow", "uuid": "1"}
+    assert buffers is not None
+    table = pa.ipc.open_stream(buffers[0]).read_all()
+    assert table.to_pylist() == [{"a": 1}]
+
+
+def test_arrow_buffer_is_not_copied(widget: RecordingWidget) -> None:
+    sql = "SELECT range AS a, range * 2 AS b FROM range(2000000)"
+
+    tracemalloc.start()
+    try:
+        widget.handle({"type": "arrow", "sql": sql, "uuid": "1"})
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    [(_, buffers)] = widget.sent
+    assert buffers is not None
+    [buffer] = buffers
+    # the Arrow buffer is handed to the comm as is ...
+    assert isinstance(buffer, pa.Buffer)
+    assert buffer.size > 32_000_000
+    # ... so the payload is never copied into Python memory
+    assert peak < buffer.size / 10
+
+
+def test_json(widget: RecordingWidget) -> None:
+    widget.handle({"type": "json", "sql": "SELECT 1 AS a", "uuid": "1"})
+
+    assert widget.sent == [({"type": "json", "uuid": "1", "result": [{"a": 1}]}, None)]
+
+
+def test_json_like_the_server(widget: RecordingWidget) -> None:
+    sql = "SELECT 'NaN'::DOUBLE AS a, 1 AS a, ['inf'::DOUBLE, 2.5] AS b, 'NaN' AS c"
+    widget.handle({"type": "json", "sql": sql, "uuid": "1"})
+
+    [(content, _)] = widget.sent
+    # repeated names are kept apart and non-finite numbers are null
+    assert content["result"] == [{"a": None, "a_1": 1, "b": [None, 2.5], "c": "NaN"}]
+
+
+def test_reply_on_kernel_thread() -> None:
+    widget = RecordingWidget(data={"t": pa.table({"a": [1]})})
+
+    async def run() -> None:
+        # as the kernel does, on its event loop
+        widget._handle_custom_msg({"type": "json", "sql": "FROM t", "uuid": "1"}, [])
+        while not widget.sent:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+
+    # the query ran on the worker's cursor, which sees the registered data
+    assert widget.sent == [({"type": "json", "uuid": "1", "result": [{"a": 1}]}, None)]
+    assert widget.threads == [threading.get_ident()]
+
+
+def test_params(widget: RecordingWidget) -> None:
+    widget.handle(
+        {"type": "json", "sql": "SELECT $1 + 1 AS a", "uuid": "1", "params": [1]}
+    )
+
+    assert widget.sent == [({"type": "json", "uuid": "1", "result": [{"a": 2}]}, None)]
+
+
+def test_exec(widget: RecordingWidget) -> None:
+    widget.handle(
+        {"type": "exec", "sql": "CREATE TABLE t AS SELECT 1 AS a", "uuid": "1"}
+    )
+
+    assert widget.sent == [({"type": "exec", "uuid": "1"}, None)]
+    assert widget.con.query("SELECT a FROM t").fetchall() == [(1,)]
+
+
+def test_error(widget: RecordingWidget) -> None:
+    widget.handle({"type": "json", "sql": "SELECT nope", "uuid": "1"})
+
+    [(content, _)] = widget.sent
+    assert content["uuid"] == "1"
+    assert "nope" in content["error"]
+
+
+def test_cancel_queued_query(widget: RecordingWidget) -> None:
+    slow = "SELECT count(*) FROM range(100000000000)"
+    widget._handle_custom_msg({"type": "json", "sql": slow, "uuid": "1"}, [])
+    widget._handle_custom_msg({"type": "json", "sql": "SELECT 1 AS a", "uuid": "2"}, [])
+    widget._handle_custom_msg({"type": "cancel", "sql": "", "uuid": "2"}, [])
+    # give the slow query time to start
+    time.sleep(0.2)
+    widget.handle({"type": "cancel", "sql": "", "uuid": "1"})
+
+    [(cancelled, _), (interrupted, _)] = widget.sent
+    # the queued query is dropped without running ...
+    assert cancelled == {"error": "Query cancelled", "uuid": "2"}
+    # ... and the running one is interrupted
+    assert interrupted["uuid"] == "1"
+    assert "INTERRUPT" in interrupted["error"]
+    assert not widget._pending